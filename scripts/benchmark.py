@@ -1,48 +1,398 @@
+"""Benchmark watchbot-progress against local stand-ins for AWS and Redis
+
+SNS is replaced by an in-process fake which accepts every message, with an
+optional simulated request latency. Redis is a local redis-server given by
+--redis-url, which must be an empty database, or an in-process mockredis. DynamoDB is moto's in-process fake,
+which must be installed separately (pip install moto). The memory backend
+needs no stand-in, and the sqlite and shared backends use files in a temporary
+directory.
+
+Results are written as JSON, so that runs of different releases can be
+compared, e.g.
+
+    python scripts/benchmark.py -b redis --redis-url redis://localhost:6379/0 -o redis.json
+"""
 from concurrent import futures
+from contextlib import contextmanager, ExitStack
+import json
+import math
+import multiprocessing
+import os
+import platform
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest import mock
+import uuid
 
 import click
+import pkg_resources
 
 from watchbot_progress import Part, create_job
-from watchbot_progress.backends.redis import RedisProgress
 from watchbot_progress.backends.dynamodb import DynamoProgress
+from watchbot_progress.backends.memory import MemoryProgress
+from watchbot_progress.backends.redis import RedisProgress
+from watchbot_progress.backends.shared import SharedMemoryProgress
+from watchbot_progress.backends.sqlite import SqliteProgress
+
+TOPIC = 'arn:aws:sns:us-east-1:123456789012:benchmark'
+TABLE = 'benchmark-progress'
+
+
+class FakeSNS(object):
+    """In-process stand-in for the SNS client, counting published messages"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def _request(self, messages):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            self.messages += messages
+
+    def publish(self, **kwargs):
+        self._request(1)
+        return {'MessageId': str(uuid.uuid4())}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self._request(len(PublishBatchRequestEntries))
+        return {
+            'Successful': [{'Id': entry['Id'], 'MessageId': entry['Id']}
+                           for entry in PublishBatchRequestEntries],
+            'Failed': []}
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    return ordered[max(int(math.ceil(p / 100 * len(ordered))) - 1, 0)]
+
+
+def ignore_reduce(message, topic, subject=None):
+    """on_reduce callback for worker processes, which have no fake SNS"""
+
+
+def create_table(name):
+    """A table like the one from scripts/create.py"""
+    import boto3
+    boto3.resource('dynamodb').create_table(
+        TableName=name,
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'id', 'AttributeType': 'S'},
+            {'AttributeName': 'active', 'AttributeType': 'N'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'active-jobs',
+            'KeySchema': [
+                {'AttributeName': 'active', 'KeyType': 'HASH'},
+                {'AttributeName': 'id', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'KEYS_ONLY'},
+            'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+
+@contextmanager
+def fake_dynamodb():
+    """moto's fake DynamoDB"""
+    try:
+        import moto
+    except ImportError:
+        raise click.UsageError('the dynamodb backend needs moto, pip install moto')
+    mock_aws = (getattr(moto, 'mock_aws', None) or getattr(moto, 'mock_dynamodb', None) or
+                getattr(moto, 'mock_dynamodb2'))
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        yield
+
+
+def local_progress(backend, tmpdir):
+    """Progress object for the backends kept in local files"""
+    if backend == 'sqlite':
+        return SqliteProgress(os.path.join(tmpdir, 'progress.db'), topic_arn=TOPIC)
+    return SharedMemoryProgress(os.path.join(tmpdir, 'jobs'), topic_arn=TOPIC)
+
+
+class Harness(object):
+    """Builds progress objects for the selected backend
+
+    Every progress object starts from an empty backend, so that jobs left
+    by one benchmark are not counted by the next.
+    """
+
+    def __init__(self, backend, redis_url=None, bitmap=False, shards=None):
+        self.backend = backend
+        self.redis_url = redis_url
+        self.bitmap = bitmap
+        self.shards = shards
+        self.tmpdir = None
+        self.location = None
+        self._redis = None
+        self._fresh = 0
+
+    @property
+    def fake_redis(self):
+        return self.backend == 'redis' and not self.redis_url
+
+    @property
+    def shared(self):
+        """Can worker processes reach the backend?"""
+        return self.backend in ('sqlite', 'shared') or bool(self.redis_url)
+
+    @contextmanager
+    def running(self, sns):
+        """Install the local stand-ins"""
+        with ExitStack() as stack:
+            session = stack.enter_context(mock.patch('watchbot_progress.utils.boto3_session'))
+            session.return_value.client.return_value = sns
+            if self.fake_redis:
+                from mockredis import mock_strict_redis_client
+                self._redis = mock_strict_redis_client()
+                stack.enter_context(mock.patch('redis.StrictRedis', return_value=self._redis))
+            elif self.backend == 'redis' and self._redis_progress().redis.dbsize():
+                raise click.UsageError(
+                    '--redis-url must be an empty database, the benchmark deletes its jobs')
+            if self.backend == 'dynamodb':
+                stack.enter_context(fake_dynamodb())
+            if self.backend in ('sqlite', 'shared'):
+                self.tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+            yield
+
+    def _redis_progress(self):
+        if self.redis_url:
+            return RedisProgress.from_url(self.redis_url, topic_arn=TOPIC, bitmap=self.bitmap)
+        # mockredis cannot run Lua
+        return RedisProgress(topic_arn=TOPIC, bitmap=self.bitmap, scripts=False)
 
+    def progress(self):
+        """Progress object on an empty backend"""
+        self._fresh += 1
+        if self.backend == 'redis':
+            progress = self._redis_progress()
+            if self.fake_redis:
+                self._redis.flushdb()
+            else:
+                # the database was empty at the start, these are our own jobs
+                for jobid in list(progress.list_jobs(status=False)):
+                    progress.delete(jobid)
+            return progress
+        if self.backend == 'memory':
+            return MemoryProgress(topic_arn=TOPIC)
+        if self.backend in ('sqlite', 'shared'):
+            self.location = tempfile.mkdtemp(dir=self.tmpdir)
+            return local_progress(self.backend, self.location)
+        table = '{}-{}'.format(TABLE, self._fresh)
+        create_table(table)
+        return DynamoProgress(table_arn=table, topic_arn=TOPIC, shards=self.shards)
 
-def annotate_parts(parts, jobid):
-    return [
-        dict(**part, partid=partid, jobid=jobid)
-        for partid, part in enumerate(parts)]
+    def backend_bytes(self, progress, jobid):
+        """Server side memory used by a job's parts, where it can be measured"""
+        if self.backend == 'redis' and not self.fake_redis:
+            return progress.redis.execute_command('MEMORY', 'USAGE', progress._parts_key(jobid))
+        if self.backend == 'memory':
+            return len(progress._jobs[jobid].pending)
+        if self.backend == 'shared':
+            return os.path.getsize(progress._filename(jobid, '.job'))
+        return None
+
+
+def bench_create_job(harness, sns, parts, workers):
+    """create_job fan-out, map messages published per second"""
+    progress = harness.progress()
+    before = (sns.messages, sns.requests)
+    start = time.perf_counter()
+    create_job(({'n': i} for i in range(parts)), progress=progress, workers=workers, total=parts)
+    elapsed = time.perf_counter() - start
+    return {
+        'parts': parts,
+        'workers': workers,
+        'seconds': elapsed,
+        'messages_per_second': parts / elapsed,
+        'messages': sns.messages - before[0],
+        'sns_requests': sns.requests - before[1]}
+
+
+def bench_latency(harness, parts):
+    """Latency of a single Part block, completed one at a time"""
+    progress = harness.progress()
+    jobid = str(uuid.uuid4())
+    progress.set_total(jobid, range(parts))
+    durations = []
+    for partid in range(parts):
+        start = time.perf_counter()
+        with Part(jobid, partid, progress=progress):
+            pass
+        durations.append(time.perf_counter() - start)
+    return {
+        'parts': parts,
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+        'max_ms': max(durations) * 1000,
+        'mean_ms': sum(durations) / len(durations) * 1000}
+
+
+def bench_threads(harness, parts, threads):
+    """Part completions per second, from a number of threads"""
+    progress = harness.progress()
+    jobid = str(uuid.uuid4())
+    progress.set_total(jobid, range(parts))
+
+    def complete(partid):
+        with Part(jobid, partid, progress=progress):
+            pass
+
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(complete, range(parts)))
+    elapsed = time.perf_counter() - start
+    return {
+        'threads': threads,
+        'parts': parts,
+        'seconds': elapsed,
+        'completions_per_second': parts / elapsed}
+
+
+def _complete_in_process(args):
+    """Worker process, completing a slice of a job's parts"""
+    backend, location, bitmap, jobid, partids = args
+    if backend in ('sqlite', 'shared'):
+        progress = local_progress(backend, location)
+    else:
+        progress = RedisProgress.from_url(location, topic_arn=TOPIC, bitmap=bitmap)
+    for partid in partids:
+        with Part(jobid, partid, progress=progress, on_reduce=ignore_reduce):
+            pass
+
+
+def bench_processes(harness, parts, processes):
+    """Part completions per second, from a number of processes"""
+    progress = harness.progress()
+    jobid = str(uuid.uuid4())
+    progress.set_total(jobid, range(parts))
+    location = harness.redis_url if harness.backend == 'redis' else harness.location
+    slices = [(harness.backend, location, harness.bitmap, jobid, list(range(i, parts, processes)))
+              for i in range(processes)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        start = time.perf_counter()
+        pool.map(_complete_in_process, slices)
+        elapsed = time.perf_counter() - start
+    finally:
+        pool.close()
+        pool.join()
+    return {
+        'processes': processes,
+        'parts': parts,
+        'seconds': elapsed,
+        'completions_per_second': parts / elapsed}
+
+
+def bench_list_jobs(harness, jobs, parts):
+    """Time to list all jobs with their status, for a number of jobs"""
+    progress = harness.progress()
+    for _ in range(jobs):
+        progress.set_total(str(uuid.uuid4()), range(parts))
+
+    start = time.perf_counter()
+    listed = sum(1 for _ in progress.list_jobs())
+    elapsed = time.perf_counter() - start
+    return {'jobs': jobs, 'listed': listed, 'seconds': elapsed}
+
+
+def bench_memory(harness, parts):
+    """Peak Python memory while creating a job, against part count
+
+    The peak includes in-process fakes of the backend.
+    """
+    progress = harness.progress()
+    tracemalloc.start()
+    try:
+        jobid = create_job(({'n': i} for i in range(parts)), progress=progress, total=parts)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'parts': parts,
+        'peak_bytes': peak,
+        'backend_bytes': harness.backend_bytes(progress, jobid)}
+
+
+def ints(value):
+    return [int(v) for v in value.split(',') if v]
 
 
 @click.command()
-@click.option('--backend', '-b', type=click.Choice(['redis', 'dynamodb']),
+@click.option('--backend', '-b', type=click.Choice(['redis', 'dynamodb', 'memory', 'sqlite', 'shared']),
               help="backend database", required=True)
-@click.option('--number', '-n', default=100,
-              help="number of parts")
-def main(backend, number):
-    if backend == 'redis':
-        progress = RedisProgress(host='localhost', port='6379')
-    elif backend == 'dynamodb':
-        progress = DynamoProgress()
-
-    parts = [dict() for _ in range(number)]
-    workers = 25
-
-    # Simulates Subject:start messages
-    jobid = create_job(parts, progress=progress, workers=workers)
-
-    # Simulates concurrent Subject:map messages
-    # The annonate_parts function recreates the messages that would be recieved
-    msgs = annotate_parts(parts, jobid)
-
-    def doit(msg, jobid=jobid, progress=progress):
-        partid = msg['partid']
-        with Part(partid=partid, jobid=jobid, progress=progress):
-            pass
+@click.option('--redis-url', default=None,
+              help="local redis server e.g. redis://localhost:6379/0, otherwise mockredis")
+@click.option('--bitmap', is_flag=True, help="redis bitmap encoding")
+@click.option('--shards', type=int, default=None, help="dynamodb shards")
+@click.option('--parts', '-n', default=1000, help="parts per job")
+@click.option('--workers', default=25, help="create_job publishing threads")
+@click.option('--sns-latency', default=0.0, help="simulated seconds per SNS request")
+@click.option('--threads', default='1,4,16', help="thread counts, comma separated")
+@click.option('--processes', default='1,2,4',
+              help="process counts, comma separated. Needs --redis-url with redis")
+@click.option('--jobs', default='10,100,1000', help="job counts for list_jobs, comma separated")
+@click.option('--memory-parts', default='1000,10000,100000',
+              help="part counts for memory use, comma separated")
+@click.option('--output', '-o', default='benchmark.json', help="JSON results file")
+def main(backend, redis_url, bitmap, shards, parts, workers, sns_latency,
+         threads, processes, jobs, memory_parts, output):
+    harness = Harness(backend, redis_url=redis_url, bitmap=bitmap, shards=shards)
+    sns = FakeSNS(latency=sns_latency)
+    results = {}
+
+    with harness.running(sns):
+        click.echo('create_job fan-out')
+        results['create_job'] = bench_create_job(harness, sns, parts, workers)
+
+        click.echo('Part latency')
+        results['latency'] = bench_latency(harness, parts)
+
+        click.echo('completions/sec by threads')
+        results['threads'] = [bench_threads(harness, parts, n) for n in ints(threads)]
+
+        if harness.shared:
+            click.echo('completions/sec by processes')
+            results['processes'] = [bench_processes(harness, parts, n) for n in ints(processes)]
+        else:
+            click.echo('skipping processes, in-process fakes cannot be shared')
+
+        click.echo('list_jobs by job count')
+        results['list_jobs'] = [bench_list_jobs(harness, n, 10) for n in ints(jobs)]
+
+        click.echo('memory by part count')
+        results['memory'] = [bench_memory(harness, n) for n in ints(memory_parts)]
 
-    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        executor.map(doit, msgs)
+    report = {
+        'version': pkg_resources.get_distribution('watchbot-progress').version,
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'config': {
+            'backend': backend,
+            'redis': 'redis-server' if redis_url else 'mockredis',
+            'bitmap': bitmap,
+            'shards': shards,
+            'parts': parts,
+            'workers': workers,
+            'sns_latency': sns_latency},
+        'results': results}
 
-    print(f"completed watchbot progress for {number} parts using {progress}")
+    with open(output, 'w') as dst:
+        json.dump(report, dst, indent=2)
+    click.echo(json.dumps(results, indent=2))
+    click.echo('results written to {}'.format(output))
 
 
 if __name__ == "__main__":
@@ -20,7 +20,34 @@ table = dynamodb.create_table(
             'AttributeName': 'id',
             'AttributeType': 'S'
         },
-
+        {
+            'AttributeName': 'active',
+            'AttributeType': 'N'
+        },
+    ],
+    # Sparse index of the jobs with remaining parts,
+    # see DynamoProgress.list_jobs(active_only=True)
+    GlobalSecondaryIndexes=[
+        {
+            'IndexName': 'active-jobs',
+            'KeySchema': [
+                {
+                    'AttributeName': 'active',
+                    'KeyType': 'HASH'
+                },
+                {
+                    'AttributeName': 'id',
+                    'KeyType': 'RANGE'
+                }
+            ],
+            'Projection': {
+                'ProjectionType': 'KEYS_ONLY'
+            },
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': 5,
+                'WriteCapacityUnits': 5
+            }
+        }
     ],
     ProvisionedThroughput={
         'ReadCapacityUnits': 5,
@@ -18,6 +18,7 @@ setup(
       watchbot-progress-py=watchbot_progress.cli:main
       """,
     extras_require={
-        'test': ['pytest', 'pytest-cov', 'mock', 'click', 'mockredispy', 'tox', 'coveralls']},
+        'test': ['pytest', 'pytest-cov', 'mock', 'click', 'mockredispy', 'tox', 'coveralls'],
+        'cluster': ['redis-py-cluster~=1.3']},
     include_package_data=True,
     zip_safe=False)
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+import redis
+
+from watchbot_progress.main import failed_jobs
+
+
+@pytest.fixture(autouse=True)
+def clear_failed_jobs():
+    """Job failure checks are cached process-wide by Part"""
+    failed_jobs.clear()
+
+
+@pytest.fixture()
+def redis_url():
+    """URL of a real, emptied redis database, for tests which run Lua scripts
+
+    Set REDIS_URL to use another server than localhost, the tests are
+    skipped if there is none.
+    """
+    url = os.environ.get('REDIS_URL', 'redis://localhost:6379/15')
+    client = redis.StrictRedis.from_url(url)
+    try:
+        client.flushdb()
+    except redis.ConnectionError:
+        pytest.skip('no redis server at {}'.format(url))
+    yield url
+    client.flushdb()
@@ -16,30 +16,84 @@ parts = (
 
 @patch('watchbot_progress.cli.RedisProgress')
 def test_ls(Progress, monkeypatch):
-    Progress.return_value.list_jobs.return_value = ['job1', 'job2']
+    Progress.from_url.return_value.list_jobs.return_value = ['job1', 'job2']
 
     runner = CliRunner()
     result = runner.invoke(cli.ls, '--jobid --database redis://localhost:6379?db=0'.split(' '))
 
     assert result.exit_code == 0
     assert result.output == 'job1\njob2\n'
+    Progress.from_url.return_value.list_jobs.assert_called_once_with(status=False, active_only=False)
+
+
+@patch('watchbot_progress.cli.RedisProgress')
+def test_ls_hide_completed(Progress, monkeypatch):
+    Progress.from_url.return_value.list_jobs.return_value = ['job2']
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.ls, '--jobid --hide-completed --database redis://localhost:6379?db=0'.split(' '))
+
+    assert result.exit_code == 0
+    assert result.output == 'job2\n'
+    Progress.from_url.return_value.list_jobs.assert_called_once_with(status=False, active_only=True)
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_ls_rebuild_registry(monkeypatch):
+    progress = cli.RedisProgress(topic_arn='nope', registry=False)
+    for jobid in ('job1', 'job2'):
+        progress.set_total(jobid, parts)
+    progress.registry = True
+    progress.set_total('job3', parts)
+
+    monkeypatch.setattr(cli.RedisProgress, 'from_url', lambda *args, **kwargs: progress)
+    runner = CliRunner()
+    args = '--jobid --database redis://localhost:6379?db=0'.split(' ')
+    assert runner.invoke(cli.ls, args).output == 'job3\n'
+
+    result = runner.invoke(cli.ls, args + ['--rebuild-registry'])
+    assert result.exit_code == 0
+    assert sorted(result.output.split()) == ['job1', 'job2', 'job3']
+
+
+@patch('watchbot_progress.cli.DynamoProgress')
+def test_ls_rebuild_registry_dynamodb(Progress, monkeypatch):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.ls, '--rebuild-registry --database arn:aws:dynamodb:us-east-1:1:table/foo'.split(' '))
+    assert result.exit_code == 2
+    Progress.return_value.list_jobs.assert_not_called()
 
 
 @patch('watchbot_progress.cli.RedisProgress')
 def test_info(Progress, monkeypatch):
-    Progress.return_value.status.return_value = {'fake': True}
+    Progress.from_url.return_value.status.return_value = {'fake': True}
 
     runner = CliRunner()
     result = runner.invoke(cli.info, 'job1 --database redis://localhost:6379?db=0'.split(' '))
 
-    Progress.assert_called()
+    Progress.from_url.assert_called()
     assert result.exit_code == 0
     assert result.output == '{"fake": true}\n'
 
 
+@patch('watchbot_progress.cli.RedisProgress')
+def test_info_many(Progress, monkeypatch):
+    Progress.from_url.return_value.status_many.return_value = [{'jobid': 'job1'}, {'jobid': 'job2'}]
+
+    runner = CliRunner()
+    result = runner.invoke(cli.info, 'job1 job2 --database redis://localhost:6379?db=0'.split(' '))
+
+    assert result.exit_code == 0
+    assert result.output == '{"jobid": "job1"}\n{"jobid": "job2"}\n'
+    Progress.from_url.return_value.status_many.assert_called_once_with(('job1', 'job2'))
+    Progress.from_url.return_value.status.assert_not_called()
+
+
 @patch('watchbot_progress.cli.RedisProgress')
 def test_pending(Progress, monkeypatch):
-    Progress.return_value.list_pending_parts.return_value = [2, 0, 1]
+    Progress.from_url.return_value.list_pending_parts.return_value = [2, 0, 1]
 
     runner = CliRunner()
     result = runner.invoke(cli.pending, 'job1 --database redis://localhost:6379?db=0'.split(' '))
@@ -50,7 +104,7 @@ def test_pending(Progress, monkeypatch):
 
 @patch('watchbot_progress.cli.RedisProgress')
 def test_pending_array(Progress, monkeypatch):
-    Progress.return_value.list_pending_parts.return_value = [2, 0, 1]
+    Progress.from_url.return_value.list_pending_parts.return_value = [2, 0, 1]
 
     runner = CliRunner()
     result = runner.invoke(
@@ -60,12 +114,58 @@ def test_pending_array(Progress, monkeypatch):
     assert result.output == '[2, 0, 1]\n'
 
 
+@patch('watchbot_progress.cli.time')
+@patch('watchbot_progress.cli.RedisProgress')
+def test_watch(Progress, time, monkeypatch):
+    Progress.from_url.return_value.status_many.return_value = [
+        {'jobid': 'job1', 'total': 100, 'remaining': 100},
+        {'jobid': 'job2', 'total': 10, 'remaining': 0}]
+    Progress.from_url.return_value.remaining.side_effect = [100, 100, 50, 0]
+    time.time.side_effect = [0, 5, 15, 35, 40]
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.watch, 'job1 job2 --interval 5 --stall 10 --database redis://localhost:6379'.split(' '))
+
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert lines[0] == 'job1: 0/100 parts (0.0%), 0.00 parts/s, ETA unknown'
+    assert lines[1] == 'job2: complete, 10 parts'
+    assert lines[4] == 'job1: 0/100 parts (0.0%), 0.00 parts/s, ETA unknown, stalled for 0:00:15'
+    assert lines[6] == 'job1: 50/100 parts (50.0%), 1.43 parts/s, ETA 0:00:35'
+    assert lines[8] == 'job1: complete, 100 parts'
+    # only the remaining count of the unfinished job is polled
+    assert [c[0] for c in Progress.from_url.return_value.remaining.call_args_list] == [('job1',)] * 4
+    Progress.from_url.return_value.status.assert_not_called()
+    # backs off while the job is not progressing
+    assert [c[0][0] for c in time.sleep.call_args_list] == [5, 10, 20, 5]
+
+
+@patch('watchbot_progress.cli.RedisProgress')
+def test_watch_missing(Progress, monkeypatch):
+    Progress.from_url.return_value.status_many.return_value = []
+
+    runner = CliRunner()
+    result = runner.invoke(cli.watch, 'job1 --database redis://localhost:6379'.split(' '))
+
+    assert result.exit_code == 1
+    assert 'no such jobs: job1' in result.output
+
+
 def test_validate_redis():
     from watchbot_progress.backends.redis import RedisProgress
     p = cli.validate_db(None, None, 'redis://localhost:6379')
     assert isinstance(p, RedisProgress)
 
 
+def test_validate_redis_url():
+    p = cli.validate_db(None, None, 'rediss://:secret@localhost:6380?db=2')
+    assert p.redis.connection_pool.connection_kwargs == {
+        'host': 'localhost', 'port': 6380, 'db': 2, 'password': 'secret'}
+    assert cli.validate_db(None, None, 'rediss://:secret@localhost:6380?db=2').redis.connection_pool \
+        is p.redis.connection_pool
+
+
 def test_validate_dynamo():
     from watchbot_progress.backends.dynamodb import DynamoProgress
     p = cli.validate_db(None, None, 'arn:whatevs')
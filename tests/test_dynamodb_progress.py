@@ -1,5 +1,7 @@
-from mock import patch
+import threading
 
+from botocore.exceptions import ClientError
+from mock import Mock, patch
 import pytest
 
 from watchbot_progress.backends.dynamodb import DynamoProgress as WatchbotProgress
@@ -12,6 +14,10 @@ parts = [
     {'source': 'c.tif'}]
 
 
+def check_failed():
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+
+
 @patch('watchbot_progress.backends.dynamodb.boto3.resource')
 def test_status(client, monkeypatch):
     monkeypatch.setenv('WorkTopic', 'abc123')
@@ -49,6 +55,21 @@ def test_status_progress(client, mock_item, expected, monkeypatch):
     assert s['progress'] == expected
 
 
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_status_remaining(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.get_item.return_value = {'Item': {'total': 4, 'remaining': 1}}
+    s = WatchbotProgress().status('123')
+    assert s['progress'] == 0.75
+    assert s['remaining'] == 1
+    assert s['total'] == 4
+    assert table.get_item.call_count == 1
+    assert 'parts' not in table.get_item.call_args[1]['ExpressionAttributeNames'].values()
+
+
 @patch('watchbot_progress.backends.dynamodb.boto3.resource')
 def test_set_total(client, monkeypatch):
     monkeypatch.setenv('WorkTopic', 'abc123')
@@ -56,6 +77,30 @@ def test_set_total(client, monkeypatch):
     client.return_value.Table.return_value.update_item.return_value = None
 
     WatchbotProgress().set_total('123', parts)
+    kwargs = client.return_value.Table.return_value.update_item.call_args[1]
+    assert kwargs['ExpressionAttributeValues'] == {':p': set([0, 1, 2]), ':t': 3, ':a': 1}
+    assert '#r = :t' in kwargs['UpdateExpression']
+    assert kwargs['ExpressionAttributeNames']['#a'] == 'active'
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_set_total_count_in_chunks(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    monkeypatch.setattr('watchbot_progress.backends.dynamodb.SET_TOTAL_CHUNK', 4)
+    table = client.return_value.Table.return_value
+    callback = Mock()
+
+    WatchbotProgress().set_total('123', 10, callback=callback)
+
+    calls = [c[1] for c in table.update_item.call_args_list]
+    assert calls[0]['ExpressionAttributeValues'] == {':p': set([0, 1, 2, 3]), ':t': 10, ':a': 1}
+    assert [c['UpdateExpression'] for c in calls[1:]] == ['add #p :p', 'add #p :p']
+    assert calls[2]['ExpressionAttributeValues'] == {':p': set([8, 9])}
+    assert [c[0] for c in callback.call_args_list] == [(4, 10), (8, 10), (10, 10)]
+
+    WatchbotProgress().set_total('empty', 0)
+    assert 'remove #p' in table.update_item.call_args[1]['UpdateExpression']
 
 
 @patch('watchbot_progress.backends.dynamodb.boto3.resource')
@@ -72,10 +117,19 @@ def test_complete_part(client, monkeypatch):
     monkeypatch.setenv('WorkTopic', 'abc123')
     monkeypatch.setenv('ProgressTable', 'arn::table/foo')
 
-    item = {'Attributes': {'parts': [], 'total': 4}}
-    client.return_value.Table.return_value.update_item.return_value = item
+    # parts remain after this one fails, so it was the last part
+    client.return_value.Table.return_value.update_item.side_effect = [check_failed(), {}, {}]
     s = WatchbotProgress().complete_part('123', 1)
     assert s is True
+    calls = client.return_value.Table.return_value.update_item.call_args_list
+    assert calls[0][1]['ConditionExpression'] == 'contains(#p, :id0) and #r > :c'
+    assert calls[1][1]['ConditionExpression'] == 'contains(#p, :id0) and #r = :c'
+    assert calls[1][1]['ExpressionAttributeValues'] == {
+        ':id0': 1, ':p': set([1]), ':n': -1, ':c': 1}
+    # the parts set is modified, so nothing is returned rather than all of it
+    assert calls[1][1]['ReturnValues'] == 'NONE'
+    # the last part drops the job from the active jobs index
+    assert calls[2][1]['UpdateExpression'] == 'remove #a'
 
 
 @patch('watchbot_progress.backends.dynamodb.boto3.resource')
@@ -83,10 +137,64 @@ def test_incomplete_part(client, monkeypatch):
     monkeypatch.setenv('WorkTopic', 'abc123')
     monkeypatch.setenv('ProgressTable', 'arn::table/foo')
 
-    item = {'Attributes': {'parts': [1, 2], 'total': 4}}
-    client.return_value.Table.return_value.update_item.return_value = item
+    client.return_value.Table.return_value.update_item.return_value = {}
     s = WatchbotProgress().complete_part('123', 1)
     assert s is False
+    client.return_value.Table.return_value.update_item.assert_called_once()
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_part_already_complete(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.update_item.side_effect = check_failed()
+    table.get_item.return_value = {'Item': {'remaining': 0}}
+    assert WatchbotProgress().complete_part('123', 1) is True
+    assert table.update_item.call_count == 2
+
+    table.get_item.return_value = {'Item': {'remaining': 2}}
+    assert WatchbotProgress().complete_part('123', 1) is False
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_part_legacy(client, monkeypatch):
+    """Jobs created without a remaining count fall back to the parts set
+    """
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.update_item.side_effect = [
+        check_failed(), check_failed(),
+        {'Attributes': {'parts': set([2]), 'total': 4}}]
+    table.get_item.return_value = {'Item': {}}
+    assert WatchbotProgress().complete_part('123', 1) is False
+    assert table.update_item.call_args[1]['ReturnValues'] == 'ALL_NEW'
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_part_sharded_job_without_shards(client, monkeypatch):
+    """A client without shards must not report a sharded job as complete
+    """
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+    error = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+
+    table.update_item.side_effect = error
+    table.get_item.return_value = {'Item': {'shards': 2, 'shardsDone': 0}}
+    with pytest.raises(ValueError):
+        WatchbotProgress().complete_part('123', 1)
+    with pytest.raises(ValueError):
+        WatchbotProgress().complete_parts('123', [1, 2])
+
+    # sharded between the read and the legacy update
+    table.get_item.return_value = {'Item': {}}
+    with pytest.raises(ValueError):
+        WatchbotProgress().complete_part('123', 1)
+    assert table.update_item.call_args[1]['ConditionExpression'] == 'attribute_not_exists(#s)'
 
 
 @patch('watchbot_progress.backends.dynamodb.boto3.resource')
@@ -132,3 +240,480 @@ def test_set_list_pending(client, monkeypatch):
     client.return_value.Table.return_value.get_item.return_value = {}
     with pytest.raises(JobDoesNotExist):
         parts = list(WatchbotProgress().list_pending_parts('123'))
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_set_total_sharded(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+    batch = table.batch_writer.return_value.__enter__.return_value
+
+    WatchbotProgress(shards=4).set_total('123', parts)
+
+    items = [c[1]['Item'] for c in batch.put_item.call_args_list]
+    assert [i['id'] for i in items] == ['123#shard-0', '123#shard-1', '123#shard-2', '123#shard-3']
+    assert items[0]['parts'] == set([0])
+    assert items[2]['remaining'] == 1
+    assert 'parts' not in items[3]
+    assert items[3]['remaining'] == 0
+
+    values = table.update_item.call_args[1]['ExpressionAttributeValues']
+    assert values == {':t': 3, ':s': 4, ':d': 1, ':a': 1}
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_part_sharded(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.update_item.side_effect = [{}]
+    assert WatchbotProgress(shards=2).complete_part('123', 3) is False
+    assert table.update_item.call_args[1]['Key'] == {'id': '123#shard-1'}
+
+    # shard finished but another one is not
+    table.update_item.side_effect = [
+        check_failed(), {},
+        {'Attributes': {'shards': 2, 'shardsDone': 1}}]
+    assert WatchbotProgress(shards=2).complete_part('123', 3) is False
+    assert table.update_item.call_args[1]['Key'] == {'id': '123'}
+
+    # last shard finished
+    table.update_item.side_effect = [
+        check_failed(), {},
+        {'Attributes': {'shards': 2, 'shardsDone': 2}},
+        {}]
+    assert WatchbotProgress(shards=2).complete_part('123', 2) is True
+    assert table.update_item.call_args[1]['UpdateExpression'] == 'remove #a'
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_part_sharded_already_complete(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    error = ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+    table.update_item.side_effect = error
+    table.get_item.return_value = {'Item': {'shards': 2, 'shardsDone': 1}}
+    assert WatchbotProgress(shards=2).complete_part('123', 3) is False
+
+    table.get_item.return_value = {'Item': {'shards': 2, 'shardsDone': 2}}
+    assert WatchbotProgress(shards=2).complete_part('123', 3) is True
+
+    table.update_item.side_effect = ClientError(
+        {'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'UpdateItem')
+    with pytest.raises(ClientError):
+        WatchbotProgress(shards=2).complete_part('123', 3)
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_status_sharded(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.get_item.return_value = {'Item': {'id': '123', 'total': 4, 'shards': 2}}
+    client.return_value.batch_get_item.return_value = {
+        'Responses': {'foo': [{'remaining': 1}, {'remaining': 0}]}}
+
+    s = WatchbotProgress(shards=2).status('123')
+    assert s['progress'] == 0.75
+    keys = client.return_value.batch_get_item.call_args[1]['RequestItems']['foo']['Keys']
+    assert keys == [{'id': '123#shard-0'}, {'id': '123#shard-1'}]
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_list_pending_sharded(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.get_item.return_value = {'Item': {'id': '123', 'total': 4, 'shards': 2}}
+    client.return_value.batch_get_item.side_effect = [
+        {'Responses': {'foo': [{'parts': set([2])}]},
+         'UnprocessedKeys': {'foo': {'Keys': [{'id': '123#shard-1'}]}}},
+        {'Responses': {'foo': [{'parts': set([1, 3])}]}}]
+
+    assert WatchbotProgress(shards=2).list_pending_parts('123') == [1, 2, 3]
+    assert client.return_value.batch_get_item.call_count == 2
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_list_jobs_skips_shards(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+
+    items = [{'id': '123'}]
+    table = client.return_value.Table.return_value
+    table.scan.return_value = {'Items': items}
+
+    assert list(WatchbotProgress(shards=1).list_jobs(status=False)) == ['123']
+    kwargs = table.scan.call_args[1]
+    assert kwargs['FilterExpression'] == 'attribute_not_exists(#shard)'
+    assert kwargs['ExpressionAttributeNames']['#shard'] == 'shardOf'
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_claim_reduce(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.update_item.return_value = {
+        'Attributes': {'reduceSent': True, 'metadata': {'foo': 'bar'}}}
+    assert WatchbotProgress().claim_reduce('123') == {'foo': 'bar'}
+    kwargs = table.update_item.call_args[1]
+    assert 'attribute_not_exists(#s)' in kwargs['ConditionExpression']
+    assert kwargs['ReturnValues'] == 'UPDATED_NEW'
+
+    table.update_item.side_effect = ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+    assert WatchbotProgress().claim_reduce('123') is None
+
+    table.update_item.side_effect = ClientError(
+        {'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'UpdateItem')
+    with pytest.raises(ClientError):
+        WatchbotProgress().claim_reduce('123')
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_part_and_claim_reduce(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.update_item.side_effect = [
+        check_failed(), {},
+        {},
+        {'Attributes': {'reduceSent': True, 'metadata': {}}}]
+    assert WatchbotProgress().complete_part_and_claim_reduce('123', 1) == (True, {})
+    table.get_item.assert_not_called()
+
+    table.update_item.side_effect = [{}]
+    assert WatchbotProgress().complete_part_and_claim_reduce('123', 1) == (False, None)
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_release_reduce(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    WatchbotProgress().release_reduce('123')
+    assert table.update_item.call_args[1]['UpdateExpression'] == 'remove #s'
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_parts(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.update_item.return_value = {}
+    table.get_item.return_value = {'Item': {'remaining': 1}}
+    res = WatchbotProgress().complete_parts('123', [2, 0, 2, 3])
+    assert res == {'remaining': 1, 'complete': False}
+
+    table.update_item.assert_called_once()
+    kwargs = table.update_item.call_args[1]
+    values = kwargs['ExpressionAttributeValues']
+    assert values[':p'] == set([0, 2, 3])
+    assert values[':n'] == -3
+    assert values[':c'] == 3
+    assert kwargs['ConditionExpression'].count('contains') == 3
+    assert kwargs['ConditionExpression'].endswith(' and #r > :c')
+    assert kwargs['ReturnValues'] == 'NONE'
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_parts_some_already_complete(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.update_item.side_effect = [
+        check_failed(), check_failed(),  # all three
+        {},  # part 0
+        check_failed(), check_failed(),  # part 1 was already complete
+        check_failed(), {},  # part 2 was the last one
+        {}]
+    res = WatchbotProgress().complete_parts('123', [0, 1, 2])
+    assert res == {'remaining': 0, 'complete': True}
+    assert table.update_item.call_count == 8
+    table.get_item.assert_not_called()
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_parts_sharded(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.get_item.return_value = {'Item': {'shards': 2}}
+    table.update_item.side_effect = [
+        check_failed(), {},
+        {},
+        {'Attributes': {'shards': 2, 'shardsDone': 1}}]
+    client.return_value.batch_get_item.return_value = {
+        'Responses': {'foo': [{'remaining': 0}, {'remaining': 2}]}}
+
+    res = WatchbotProgress(shards=2).complete_parts('123', [0, 1, 2])
+    assert res == {'remaining': 2, 'complete': False}
+
+    calls = table.update_item.call_args_list
+    assert calls[0][1]['Key'] == {'id': '123#shard-0'}
+    assert calls[0][1]['ExpressionAttributeValues'][':p'] == set([0, 2])
+    assert calls[1][1]['Key'] == {'id': '123#shard-0'}
+    assert calls[2][1]['Key'] == {'id': '123#shard-1'}
+    assert calls[3][1]['Key'] == {'id': '123'}
+    assert calls[3][1]['ExpressionAttributeValues'] == {':n': 1}
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_part_shards_of_job(client, monkeypatch):
+    """Parts are routed by the job's shard count, not the client's"""
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    # unsharded job
+    table.update_item.side_effect = [check_failed(), check_failed(), {}]
+    table.get_item.return_value = {'Item': {'remaining': 3}}
+    assert WatchbotProgress(shards=4).complete_part('123', 1) is False
+    keys = [c[1]['Key'] for c in table.update_item.call_args_list]
+    assert keys == [{'id': '123#shard-1'}, {'id': '123#shard-1'}, {'id': '123'}]
+
+    # fewer shards than the client's, part 3 lives on shard 1
+    table.reset_mock()
+    table.update_item.side_effect = [
+        check_failed(), check_failed(),
+        check_failed(), {},
+        {'Attributes': {'shards': 2, 'shardsDone': 2}},
+        {}]
+    table.get_item.return_value = {'Item': {'shards': 2, 'shardsDone': 1}}
+    assert WatchbotProgress(shards=4).complete_part('123', 3) is True
+    keys = [c[1]['Key'] for c in table.update_item.call_args_list]
+    assert keys[:4] == [{'id': '123#shard-3'}] * 2 + [{'id': '123#shard-1'}] * 2
+
+    # more shards than the client's, the job is not done with two
+    table.reset_mock()
+    table.update_item.side_effect = [
+        check_failed(), {},
+        {'Attributes': {'shards': 4, 'shardsDone': 2}}]
+    assert WatchbotProgress(shards=2).complete_part('123', 4) is False
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_complete_parts_shards_of_job(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    # unsharded job
+    table.update_item.side_effect = [{}]
+    table.get_item.return_value = {'Item': {'remaining': 1}}
+    res = WatchbotProgress(shards=4).complete_parts('123', [0, 1])
+    assert res == {'remaining': 1, 'complete': False}
+    assert table.update_item.call_args[1]['Key'] == {'id': '123'}
+
+    # fewer shards than the client's
+    table.reset_mock()
+    table.update_item.side_effect = [{}, {}]
+    table.get_item.return_value = {'Item': {'shards': 2}}
+    client.return_value.batch_get_item.return_value = {
+        'Responses': {'foo': [{'remaining': 1}, {'remaining': 1}]}}
+    res = WatchbotProgress(shards=4).complete_parts('123', [0, 1, 2, 3])
+    assert res == {'remaining': 2, 'complete': False}
+    keys = [c[1]['Key'] for c in table.update_item.call_args_list]
+    assert keys == [{'id': '123#shard-0'}, {'id': '123#shard-1'}]
+    request = client.return_value.batch_get_item.call_args[1]['RequestItems']['foo']
+    assert request['Keys'] == [{'id': '123#shard-0'}, {'id': '123#shard-1'}]
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_is_failed(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.get_item.return_value = {'Item': {}}
+    assert WatchbotProgress().is_failed('123') is False
+    assert table.get_item.call_args[1]['ExpressionAttributeNames'] == {'#a0': 'error'}
+
+    table.get_item.return_value = {'Item': {'error': 'nope'}}
+    assert WatchbotProgress().is_failed('123') is True
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_list_jobs_paginated(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.scan.side_effect = [
+        {'Items': [{'id': '1', 'total': 4, 'remaining': 1}], 'LastEvaluatedKey': {'id': '1'}},
+        {'Items': [{'id': '2', 'total': 2, 'remaining': 0, 'error': 'bad'}]}]
+
+    jobs = list(WatchbotProgress().list_jobs())
+    assert [j['jobid'] for j in jobs] == ['1', '2']
+    assert jobs[0]['progress'] == 0.75
+    assert jobs[1]['failed'] == 'bad'
+    table.get_item.assert_not_called()
+
+    assert table.scan.call_args[1]['ExclusiveStartKey'] == {'id': '1'}
+    names = table.scan.call_args[1]['ExpressionAttributeNames'].values()
+    assert 'parts' not in names
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_list_jobs_parallel(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    def scan(**kwargs):
+        return {'Items': [{'id': str(kwargs['Segment'])}]}
+
+    table.scan.side_effect = scan
+
+    jobs = list(WatchbotProgress().list_jobs(status=False, segments=4))
+    assert sorted(jobs) == ['0', '1', '2', '3']
+    assert set(c[1]['TotalSegments'] for c in table.scan.call_args_list) == set([4])
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_list_jobs_parallel_streams(client, monkeypatch):
+    """Pages are yielded as segments scan them, not once every segment is done"""
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+    released = threading.Event()
+    scanned = []
+
+    def scan(**kwargs):
+        segment = kwargs['Segment']
+        if segment == 1:
+            released.wait(2)
+        elif 'ExclusiveStartKey' not in kwargs:
+            return {'Items': [{'id': 'a'}], 'LastEvaluatedKey': {'id': 'a'}}
+        scanned.append(segment)
+        return {'Items': [{'id': 'b' if segment == 0 else 'c'}]}
+
+    table.scan.side_effect = scan
+
+    jobs = WatchbotProgress().list_jobs(status=False, segments=2)
+    assert next(jobs) == 'a'
+    assert 1 not in scanned
+    released.set()
+    assert sorted(jobs) == ['b', 'c']
+    assert sorted(scanned) == [0, 1]
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_list_jobs_active_index(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+    table.global_secondary_indexes = [{'IndexName': 'active-jobs'}]
+
+    table.query.side_effect = [
+        {'Items': [{'id': '1', 'active': 1}, {'id': '2', 'active': 1}],
+         'LastEvaluatedKey': {'id': '2', 'active': 1}},
+        {'Items': [{'id': '3', 'active': 1}]}]
+    client.return_value.batch_get_item.side_effect = [
+        {'Responses': {'foo': [
+            {'id': '2', 'total': 2, 'remaining': 0},
+            {'id': '1', 'total': 4, 'remaining': 1}]}},
+        {'Responses': {'foo': [{'id': '3', 'total': 2, 'remaining': 2}]}}]
+
+    jobs = list(WatchbotProgress().list_jobs(active_only=True))
+    # job 2 finished after the index was read
+    assert [j['jobid'] for j in jobs] == ['1', '3']
+    assert jobs[0]['progress'] == 0.75
+    table.scan.assert_not_called()
+
+    kwargs = table.query.call_args[1]
+    assert kwargs['IndexName'] == 'active-jobs'
+    assert kwargs['ExclusiveStartKey'] == {'id': '2', 'active': 1}
+
+    table.query.side_effect = [{'Items': [{'id': '1', 'active': 1}]}]
+    assert list(WatchbotProgress().list_jobs(status=False, active_only=True)) == ['1']
+    # positional parameters are the same as every other backend's
+    table.query.side_effect = [{'Items': [{'id': '1', 'active': 1}]}]
+    assert list(WatchbotProgress().list_jobs(False, True)) == ['1']
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_list_jobs_active_without_index(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+    table.global_secondary_indexes = None
+
+    table.scan.return_value = {'Items': [
+        {'id': '1', 'total': 4, 'remaining': 1},
+        {'id': '2', 'total': 2, 'remaining': 0}]}
+    assert list(WatchbotProgress().list_jobs(status=False, active_only=True)) == ['1']
+    table.query.assert_not_called()
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_rebuild_active_index(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.scan.return_value = {'Items': [
+        {'id': '1', 'total': 4, 'remaining': 1},
+        {'id': '2', 'total': 2, 'remaining': 0}]}
+    WatchbotProgress().rebuild_active_index()
+    table.update_item.assert_called_once()
+    assert table.update_item.call_args[1]['Key'] == {'id': '1'}
+    assert table.update_item.call_args[1]['UpdateExpression'] == 'set #a = :a'
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_status_many(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    jobids = ['job{:03d}'.format(i) for i in range(150)]
+    client.return_value.batch_get_item.side_effect = [
+        {'Responses': {'foo': [
+            {'id': jobid, 'total': 4, 'remaining': 1} for jobid in jobids[:99]]},
+         'UnprocessedKeys': {'foo': {'Keys': [{'id': jobids[99]}]}}},
+        {'Responses': {'foo': [{'id': jobids[99], 'total': 4, 'remaining': 1}]}},
+        {'Responses': {'foo': [
+            {'id': jobid, 'total': 4, 'remaining': 1} for jobid in jobids[100:149]] + [
+            {'id': jobids[149], 'total': 4, 'shards': 2}]}},
+        {'Responses': {'foo': [
+            {'id': jobids[149] + '#shard-0', 'shardOf': jobids[149], 'remaining': 0},
+            {'id': jobids[149] + '#shard-1', 'shardOf': jobids[149], 'remaining': 2}]}}]
+
+    statuses = WatchbotProgress().status_many(list(reversed(jobids)) + ['missing'])
+    assert [s['jobid'] for s in statuses] == list(reversed(jobids))
+    assert statuses[0]['remaining'] == 2
+    assert statuses[1]['progress'] == 0.75
+    assert client.return_value.batch_get_item.call_count == 4
+    table.get_item.assert_not_called()
+
+
+@patch('watchbot_progress.backends.dynamodb.boto3.resource')
+def test_remaining(client, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    table = client.return_value.Table.return_value
+
+    table.get_item.return_value = {'Item': {'remaining': 3}}
+    assert WatchbotProgress().remaining('123') == 3
+    kwargs = table.get_item.call_args[1]
+    assert 'ConsistentRead' not in kwargs
+    assert sorted(kwargs['ExpressionAttributeNames'].values()) == ['remaining', 'shards']
+
+    table.get_item.return_value = {}
+    with pytest.raises(JobDoesNotExist):
+        WatchbotProgress().remaining('123')
@@ -0,0 +1,156 @@
+from concurrent import futures
+import threading
+import warnings
+
+import pytest
+
+from watchbot_progress import Part
+from watchbot_progress.backends.base import WatchbotProgressBase
+from watchbot_progress.backends.groupcommit import GroupCommitProgress
+from watchbot_progress.backends.memory import MemoryProgress
+
+
+class CountingProgress(WatchbotProgressBase):
+    """Records complete_parts calls for a job of `total` parts"""
+
+    def __init__(self, total):
+        self.topic = 'topic'
+        self.pending = set(range(total))
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def status(self, jobid, part=None):
+        return {'remaining': len(self.pending)}
+
+    def set_total(self, jobid, parts):
+        pass
+
+    def fail_job(self, jobid, reason):
+        pass
+
+    def complete_part(self, jobid, partid):
+        return self.complete_parts(jobid, [partid])['complete']
+
+    def complete_parts(self, jobid, partids):
+        with self.lock:
+            self.batches.append(list(partids))
+            self.pending.difference_update(partids)
+            return {'remaining': len(self.pending), 'complete': not self.pending}
+
+    def set_metadata(self, jobid, metadata):
+        pass
+
+    def list_jobs(self, status=True, active_only=False, jobids=None):
+        return []
+
+    def list_pending_parts(self, jobid):
+        return sorted(self.pending)
+
+
+def test_single_part_flushed_after_delay():
+    backend = CountingProgress(2)
+    progress = GroupCommitProgress(backend, max_batch=10, max_delay=0.001)
+    assert progress.complete_part('123', 0) is False
+    assert progress.complete_part('123', 1) is True
+    assert backend.batches == [[0], [1]]
+
+
+def test_batches_from_many_threads():
+    backend = CountingProgress(200)
+    progress = GroupCommitProgress(backend, max_batch=10, max_delay=0.05)
+
+    with futures.ThreadPoolExecutor(max_workers=40) as executor:
+        results = list(executor.map(
+            lambda partid: progress.complete_part('123', partid), range(200)))
+
+    assert backend.pending == set()
+    assert sorted(p for batch in backend.batches for p in batch) == list(range(200))
+    assert all(len(batch) <= 10 for batch in backend.batches)
+    assert len(backend.batches) < 200
+    # only one of the parts written in the final batch sees the job complete
+    assert results.count(True) == 1
+
+
+def test_batches_by_job():
+    backend = CountingProgress(4)
+    progress = GroupCommitProgress(backend, max_batch=2, max_delay=1)
+    calls = []
+    backend.complete_parts = lambda jobid, partids: calls.append((jobid, partids)) or {
+        'remaining': 0, 'complete': True}
+
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda args: progress.complete_part(*args), [('a', 0), ('b', 0)]))
+
+    assert sorted(calls) == [('a', [0]), ('b', [0])]
+
+
+def test_errors_raised_to_every_caller():
+    backend = CountingProgress(4)
+
+    def complete_parts(jobid, partids):
+        raise RuntimeError('backend down')
+
+    backend.complete_parts = complete_parts
+    progress = GroupCommitProgress(backend, max_batch=2, max_delay=1)
+
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        results = [executor.submit(progress.complete_part, '123', i) for i in range(2)]
+    for future in results:
+        with pytest.raises(RuntimeError):
+            future.result()
+
+
+def test_part_context_manager():
+    backend = CountingProgress(1)
+    progress = GroupCommitProgress(backend, max_delay=0.001)
+    on_reduce = []
+    with Part('123', 0, progress=progress, on_reduce=lambda *args, **kwargs: on_reduce.append(args)):
+        pass
+    assert len(on_reduce) == 1
+
+
+def test_part_delete_when_done():
+    """The reduce is claimed before the batch finishing the job deletes it"""
+    progress = GroupCommitProgress(
+        MemoryProgress(topic_arn='topic', delete_when_done=True), max_delay=0.001)
+    progress.set_total('123', 1)
+    on_reduce = []
+    with Part('123', 0, progress=progress, on_reduce=lambda *args, **kwargs: on_reduce.append(args)):
+        pass
+    assert len(on_reduce) == 1
+    assert list(progress.list_jobs()) == []
+
+
+def test_threads_claim_once_delete_when_done():
+    backend = MemoryProgress(topic_arn='topic', delete_when_done=True)
+    progress = GroupCommitProgress(backend, max_batch=10, max_delay=0.05)
+    progress.set_total('123', 200)
+
+    with futures.ThreadPoolExecutor(max_workers=40) as executor:
+        results = list(executor.map(
+            lambda partid: progress.complete_part_and_claim_reduce('123', partid), range(200)))
+
+    assert sum(1 for done, metadata in results if metadata is not None) == 1
+    assert sum(1 for done, metadata in results if done) == 1
+    assert list(progress.list_jobs()) == []
+
+
+def test_threads_reduce_once_without_warnings():
+    """Parts sharing the final batch do not warn that the reduce was already sent"""
+    progress = GroupCommitProgress(MemoryProgress(topic_arn='topic'), max_batch=16, max_delay=0.05)
+    progress.set_total('123', 64)
+    progress.set_metadata('123', {'foo': 'bar'})
+    on_reduce = []
+
+    def run(partid):
+        with Part('123', partid, progress=progress,
+                  on_reduce=lambda *args, **kwargs: on_reduce.append(args)):
+            pass
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        with futures.ThreadPoolExecutor(max_workers=64) as executor:
+            list(executor.map(run, range(64)))
+
+    assert len(on_reduce) == 1
+    assert caught == []
@@ -1,7 +1,12 @@
+from concurrent import futures
+
 import pytest
-from watchbot_progress import create_job, Part
-from watchbot_progress.errors import JobFailed, ProgressTypeError
+from watchbot_progress import create_job, run_job, Part, Parts
+from watchbot_progress.errors import JobFailed, ProgressTypeError, PublishError
+from watchbot_progress.main import failed_jobs
 from watchbot_progress.backends.base import WatchbotProgressBase
+from watchbot_progress.backends.memory import MemoryProgress
+from watchbot_progress.backends.sqlite import SqliteProgress
 from mock import patch, Mock
 
 parts = [
@@ -114,6 +119,17 @@ def test_Part_already_failed(aws_send_message, monkeypatch):
     aws_send_message.assert_not_called()
 
 
+def test_Part_failed_check_cached(monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    progress = MockProgress()
+    progress.is_failed = Mock(return_value=False)
+
+    for partid in range(3):
+        with Part(jobid='123', partid=partid, progress=progress, fail_job_on=[ValueError]):
+            pass
+    progress.is_failed.assert_called_once_with('123')
+
+
 @patch('watchbot_progress.main.sns_worker')
 def test_create_jobs_metadata(sns_worker, monkeypatch):
     monkeypatch.setenv('WorkTopic', 'abc123')
@@ -130,10 +146,11 @@ def test_create_jobs_metadata(sns_worker, monkeypatch):
 
 @patch('watchbot_progress.main.aws_send_message')
 @patch('watchbot_progress.main.DynamoProgress.fail_job')
-@patch('watchbot_progress.main.DynamoProgress.status')
-def test_Part_fail_job_on(status, fail_job, aws_send_message, monkeypatch):
+@patch('watchbot_progress.main.DynamoProgress.is_failed')
+def test_Part_fail_job_on(is_failed, fail_job, aws_send_message, monkeypatch):
     monkeypatch.setenv('WorkTopic', 'abc123')
     monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    is_failed.return_value = False
 
     class CustomException(Exception):
         pass
@@ -145,13 +162,21 @@ def test_Part_fail_job_on(status, fail_job, aws_send_message, monkeypatch):
     fail_job.assert_called_once_with(2, 2)
     aws_send_message.assert_not_called()
 
+    # this process knows the job failed without asking the backend
+    is_failed.reset_mock()
+    with pytest.raises(JobFailed):
+        with Part(jobid=2, partid=3, fail_job_on=[CustomException]):
+            pass
+    is_failed.assert_not_called()
+
 
 @patch('watchbot_progress.main.aws_send_message')
 @patch('watchbot_progress.main.DynamoProgress.fail_job')
-@patch('watchbot_progress.main.DynamoProgress.status')
-def test_Part_dont_fail_job_on(status, fail_job, aws_send_message, monkeypatch):
+@patch('watchbot_progress.main.DynamoProgress.is_failed')
+def test_Part_dont_fail_job_on(is_failed, fail_job, aws_send_message, monkeypatch):
     monkeypatch.setenv('WorkTopic', 'abc123')
     monkeypatch.setenv('ProgressTable', 'arn::table/foo')
+    is_failed.return_value = False
 
     class CustomException(Exception):
         pass
@@ -164,6 +189,59 @@ def test_Part_dont_fail_job_on(status, fail_job, aws_send_message, monkeypatch):
     aws_send_message.assert_not_called()
 
 
+def test_Parts_fail_job_on_cached(monkeypatch):
+    """A job failed by Parts is seen as failed by this process at once"""
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    progress = MemoryProgress()
+    progress.set_total('123', 4)
+    with pytest.raises(ZeroDivisionError):
+        with Parts('123', [0, 1], progress=progress, fail_job_on=[ZeroDivisionError]):
+            1 / 0
+
+    progress.is_failed = Mock(side_effect=AssertionError('cached'))
+    assert failed_jobs.is_failed(progress, '123') is True
+    with pytest.raises(JobFailed):
+        with Part(jobid='123', partid=2, progress=progress, fail_job_on=[ValueError]):
+            pass
+
+
+@patch('watchbot_progress.main.aws_send_message')
+def test_Parts_job_done(aws_send_message, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+
+    class CustomProgress(MockProgress):
+        completed = []
+
+        def complete_part(self, jobid, partid):
+            self.completed.append(partid)
+            return len(self.completed) == 3
+
+    progress = CustomProgress()
+    with Parts(jobid='123', partids=[0, 1], progress=progress):
+        pass
+    aws_send_message.assert_not_called()
+
+    with Parts(jobid='123', partids=[2], progress=progress):
+        pass
+    assert progress.completed == [0, 1, 2]
+    aws_send_message.assert_called_once()
+    assert aws_send_message.call_args[1].get('subject') == 'reduce'
+
+
+@patch('watchbot_progress.main.aws_send_message')
+def test_Parts_fail_job_on(aws_send_message, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    progress = MockProgress()
+    progress.fail_job = Mock()
+
+    with pytest.raises(ZeroDivisionError):
+        with Parts(jobid='123', partids=[0, 1], progress=progress,
+                   fail_job_on=[ZeroDivisionError]):
+            1 / 0
+    progress.fail_job.assert_called_once_with('123', '0, 1')
+    aws_send_message.assert_not_called()
+
+
 @patch('watchbot_progress.main.aws_send_message')
 def test_Part_bad_progress(aws_send_message):
     with pytest.raises(ProgressTypeError):
@@ -172,8 +250,140 @@ def test_Part_bad_progress(aws_send_message):
     aws_send_message.assert_not_called()
 
 
+@patch('watchbot_progress.main.sns_worker')
+def test_create_jobs_generator(sns_worker, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    sns_worker.return_value = True
+
+    class CountingProgress(MockProgress):
+        def set_total(self, jobid, parts, callback=None):
+            self.total = parts
+
+    progress = CountingProgress()
+    messages = ({'source': '{}.tif'.format(i)} for i in range(2500))
+    create_job(messages, progress=progress, total=2500, jobid='1', workers=2)
+
+    assert len(progress.total) == 2500
+    assert list(progress.total)[-1] == 2499
+    assert [len(c[0][0]) for c in sns_worker.call_args_list] == [1000, 1000, 500]
+    last = sns_worker.call_args_list[-1][0][0][-1]
+    assert last == {'source': '2499.tif', 'partid': 2499, 'jobid': '1', 'metadata': None}
+
+
+@patch('watchbot_progress.main.sns_worker')
+def test_create_job_sized_parts(sns_worker, monkeypatch):
+    """Backends written for lists of parts still get a sized collection"""
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    sns_worker.return_value = True
+
+    class ListProgress(MockProgress):
+        def set_total(self, jobid, parts):
+            self.pending = [i for i, _ in enumerate(parts)]
+            self.total = len(parts)
+
+    progress = ListProgress()
+    create_job((p for p in parts), progress=progress, total=3)
+    assert progress.total == 3
+    assert progress.pending == [0, 1, 2]
+
+
+@patch('watchbot_progress.main.sns_worker')
+def test_create_jobs_generator_no_total(sns_worker, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    sns_worker.return_value = True
+
+    create_job((p for p in parts), progress=MockProgress())
+    sns_worker.assert_called_once()
+    assert len(sns_worker.call_args[0][0]) == 3
+
+
+@patch('watchbot_progress.main.sns_worker')
+def test_create_jobs_wrong_total(sns_worker, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    sns_worker.return_value = True
+
+    with pytest.raises(ValueError):
+        create_job(iter(parts), progress=MockProgress(), total=2)
+
+    with pytest.raises(ValueError):
+        create_job(iter(parts), progress=MockProgress(), total=4)
+
+
+@patch('watchbot_progress.main.sns_worker')
+def test_create_jobs_publish_error(sns_worker, monkeypatch):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    sns_worker.side_effect = PublishError('nope')
+
+    with pytest.raises(PublishError):
+        create_job(parts, progress=MockProgress())
+
+
 @patch('watchbot_progress.main.sns_worker')
 def test_create_bad_progress(sns_worker):
     with pytest.raises(ProgressTypeError):
         create_job(jobid='1', parts=parts, progress=Exception())
     sns_worker.assert_not_called()
+
+
+def _square(message):
+    with open(message['path'], 'w') as dst:
+        dst.write(str(message['n'] ** 2))
+
+
+@patch('watchbot_progress.main.sns_worker')
+@patch('watchbot_progress.main.aws_send_message')
+def test_run_job(aws_send_message, sns_worker):
+    seen = []
+    reduce_fn = Mock(return_value='reduced')
+    progress = MemoryProgress()
+
+    assert run_job(
+        ({'n': n} for n in range(50)), seen.append, reduce_fn,
+        progress=progress, jobid='123', metadata={'foo': 'bar'}, total=50) == 'reduced'
+
+    assert sorted(m['partid'] for m in seen) == list(range(50))
+    assert seen[0]['jobid'] == '123'
+    assert seen[0]['metadata'] == {'foo': 'bar'}
+    reduce_fn.assert_called_once_with({'jobid': '123', 'metadata': {'foo': 'bar'}})
+    assert progress.status('123')['remaining'] == 0
+    assert not sns_worker.called
+    assert not aws_send_message.called
+
+
+def test_run_job_processes(tmpdir):
+    progress = SqliteProgress(str(tmpdir.join('progress.db')))
+    parts = [{'n': n, 'path': str(tmpdir.join(str(n)))} for n in range(20)]
+
+    with futures.ProcessPoolExecutor(max_workers=2) as executor:
+        message = run_job(parts, _square, lambda message: message,
+                          executor=executor, progress=progress)
+
+    assert progress.status(message['jobid'])['remaining'] == 0
+    assert tmpdir.join('7').read() == '49'
+
+
+def test_run_job_map_error():
+    class Boom(Exception):
+        pass
+
+    def map_fn(message):
+        if message['partid'] == 3 or message.get('fail'):
+            raise Boom()
+
+    reduce_fn = Mock()
+    progress = MemoryProgress()
+    with pytest.raises(Boom):
+        run_job([{}] * 5, map_fn, reduce_fn, progress=progress, jobid='run-job-error')
+
+    assert not reduce_fn.called
+    assert progress.list_pending_parts('run-job-error') == [3]
+
+    with pytest.raises(Boom):
+        run_job([{'fail': True}], map_fn, reduce_fn, progress=progress,
+                jobid='run-job-failed', fail_job_on=[Boom])
+    assert progress.is_failed('run-job-failed')
+
+
+def test_run_job_bad_progress():
+    with pytest.raises(ProgressTypeError):
+        run_job([{}], Mock(), progress=dict())
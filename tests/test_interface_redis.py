@@ -1,4 +1,4 @@
-from watchbot_progress import create_job, Part
+from watchbot_progress import create_job, Part, Parts
 from watchbot_progress.backends.redis import RedisProgress
 from mock import patch, Mock
 from mockredis import mock_strict_redis_client
@@ -19,7 +19,7 @@ def test_progress_one_done(aws_send_message, sns_worker, monkeypatch):
 
         sns_worker.side_effect = [True]
 
-        progress = RedisProgress()
+        progress = RedisProgress(scripts=False)  # mockredis cannot run Lua
 
         jobid = create_job(parts, progress=progress)
         with Part(jobid, 0, progress=progress):
@@ -39,7 +39,7 @@ def test_progress_one_done(aws_send_message, sns_worker, monkeypatch):
 @patch('watchbot_progress.main.aws_send_message')
 def test_progress_all_done(aws_send_message, sns_worker, monkeypatch):
         monkeypatch.setenv('WorkTopic', 'abc123')
-        progress = RedisProgress()
+        progress = RedisProgress(scripts=False)  # mockredis cannot run Lua
 
         jobid = create_job(parts, progress=progress)
         for i in range(3):
@@ -60,7 +60,7 @@ def test_progress_all_done(aws_send_message, sns_worker, monkeypatch):
 @patch('watchbot_progress.main.sns_worker')
 def test_progress_all_done_custom_on_reduce(sns_worker, monkeypatch):
         monkeypatch.setenv('WorkTopic', 'abc123')
-        progress = RedisProgress()
+        progress = RedisProgress(scripts=False)  # mockredis cannot run Lua
         on_reduce = Mock()
         jobid = create_job(parts, progress=progress)
         for i in range(3):
@@ -86,7 +86,7 @@ def test_progress_reduce_once(aws_send_message, sns_worker, monkeypatch):
         even if parts are completed multiple times
         """
         monkeypatch.setenv('WorkTopic', 'abc123')
-        progress = RedisProgress()
+        progress = RedisProgress(scripts=False)  # mockredis cannot run Lua
         jobid = create_job(parts, progress=progress)
 
         for i in range(3):
@@ -104,3 +104,101 @@ def test_progress_reduce_once(aws_send_message, sns_worker, monkeypatch):
                     pass
         assert 'skip' in record[0].message.args[0]
         aws_send_message.assert_not_called()
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+@patch('watchbot_progress.main.sns_worker')
+@patch('watchbot_progress.main.aws_send_message')
+def test_progress_reduce_send_fails(aws_send_message, sns_worker, monkeypatch):
+        """A failed reduce message is released and sent by a retry
+        """
+        monkeypatch.setenv('WorkTopic', 'abc123')
+        progress = RedisProgress(scripts=False)
+        jobid = create_job(parts, progress=progress, metadata={'foo': 'bar'})
+
+        for i in range(2):
+            with Part(jobid, i, progress=progress):
+                pass
+
+        aws_send_message.side_effect = RuntimeError('SNS is down')
+        with pytest.raises(RuntimeError):
+            with Part(jobid, 2, progress=progress):
+                pass
+
+        aws_send_message.side_effect = None
+        with Part(jobid, 2, progress=progress):
+            pass
+        assert aws_send_message.call_count == 2
+        message = aws_send_message.call_args[0][0]
+        assert message == {'jobid': jobid, 'metadata': {'foo': 'bar'}}
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+@patch('watchbot_progress.main.aws_send_message')
+def test_progress_scripted_reduce(aws_send_message, monkeypatch):
+        """Part completes and claims the reduce with one script call
+        """
+        monkeypatch.setenv('WorkTopic', 'abc123')
+        progress = RedisProgress(registry=False)
+        progress._complete_and_claim = Mock(return_value=[
+            0, 1, [b'total', b'3', b'reduce_message_sent', b'True', b'foo', b'bar']])
+
+        with Part('123', 2, progress=progress):
+            pass
+
+        progress._complete_and_claim.assert_called_once_with(
+            keys=['123-parts', '123-metadata', '123-remaining'], args=[2, '0'])
+        aws_send_message.assert_called_once()
+        message = aws_send_message.call_args[0][0]
+        assert message == {'jobid': '123', 'metadata': {'foo': 'bar'}}
+
+        aws_send_message.reset_mock()
+        progress._complete_and_claim.return_value = [0, 0]
+        with pytest.warns(UserWarning):
+            with Part('123', 2, progress=progress):
+                pass
+        aws_send_message.assert_not_called()
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+@patch('watchbot_progress.main.sns_worker')
+@patch('watchbot_progress.main.aws_send_message')
+def test_progress_parts(aws_send_message, sns_worker, monkeypatch):
+        monkeypatch.setenv('WorkTopic', 'abc123')
+        progress = RedisProgress(scripts=False)
+        jobid = create_job(parts, progress=progress)
+
+        with Parts(jobid, [0, 1], progress=progress):
+            pass
+        assert progress.status(jobid)['remaining'] == 1
+        aws_send_message.assert_not_called()
+
+        with Parts(jobid, [2], progress=progress):
+            pass
+        aws_send_message.assert_called_once()
+        assert aws_send_message.call_args[1].get('subject') == 'reduce'
+
+        with pytest.warns(UserWarning):
+            with Parts(jobid, [0, 1, 2], progress=progress):
+                pass
+        aws_send_message.assert_called_once()
+
+
+@pytest.mark.parametrize('bitmap', [False, True])
+@patch('redis.StrictRedis', mock_strict_redis_client)
+@patch('watchbot_progress.main.sns_worker')
+@patch('watchbot_progress.main.aws_send_message')
+def test_progress_parts_delete_when_done(aws_send_message, sns_worker, bitmap, monkeypatch):
+        monkeypatch.setenv('WorkTopic', 'abc123')
+        progress = RedisProgress(delete_when_done=True, bitmap=bitmap, scripts=False)
+        jobid = create_job(parts, progress=progress, metadata={'foo': 'bar'})
+
+        with Parts(jobid, [0, 1], progress=progress):
+            pass
+        aws_send_message.assert_not_called()
+
+        with Parts(jobid, [2], progress=progress):
+            pass
+        aws_send_message.assert_called_once()
+        assert aws_send_message.call_args[0][0] == {'jobid': jobid, 'metadata': {'foo': 'bar'}}
+        assert progress.redis.keys('{}-*'.format(jobid)) == []
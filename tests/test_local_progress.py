@@ -0,0 +1,187 @@
+"""Behaviour shared by the single-host backends: memory, sqlite and shared memory
+
+Backend-specific tests live in each backend's own test module.
+"""
+from __future__ import division
+
+from concurrent import futures
+
+from mock import patch, Mock
+import pytest
+
+from watchbot_progress import create_job, Part, Parts
+from watchbot_progress.backends.memory import MemoryProgress
+from watchbot_progress.backends.shared import SharedMemoryProgress
+from watchbot_progress.backends.sqlite import SqliteProgress
+from watchbot_progress.errors import JobDoesNotExist
+
+
+parts = [
+    {'source': 'a.tif'},
+    {'source': 'b.tif'},
+    {'source': 'c.tif'}]
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'shared'])
+def make_progress(request, tmpdir):
+    """Makes a progress object of each backend, given its keyword arguments"""
+    def make(**kwargs):
+        if request.param == 'memory':
+            return MemoryProgress(**kwargs)
+        if request.param == 'sqlite':
+            return SqliteProgress(str(tmpdir.join('progress.db')), **kwargs)
+        return SharedMemoryProgress(str(tmpdir.join('jobs')), **kwargs)
+    return make
+
+
+def test_status(make_progress):
+    p = make_progress(topic_arn='nope')
+    p.set_total('123', parts)
+    p.set_metadata('123', {'foo': 'bar'})
+    assert p.complete_part('123', 1) is False
+    assert p.status('123') == {
+        'jobid': '123', 'total': 3, 'remaining': 2, 'progress': 1 / 3,
+        'failed': False, 'metadata': {'foo': 'bar'}}
+    assert p.status('123', part=1) == {'part': 1, 'complete': True}
+    assert p.status('123', part=2) == {'part': 2, 'complete': False}
+    assert p.remaining('123') == 2
+
+    with pytest.raises(JobDoesNotExist):
+        p.status('nope')
+    with pytest.raises(JobDoesNotExist):
+        p.set_metadata('nope', {'foo': 'bar'})
+
+
+def test_complete_parts(make_progress):
+    p = make_progress(topic_arn='nope')
+    p.set_total('123', range(20))
+    assert p.complete_parts('123', [0, 9, 9, 19, 25]) == {'remaining': 17, 'complete': False}
+    assert p.list_pending_parts('123') == [i for i in range(20) if i not in (0, 9, 19)]
+    # already complete parts are not counted again
+    assert p.complete_part('123', 0) is False
+    assert p.complete_parts('123', []) == {'remaining': 17, 'complete': False}
+    assert p.complete_parts('123', [i for i in range(20)]) == {'remaining': 0, 'complete': True}
+    assert p.complete_part('123', '3') is True
+
+    with pytest.raises(JobDoesNotExist):
+        p.complete_part('nope', 0)
+
+
+def test_set_total_replaces(make_progress):
+    p = make_progress(topic_arn='nope')
+    p.set_total('123', range(10))
+    p.complete_parts('123', range(5))
+    p.claim_reduce('123')
+    p.set_total('123', parts)
+    assert p.remaining('123') == 3
+    assert p.list_pending_parts('123') == [0, 1, 2]
+    assert p.claim_reduce('123') == {}
+
+
+def test_set_total_count(make_progress):
+    p = make_progress(topic_arn='nope')
+    callback = Mock()
+    p.set_total('123', 10, callback=callback)
+    assert callback.call_args[0] == (10, 10)
+    assert p.list_pending_parts('123') == list(range(10))
+    assert p.status('123')['total'] == 10
+
+
+def test_fail_job(make_progress):
+    p = make_progress(topic_arn='nope')
+    p.set_total('123', parts)
+    assert p.is_failed('123') is False
+    p.fail_job('123', 'epic fail')
+    assert p.is_failed('123') is True
+    assert p.status('123')['error'] == 'epic fail'
+    assert p.is_failed('nope') is False
+
+
+def test_claim_reduce(make_progress):
+    p = make_progress(topic_arn='nope')
+    p.set_total('123', parts)
+    p.set_metadata('123', {'foo': 'bar'})
+    assert p.claim_reduce('123') == {'foo': 'bar'}
+    assert p.claim_reduce('123') is None
+    p.release_reduce('123')
+    assert p.claim_reduce('123') == {'foo': 'bar'}
+    assert p.claim_reduce('nope') is None
+
+
+def test_delete_when_done(make_progress):
+    p = make_progress(topic_arn='nope', delete_when_done=True)
+    p.set_total('123', parts)
+    p.complete_parts('123', [0, 1])
+    assert p.complete_part_and_claim_reduce('123', 2) == (True, {})
+    assert list(p.list_jobs()) == []
+    assert p.delete('123') is False
+
+    p.set_total('123', parts)
+    assert p.complete_parts_and_claim_reduce('123', [0, 1]) == (False, None)
+    assert p.complete_parts_and_claim_reduce('123', [1, 2]) == (True, {})
+    assert list(p.list_jobs()) == []
+
+
+def test_parts_delete_when_done(make_progress):
+    """The reduce is claimed before a job finished by Parts is deleted"""
+    p = make_progress(topic_arn='nope', delete_when_done=True)
+    on_reduce = Mock()
+    p.set_total('123', parts)
+    p.set_metadata('123', {'foo': 'bar'})
+    with Parts('123', [0, 1], progress=p, on_reduce=on_reduce):
+        pass
+    on_reduce.assert_not_called()
+    with Parts('123', [2], progress=p, on_reduce=on_reduce):
+        pass
+    on_reduce.assert_called_once()
+    assert on_reduce.call_args[0][0] == {'jobid': '123', 'metadata': {'foo': 'bar'}}
+    with pytest.raises(JobDoesNotExist):
+        p.status('123')
+
+
+def test_list_jobs(make_progress):
+    p = make_progress(topic_arn='nope')
+    p.set_total('b', parts)
+    p.set_total('a', parts)
+    p.complete_parts('b', [0, 1, 2])
+    assert list(p.list_jobs(status=False)) == ['b', 'a']
+    assert list(p.list_jobs(status=False, active_only=True)) == ['a']
+    assert [s['jobid'] for s in p.list_jobs()] == ['b', 'a']
+    assert [s['jobid'] for s in p.status_many(['a', 'nope', 'b'])] == ['a', 'b']
+    assert list(p.list_jobs(status=False, jobids=['a', 'nope'])) == ['a']
+
+    assert p.delete('a') is True
+    assert list(p.list_jobs(status=False)) == ['b']
+    with pytest.raises(JobDoesNotExist):
+        p.list_pending_parts('a')
+
+
+def test_threads_claim_once(make_progress):
+    p = make_progress(topic_arn='nope')
+    p.set_total('123', range(500))
+
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(
+            lambda partid: p.complete_part_and_claim_reduce('123', partid), range(500)))
+
+    assert p.remaining('123') == 0
+    assert sum(1 for done, metadata in results if metadata is not None) == 1
+    assert sum(1 for done, metadata in results if done) == 1
+
+
+@patch('watchbot_progress.main.sns_worker')
+def test_create_job_and_parts(sns_worker, monkeypatch, make_progress):
+    monkeypatch.setenv('WorkTopic', 'abc123')
+    progress = make_progress()
+    on_reduce = Mock()
+
+    jobid = create_job(parts, progress=progress, metadata={'foo': 'bar'})
+    with Part(jobid, 0, progress=progress, on_reduce=on_reduce):
+        pass
+    with Parts(jobid, [1, 2], progress=progress, on_reduce=on_reduce):
+        pass
+
+    assert progress.status(jobid)['remaining'] == 0
+    assert len(sns_worker.call_args[0][0]) == 3
+    on_reduce.assert_called_once()
+    assert on_reduce.call_args[0][0] == {'jobid': jobid, 'metadata': {'foo': 'bar'}}
@@ -0,0 +1,10 @@
+"""MemoryProgress specifics, see test_local_progress for the shared behaviour"""
+from watchbot_progress.backends.memory import MemoryProgress
+
+
+def test_large_job():
+    p = MemoryProgress(topic_arn='nope')
+    p.set_total('123', range(100001))
+    assert len(p._jobs['123'].pending) == 12501
+    assert p.complete_parts('123', range(100000)) == {'remaining': 1, 'complete': False}
+    assert p.list_pending_parts('123') == [100000]
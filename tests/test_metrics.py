@@ -0,0 +1,154 @@
+from mock import Mock, patch
+from mockredis import mock_strict_redis_client
+import pytest
+
+from watchbot_progress import Part, create_job, metrics
+from watchbot_progress.backends.redis import RedisProgress
+
+
+parts = [
+    {'source': 'a.tif'},
+    {'source': 'b.tif'},
+    {'source': 'c.tif'}]
+
+
+class ListSink(metrics.Sink):
+    def __init__(self):
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+
+@pytest.fixture
+def sink():
+    sink = ListSink()
+    metrics.add_sink(sink)
+    yield sink
+    metrics.remove_sink(sink)
+
+
+class Progress(object):
+    @metrics.instrumented('op')
+    def op(self, jobid, fail=False):
+        metrics.round_trip(payload_bytes=10)
+        if fail:
+            raise ValueError('nope')
+        return jobid
+
+    @metrics.instrumented('outer')
+    def outer(self, jobid):
+        metrics.round_trip()
+        return self.op(jobid)
+
+
+def test_no_sinks():
+    with patch('watchbot_progress.metrics._start') as start:
+        assert Progress().op('123') == '123'
+        with metrics.measure('thing'):
+            metrics.round_trip()
+    start.assert_not_called()
+
+
+def test_instrumented(sink):
+    assert Progress().op('123') == '123'
+    event, = sink.events
+    assert event.op == 'op'
+    assert event.jobid == '123'
+    assert event.round_trips == 1
+    assert event.payload_bytes == 10
+    assert event.duration >= 0
+    assert event.error is None
+
+
+def test_instrumented_keywords(sink):
+    assert Progress().op(jobid='123') == '123'
+    assert Progress().op('456', fail=False) == '456'
+    assert [e.jobid for e in sink.events] == ['123', '456']
+
+    with patch('watchbot_progress.metrics._sinks', []):
+        assert Progress().op(jobid='789') == '789'
+
+
+def test_instrumented_error(sink):
+    with pytest.raises(ValueError):
+        Progress().op('123', fail=True)
+    assert isinstance(sink.events[0].error, ValueError)
+
+
+def test_nested(sink):
+    Progress().outer('123')
+    inner, outer = sink.events
+    assert (inner.op, inner.round_trips) == ('op', 1)
+    assert (outer.op, outer.round_trips, outer.payload_bytes) == ('outer', 2, 10)
+
+
+def test_broken_sink_ignored(sink):
+    broken = Mock()
+    broken.record.side_effect = RuntimeError('sink down')
+    metrics.add_sink(broken)
+    try:
+        assert Progress().op('123') == '123'
+    finally:
+        metrics.remove_sink(broken)
+    assert len(sink.events) == 1
+
+
+def test_memory_sink():
+    sink = metrics.MemorySink()
+    for i in range(1, 101):
+        event = metrics.Event('op', '123')
+        event.duration = i / 1000
+        event.round_trips = 1
+        event.error = ValueError() if i == 100 else None
+        sink.record(event)
+
+    summary = sink.summary()['op']
+    assert summary['count'] == 100
+    assert summary['errors'] == 1
+    assert summary['round_trips'] == 100
+    assert summary['p50'] == 0.05
+    assert summary['p99'] == 0.099
+    assert summary['max'] == 0.1
+    assert round(summary['mean'], 4) == 0.0505
+
+    sink.clear()
+    assert sink.summary() == {}
+
+
+def test_memory_sink_sampled():
+    sink = metrics.MemorySink(max_samples=10)
+    for i in range(100):
+        event = metrics.Event('op')
+        event.duration = i
+        sink.record(event)
+    assert sink.summary()['op']['count'] == 100
+    assert len(sink._ops['op']['samples']) == 10
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+@patch('watchbot_progress.utils.boto3_session')
+def test_redis_create_job_and_part(session, monkeypatch):
+    session.return_value.client.return_value.publish_batch.side_effect = \
+        lambda TopicArn, PublishBatchRequestEntries: {
+            'Successful': [{'Id': e['Id']} for e in PublishBatchRequestEntries]}
+    sink = metrics.MemorySink()
+    metrics.add_sink(sink)
+    try:
+        progress = RedisProgress(topic_arn='topic', scripts=False)
+        jobid = create_job(parts, progress=progress)
+        for partid in range(3):
+            with Part(jobid, partid, progress=progress):
+                pass
+    finally:
+        metrics.remove_sink(sink)
+
+    summary = sink.summary()
+    assert summary['set_total']['round_trips'] == 1
+    assert summary['sns.publish_batch']['count'] == 1
+    assert summary['sns.publish_batch']['payload_bytes'] > 0
+    assert summary['create_job']['count'] == 1
+    assert summary['complete_part_and_claim_reduce']['count'] == 3
+    assert summary['claim_reduce']['count'] == 1
+    assert summary['sns.publish']['count'] == 1
+    assert summary['reduce']['count'] == 1
@@ -1,14 +1,40 @@
 from __future__ import division
 
-from mock import patch
+import gc
+import sys
 
-from mockredis import mock_strict_redis_client
+from mock import Mock, patch
+
+from mockredis import MockRedis, mock_strict_redis_client
 import pytest
+from redis.connection import Connection, SSLConnection
 
-from watchbot_progress.backends.redis import RedisProgress
+from watchbot_progress.backends.redis import RedisProgress, connection_pool
 from watchbot_progress.errors import JobDoesNotExist
 
 
+class MockBitcountRedis(MockRedis):
+    """mockredis does not implement BITCOUNT or SETRANGE"""
+
+    def bitcount(self, key):
+        return sum(bin(byte).count('1') for byte in bytearray(self.get(key) or b''))
+
+    def setrange(self, key, offset, value):
+        current = bytearray(self.get(key) or b'')
+        current.extend(b'\x00' * max(offset + len(value) - len(current), 0))
+        current[offset:offset + len(value)] = value
+        self.set(key, bytes(current))
+        return len(current)
+
+
+def mock_bitmap_redis_client(*args, **kwargs):
+    return MockBitcountRedis(strict=True)
+
+
+def mock_cluster_client(host, port, db, **kwargs):
+    return mock_strict_redis_client()
+
+
 @pytest.fixture()
 def parts():
     return [
@@ -185,3 +211,429 @@ def test_no_delete_when_done(parts, monkeypatch):
     p.complete_part(jobid, 0)
     assert 'total' in p._decode_dict(p.redis.hgetall('123-metadata'))
     assert p.status(jobid)['remaining'] == 0  # status still works
+
+
+@patch('redis.StrictRedis', mock_bitmap_redis_client)
+def test_bitmap_status(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', bitmap=True)
+    p.set_total('123', parts)
+    status = p.status('123')
+    assert status['total'] == 3
+    assert status['remaining'] == 3
+    assert p.redis.get('123-parts') == b'\xe0'
+
+
+@patch('redis.StrictRedis', mock_bitmap_redis_client)
+def test_bitmap_complete_part(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', bitmap=True, scripts=False)
+    p.set_total('123', parts)
+    assert not p.complete_part('123', 1)
+    assert p.status('123', part=1)['complete'] is True
+    assert p.status('123', part=0)['complete'] is False
+    assert p.status('123')['remaining'] == 2
+    assert sorted(p.list_pending_parts('123')) == [0, 2]
+
+    assert not p.complete_part('123', 1)  # completing twice is harmless
+    assert not p.complete_part('123', 0)
+    assert p.complete_part('123', 2)
+    assert p.status('123')['progress'] == 1.0
+    assert p.list_pending_parts('123') == []
+
+
+@patch('redis.StrictRedis', mock_bitmap_redis_client)
+def test_bitmap_many_parts(monkeypatch):
+    p = RedisProgress(topic_arn='nope', bitmap=True, scripts=False)
+    p.set_total('123', [{}] * 1001)
+    assert len(p.redis.get('123-parts')) == 126
+    assert p.status('123')['remaining'] == 1001
+    p.complete_part('123', 1000)
+    assert p.list_pending_parts('123') == list(range(1000))
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_claim_reduce(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope')
+    p.set_total('123', parts)
+    p.set_metadata('123', {'foo': 'bar'})
+    assert p.claim_reduce('123') == {'foo': 'bar'}
+    assert p.claim_reduce('123') is None
+    p.release_reduce('123')
+    assert p.claim_reduce('123') == {'foo': 'bar'}
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_claim_reduce_deleted(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', scripts=False, delete_when_done=True)
+    p.set_total('123', [parts[0]])
+    assert p.complete_part_and_claim_reduce('123', 0) == (True, {})
+    assert p.complete_part_and_claim_reduce('123', 0) == (True, None)
+    assert not p.redis.exists('123-metadata')
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_complete_parts(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope')
+    p.set_total('123', parts)
+    assert p.complete_parts('123', [0, 2]) == {'remaining': 1, 'complete': False}
+    assert p.list_pending_parts('123') == [1]
+    assert p.complete_parts('123', []) == {'remaining': 1, 'complete': False}
+    assert p.complete_parts('123', [0, 1]) == {'remaining': 0, 'complete': True}
+
+
+@patch('redis.StrictRedis', mock_bitmap_redis_client)
+def test_bitmap_complete_parts(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', bitmap=True, scripts=False, delete_when_done=True)
+    p.set_total('123', parts)
+    assert p.complete_parts('123', [0, 2]) == {'remaining': 1, 'complete': False}
+    assert p.list_pending_parts('123') == [1]
+    assert p.complete_parts('123', [1]) == {'remaining': 0, 'complete': True}
+    assert not p.redis.exists('123-metadata')
+
+
+@patch('redis.StrictRedis', mock_bitmap_redis_client)
+def test_bitmap_complete_missing_parts(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', bitmap=True, scripts=False, delete_when_done=True)
+    p.set_total('123', parts)
+    assert p.complete_parts('123', [0, 0, 1000]) == {'remaining': 2, 'complete': False}
+    assert len(p.redis.get('123-parts')) == 1  # not grown to partid 1000
+    assert p.complete_parts('123', [1, 2]) == {'remaining': 0, 'complete': True}
+
+    # completing parts of a deleted job does not recreate its keys
+    assert p.complete_part('123', 1)
+    assert p.complete_parts('123', [2]) == {'remaining': 0, 'complete': True}
+    assert not p.redis.exists('123-parts')
+    assert not p.redis.exists('123-remaining')
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_is_failed(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope')
+    p.set_total('123', parts)
+    assert p.is_failed('123') is False
+    p.fail_job('123', 'epic fail')
+    assert p.is_failed('123') is True
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_list_jobs_pipelined(parts, monkeypatch):
+    p = RedisProgress(host='localhost', port=6379, db=0, topic_arn='nope', registry=False)
+    for i in range(25):
+        p.set_total('job{:02d}'.format(i), parts)
+    p.complete_part('job03', 0)
+    p.redis.set('unrelated', 'key')
+
+    pipeline = p.redis.pipeline
+    with patch.object(p.redis, 'pipeline', side_effect=pipeline) as pipelines:
+        jobs = list(p.list_jobs(count=10))
+    assert len(jobs) == 25
+    assert jobs[3]['jobid'] == 'job03'
+    assert jobs[3]['remaining'] == 2
+    # one pipeline per SCAN batch, not one per job
+    assert pipelines.call_count < 25
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_list_jobs_skips_deleted(parts, monkeypatch):
+    p = RedisProgress(host='localhost', port=6379, db=0, topic_arn='nope')
+    p.set_total('job1', parts)
+    p.redis.hset('job2-metadata', 'error', 'no total')
+    assert [j['jobid'] for j in p.list_jobs()] == ['job1']
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_registry(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope')
+    p.set_total('job1', parts)
+    p.set_total('job2', parts)
+    p.redis.set('unrelated-metadata', 'key')
+    assert p.redis.zrange('watchbot-progress-jobs', 0, -1) == [b'job1', b'job2']
+
+    with patch.object(p.redis, 'scan') as scan:
+        assert list(p.list_jobs(status=False, count=1)) == ['job1', 'job2']
+        assert [j['jobid'] for j in p.list_jobs()] == ['job1', 'job2']
+    scan.assert_not_called()
+
+    for partid in range(3):
+        p.complete_part('job1', partid)
+    assert list(p.list_jobs(status=False, active_only=True)) == ['job2']
+    # positional parameters are the same as every other backend's
+    assert list(p.list_jobs(False, True)) == ['job2']
+    assert [j['jobid'] for j in p.list_jobs(active_only=True)] == ['job2']
+    assert list(p.list_jobs(status=False)) == ['job1', 'job2']
+
+    p.complete_parts('job2', [0, 1, 2])
+    assert list(p.list_jobs(active_only=True)) == []
+
+    p.delete('job1')
+    assert list(p.list_jobs(status=False)) == ['job2']
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_registry_claim_path(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', scripts=False)
+    p.set_total('job1', parts)
+    for partid in range(3):
+        p.complete_part_and_claim_reduce('job1', partid)
+    assert list(p.list_jobs(status=False, active_only=True)) == []
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_registry_script_keys(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', scripts=False)
+    p.scripts = True
+    p._complete_and_claim = Mock(return_value=[0, 0])
+    p.complete_part_and_claim_reduce('job1', 2)
+    p._complete_and_claim.assert_called_once_with(
+        keys=['job1-parts', 'job1-metadata', 'job1-remaining', 'watchbot-progress-active'],
+        args=[2, '0', 'job1'])
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_rebuild_registry(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', registry=False)
+    p.set_total('job1', parts)
+    p.set_total('job2', parts)
+    p.complete_parts('job2', [0, 1, 2])
+
+    p.registry = True
+    # jobs are scanned for until there is a registry
+    assert sorted(p.list_jobs(status=False)) == ['job1', 'job2']
+    assert list(p.list_jobs(status=False, active_only=True)) == ['job1']
+
+    p.set_total('job3', parts)
+    assert list(p.list_jobs(status=False)) == ['job3']
+    p.rebuild_registry()
+    assert sorted(p.list_jobs(status=False)) == ['job1', 'job2', 'job3']
+    assert sorted(p.list_jobs(status=False, active_only=True)) == ['job1', 'job3']
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_list_jobs_active_only_without_registry(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', registry=False)
+    p.set_total('job1', parts)
+    p.set_total('job2', parts)
+    p.complete_parts('job1', [0, 1, 2])
+    assert list(p.list_jobs(status=False, active_only=True)) == ['job2']
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_status_many(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope')
+    p.set_total('job1', parts)
+    p.set_total('job2', parts)
+    p.complete_part('job2', 0)
+
+    pipeline = p.redis.pipeline
+    with patch.object(p.redis, 'pipeline', side_effect=pipeline) as pipelines:
+        statuses = p.status_many(['job2', 'nope', 'job1'])
+    assert pipelines.call_count == 1
+    assert [s['jobid'] for s in statuses] == ['job2', 'job1']
+    assert statuses[0]['remaining'] == 2
+
+    assert list(p.list_jobs(status=False, jobids=['job1', 'nope'])) == ['job1']
+    assert [s['jobid'] for s in p.list_jobs(jobids=['job2', 'job1'])] == ['job2', 'job1']
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_remaining(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope')
+    p.set_total('job1', parts)
+    p.complete_part('job1', 1)
+    assert p.remaining('job1') == 2
+
+
+@patch('redis.StrictRedis', mock_strict_redis_client)
+def test_set_total_count_in_chunks(monkeypatch):
+    monkeypatch.setattr('watchbot_progress.backends.redis.SET_TOTAL_CHUNK', 4)
+    p = RedisProgress(topic_arn='nope')
+    p.set_total('123', range(20))
+    callback = Mock()
+    p.set_total('123', 10, callback=callback)
+
+    assert [c[0] for c in callback.call_args_list] == [(4, 10), (8, 10), (10, 10)]
+    assert sorted(p.list_pending_parts('123')) == list(range(10))
+    assert p.status('123')['total'] == 10
+
+
+@patch('redis.StrictRedis', mock_bitmap_redis_client)
+def test_bitmap_set_total_in_chunks(monkeypatch):
+    monkeypatch.setattr('watchbot_progress.backends.redis.BITMAP_CHUNK', 2)
+    p = RedisProgress(topic_arn='nope', bitmap=True)
+    callback = Mock()
+    p.set_total('123', 35, callback=callback)
+
+    assert [c[0] for c in callback.call_args_list] == [(16, 35), (32, 35), (35, 35)]
+    assert p.redis.get('123-parts') == b'\xff\xff\xff\xff\xe0'
+    assert p.status('123')['remaining'] == 35
+
+
+@patch('watchbot_progress.backends.redis._cluster_client', mock_cluster_client)
+def test_cluster_keys(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', cluster=True, scripts=False)
+    p.set_total('job1', parts)
+    assert sorted(p.redis.keys('{job1}*')) == [b'{job1}-metadata', b'{job1}-parts']
+    p.complete_parts('job1', [0, 1])
+    assert p.status('job1')['remaining'] == 1
+    assert list(p.list_jobs(status=False, active_only=True)) == ['job1']
+    assert p.complete_part_and_claim_reduce('job1', 2) == (True, {})
+    assert list(p.list_jobs(status=False, active_only=True)) == []
+
+
+@patch('watchbot_progress.backends.redis._cluster_client', mock_cluster_client)
+def test_cluster_script_keys(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', cluster=True, scripts=False)
+    p.set_total('job1', parts)
+    p.scripts = True
+    p._complete_and_claim = Mock(return_value=[0, 0])
+    p.complete_part_and_claim_reduce('job1', 2)
+
+    # only the job's keys, which share a slot
+    p._complete_and_claim.assert_called_once_with(
+        keys=['{job1}-parts', '{job1}-metadata', '{job1}-remaining'], args=[2, '0'])
+    assert p.redis.smembers('watchbot-progress-active') == set()
+
+
+@patch('watchbot_progress.backends.redis._cluster_client', mock_cluster_client)
+def test_cluster_scan_primaries(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', cluster=True, registry=False)
+    primaries = [mock_strict_redis_client(), mock_strict_redis_client()]
+    p._primaries = Mock(return_value=primaries)
+    p.redis = primaries[0]
+    p.set_total('job1', parts)
+    p.redis = primaries[1]
+    p.set_total('job2', parts)
+    p.set_total('job3', parts)
+
+    assert sorted(p.list_jobs(status=False)) == ['job1', 'job2', 'job3']
+
+
+def test_cluster_bitmap_needs_scripts():
+    """Cluster pipelines cannot WATCH the job's total to clear bits"""
+    with pytest.raises(ValueError):
+        RedisProgress(topic_arn='nope', cluster=True, bitmap=True, scripts=False)
+
+
+@patch('watchbot_progress.backends.redis._cluster_client', mock_cluster_client)
+def test_cluster_bitmap_clears_bits_with_script(parts, monkeypatch):
+    p = RedisProgress(topic_arn='nope', cluster=True, bitmap=True)
+    p.set_total('job1', parts)
+    p._clear_pending_bits = Mock(return_value=1)
+    p.redis.pipeline = Mock(side_effect=AssertionError('no WATCH in a cluster'))
+
+    assert p.complete_parts('job1', [0, 2]) == {'remaining': 1, 'complete': False}
+    assert p.complete_part('job1', 0) is False
+    # only the job's keys, which share a slot
+    p._clear_pending_bits.assert_called_with(
+        keys=['{job1}-parts', '{job1}-remaining'], args=[0])
+
+
+def test_cluster_needs_rediscluster(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'rediscluster', None)
+    with pytest.raises(ImportError):
+        RedisProgress(topic_arn='nope', cluster=True)
+
+
+def test_connection_pool_shared():
+    pool = connection_pool('redis://:secret@example.com:6380/2', max_connections=5)
+    assert connection_pool('redis://:secret@example.com:6380/2', max_connections=5) is pool
+    assert connection_pool('redis://:secret@example.com:6380/2') is not pool
+    assert pool.max_connections == 5
+    assert pool.connection_kwargs == {
+        'host': 'example.com', 'port': 6380, 'db': 2, 'password': 'secret'}
+
+
+def test_connection_pool_forked():
+    pool = connection_pool('redis://localhost:6379/0')
+    available, in_use = Connection(), Connection()
+    available._sock, in_use._sock = Mock(), Mock()
+    sockets = [available._sock, in_use._sock]
+    pool._available_connections.append(available)
+    pool._in_use_connections.add(in_use)
+
+    pool.pid = -1  # as if this process had been forked
+    pool._checkpid()
+    assert pool._available_connections == []
+    assert pool._in_use_connections == set()
+
+    # the parent's sockets are left alone, even once the connections are collected
+    del available, in_use
+    gc.collect()
+    for sock in sockets:
+        assert not sock.shutdown.called
+
+
+def test_from_url(monkeypatch):
+    p = RedisProgress.from_url(
+        'rediss://localhost:6380/1', topic_arn='nope', bitmap=True, socket_timeout=5)
+    other = RedisProgress.from_url('rediss://localhost:6380/1', topic_arn='nope', socket_timeout=5)
+    pool = p.redis.connection_pool
+
+    assert other.redis.connection_pool is pool
+    assert pool.connection_class is SSLConnection
+    assert pool.connection_kwargs['socket_timeout'] == 5
+    assert p.bitmap and not other.bitmap
+
+
+@pytest.mark.parametrize('bitmap', [False, True])
+def test_script_complete_and_claim(redis_url, bitmap):
+    """COMPLETE_AND_CLAIM on a real server"""
+    p = RedisProgress.from_url(redis_url, topic_arn='nope', bitmap=bitmap)
+    p.set_total('123', 3)
+    p.set_metadata('123', {'foo': 'bar'})
+
+    assert p.complete_part_and_claim_reduce('123', 0) == (False, None)
+    assert p.complete_part_and_claim_reduce('123', 0) == (False, None)
+    assert p.status('123')['remaining'] == 2
+    assert p.complete_part_and_claim_reduce('123', 1) == (False, None)
+    assert [j['jobid'] for j in p.list_jobs(active_only=True)] == ['123']
+
+    assert p.complete_part_and_claim_reduce('123', 2) == (True, {'foo': 'bar'})
+    assert p.complete_part_and_claim_reduce('123', 2) == (True, None)
+    assert p.status('123')['remaining'] == 0
+    # the script drops the job from the active jobs
+    assert list(p.list_jobs(active_only=True)) == []
+
+
+def test_script_bitmap_partid_out_of_range(redis_url):
+    p = RedisProgress.from_url(redis_url, topic_arn='nope', bitmap=True)
+    p.set_total('123', 3)
+    assert p.complete_part_and_claim_reduce('123', 1000) == (False, None)
+    assert p.status('123')['remaining'] == 3
+    assert len(p.redis.get('123-parts')) == 1
+
+
+def test_script_clear_bits(redis_url):
+    """CLEAR_BITS on a real server"""
+    p = RedisProgress.from_url(redis_url, topic_arn='nope', bitmap=True, delete_when_done=True)
+    p.set_total('123', 3)
+    assert p.complete_parts('123', [0, 0, 1000, -1]) == {'remaining': 2, 'complete': False}
+    assert len(p.redis.get('123-parts')) == 1
+    assert p.complete_part('123', 0) is False
+    assert p.list_pending_parts('123') == [1, 2]
+    assert p.complete_parts('123', [1, 2]) == {'remaining': 0, 'complete': True}
+    assert p.redis.keys('123-*') == []
+
+    # completing parts of a deleted job does not recreate its keys
+    assert p.complete_parts('123', [1, 2]) == {'remaining': 0, 'complete': True}
+    assert p.redis.keys('123-*') == []
+
+
+def test_script_without_registry(redis_url):
+    p = RedisProgress.from_url(redis_url, topic_arn='nope', registry=False)
+    p.set_total('123', 1)
+    assert p.complete_part_and_claim_reduce('123', 0) == (True, {})
+    assert not p.redis.exists('watchbot-progress-active')
+
+
+@pytest.mark.parametrize('bitmap', [False, True])
+def test_script_deleted_job(redis_url, bitmap):
+    p = RedisProgress.from_url(redis_url, topic_arn='nope', bitmap=bitmap, delete_when_done=True)
+    p.set_total('123', 2)
+    assert p.complete_part_and_claim_reduce('123', 0) == (False, None)
+    assert p.complete_part_and_claim_reduce('123', 1) == (True, {})
+    assert p.redis.keys('123-*') == []
+
+    # late completions find no job, claim nothing and leave nothing behind
+    assert p.complete_part_and_claim_reduce('123', 1) == (True, None)
+    assert p.complete_part_and_claim_reduce('123', 0) == (True, None)
+    assert p.redis.keys('123-*') == []
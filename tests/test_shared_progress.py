@@ -0,0 +1,69 @@
+"""SharedMemoryProgress specifics, see test_local_progress for the shared behaviour"""
+from concurrent import futures
+import pickle
+
+from mock import Mock
+import pytest
+
+from watchbot_progress.backends.shared import SharedMemoryProgress
+from watchbot_progress.errors import JobDoesNotExist
+
+
+parts = [
+    {'source': 'a.tif'},
+    {'source': 'b.tif'},
+    {'source': 'c.tif'}]
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('jobs'))
+
+
+def test_survives_process(path):
+    p = SharedMemoryProgress(path, topic_arn='nope')
+    p.set_total('job/1', parts)
+    p.complete_part('job/1', 0)
+
+    # state is in the files, not the process
+    assert SharedMemoryProgress(path).status('job/1')['remaining'] == 2
+    assert list(SharedMemoryProgress(path).list_jobs(status=False)) == ['job/1']
+
+
+def test_replaced_elsewhere(path):
+    p = SharedMemoryProgress(path, topic_arn='nope')
+    other = SharedMemoryProgress(path, topic_arn='nope')
+    p.set_total('123', parts)
+    assert other.complete_part('123', 0) is False
+
+    p.set_total('123', range(10))
+    assert other.remaining('123') == 10
+    p.delete('123')
+    with pytest.raises(JobDoesNotExist):
+        other.remaining('123')
+
+
+def test_set_total_in_chunks(path, monkeypatch):
+    monkeypatch.setattr('watchbot_progress.backends.shared.BITMAP_CHUNK', 1)
+    p = SharedMemoryProgress(path, topic_arn='nope')
+    callback = Mock()
+    p.set_total('123', 20, callback=callback)
+    assert [c[0] for c in callback.call_args_list] == [(8, 20), (16, 20), (20, 20)]
+    assert p.list_pending_parts('123') == list(range(20))
+
+
+def _complete(args):
+    p, partid = args
+    return p.complete_part_and_claim_reduce('123', partid)
+
+
+def test_processes_claim_once(path):
+    p = SharedMemoryProgress(path, topic_arn='nope')
+    p.set_total('123', range(200))
+    assert pickle.loads(pickle.dumps(p)).remaining('123') == 200
+
+    with futures.ProcessPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(_complete, [(p, partid) for partid in range(200)]))
+
+    assert p.remaining('123') == 0
+    assert sum(1 for done, metadata in results if metadata is not None) == 1
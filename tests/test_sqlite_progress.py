@@ -0,0 +1,87 @@
+"""SqliteProgress specifics, see test_local_progress for the shared behaviour"""
+from concurrent import futures
+import pickle
+import sqlite3
+
+from mock import Mock
+import pytest
+
+from watchbot_progress.backends.sqlite import SqliteProgress
+
+
+parts = [
+    {'source': 'a.tif'},
+    {'source': 'b.tif'},
+    {'source': 'c.tif'}]
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('progress.db'))
+
+
+def test_wal_and_durable(path):
+    p = SqliteProgress(path, topic_arn='nope')
+    assert p._connection().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    p.set_total('123', parts)
+    p.complete_part('123', 0)
+
+    # a new connection sees the committed state
+    assert SqliteProgress(path).status('123')['remaining'] == 2
+
+
+def test_set_total_in_chunks(path, monkeypatch):
+    monkeypatch.setattr('watchbot_progress.backends.sqlite.INSERT_BATCH_SIZE', 4)
+    p = SqliteProgress(path, topic_arn='nope')
+    callback = Mock()
+    p.set_total('123', 10, callback=callback)
+    assert [c[0] for c in callback.call_args_list] == [(4, 10), (8, 10), (10, 10)]
+    assert p.list_pending_parts('123') == list(range(10))
+
+
+class _FailingCommit(object):
+    """A connection whose next COMMIT fails, as when the database is busy"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.fail = True
+
+    def execute(self, sql, *args):
+        if sql == 'COMMIT' and self.fail:
+            self.fail = False
+            raise sqlite3.OperationalError('database is locked')
+        return self.conn.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def test_commit_fails(path):
+    p = SqliteProgress(path, topic_arn='nope')
+    p.set_total('123', parts)
+    conn = _FailingCommit(p._connection())
+    p._connection = lambda: conn
+
+    with pytest.raises(sqlite3.OperationalError):
+        p.complete_part('123', 0)
+    # rolled back, and the connection can start the next transaction
+    assert p.remaining('123') == 3
+    assert p.complete_part('123', 0) is False
+    assert SqliteProgress(path).remaining('123') == 2
+
+
+def _complete(args):
+    p, partid = args
+    return p.complete_part_and_claim_reduce('123', partid)
+
+
+def test_processes_claim_once(path):
+    p = SqliteProgress(path, topic_arn='nope')
+    p.set_total('123', range(200))
+    assert pickle.loads(pickle.dumps(p)).remaining('123') == 200
+
+    with futures.ProcessPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(_complete, [(p, partid) for partid in range(200)]))
+
+    assert p.remaining('123') == 0
+    assert sum(1 for done, metadata in results if metadata is not None) == 1
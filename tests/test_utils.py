@@ -1,9 +1,9 @@
 
-# import pytest
-
-from mock import patch
+from mock import patch, Mock
+import pytest
 
 from watchbot_progress import utils
+from watchbot_progress.errors import PublishError
 
 
 def test_chunker_valid():
@@ -13,6 +13,46 @@ def test_chunker_valid():
     assert list(utils.chunker(it, 2)) == [[1, 2], [3, 4], [5, 6], [7]]
 
 
+def test_chunker_generator():
+    """ Should chunk iterables without a length
+    """
+    assert list(utils.chunker((i for i in range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(utils.chunker(iter([]), 2)) == []
+
+
+def test_pending_bitmap():
+    """ Should set one leading bit per part
+    """
+    assert utils.pending_bitmap(0) == b''
+    assert utils.pending_bitmap(3) == b'\xe0'
+    assert utils.pending_bitmap(8) == b'\xff'
+    assert utils.pending_bitmap(10) == b'\xff\xc0'
+
+
+def test_part_count():
+    """ Should accept a count or a sized collection
+    """
+    assert utils.part_count(3) == 3
+    assert utils.part_count([{}, {}]) == 2
+    assert utils.part_count(range(10)) == 10
+    assert utils.part_count(utils.part_range(10)) == 10
+
+
+def test_part_range():
+    parts = utils.part_range(3)
+    assert len(parts) == 3
+    assert list(parts) == [0, 1, 2]
+    assert not isinstance(parts, list)
+
+
+def test_bitmap_members():
+    """ Should list the offsets of set bits
+    """
+    assert list(utils.bitmap_members(utils.pending_bitmap(10))) == list(range(10))
+    assert list(utils.bitmap_members(b'\x00\x41')) == [9, 15]
+    assert list(utils.bitmap_members(None)) == []
+
+
 @patch('watchbot_progress.utils.boto3_session')
 def test_aws_send_message_valid(session):
     """ Should work as expected
@@ -59,29 +99,124 @@ def test_aws_send_message_valid_subject(session):
     session.assert_called_once()
 
 
-@patch('watchbot_progress.utils.aws_send_message')
-def test_sns_worker_valid(aws_send_message):
+@patch('watchbot_progress.utils.boto3_session')
+def test_aws_send_batch_valid(session):
+    """ Should publish all messages in one request
+    """
+    client = session.return_value.client.return_value
+    client.publish_batch.return_value = {
+        'Successful': [{'Id': '0'}, {'Id': '1'}], 'Failed': []}
+
+    messages = [{'content': 'a'}, {'content': 'b'}]
+    topic = "arn:aws:sns:my-region:00000000000:a-stack-0000XXXXXXX"
+
+    assert utils.aws_send_batch(messages, topic, subject='map')
+    client.publish_batch.assert_called_once()
+    kwargs = client.publish_batch.call_args[1]
+    assert kwargs['TopicArn'] == topic
+    assert kwargs['PublishBatchRequestEntries'][1] == {
+        'Id': '1', 'Message': '{"content": "b"}', 'Subject': 'map'}
+
+
+@patch('watchbot_progress.utils.time.sleep')
+@patch('watchbot_progress.utils.boto3_session')
+def test_aws_send_batch_retry(session, sleep):
+    """ Should retry only the failed entries
+    """
+    client = session.return_value.client.return_value
+    client.publish_batch.side_effect = [
+        {'Successful': [{'Id': '0'}],
+         'Failed': [{'Id': '1', 'Code': 'InternalError', 'SenderFault': False}]},
+        {'Successful': [{'Id': '1'}], 'Failed': []}]
+
+    messages = [{'content': 'a'}, {'content': 'b'}]
+    assert utils.aws_send_batch(messages, 'topic')
+    assert client.publish_batch.call_count == 2
+    retried = client.publish_batch.call_args[1]['PublishBatchRequestEntries']
+    assert retried == [{'Id': '1', 'Message': '{"content": "b"}'}]
+
+
+@patch('watchbot_progress.utils.time.sleep')
+@patch('watchbot_progress.utils.boto3_session')
+def test_aws_send_batch_retries_exhausted(session, sleep):
+    """ Should raise once retries are used up
+    """
+    client = session.return_value.client.return_value
+    client.publish_batch.return_value = {
+        'Successful': [],
+        'Failed': [{'Id': '0', 'Code': 'InternalError', 'SenderFault': False}]}
+
+    with pytest.raises(PublishError):
+        utils.aws_send_batch([{'content': 'a'}], 'topic', retries=2)
+    assert client.publish_batch.call_count == 3
+
+
+@patch('watchbot_progress.utils.boto3_session')
+def test_aws_send_batch_sender_fault(session):
+    """ Should not retry sender faults
+    """
+    client = session.return_value.client.return_value
+    client.publish_batch.return_value = {
+        'Successful': [],
+        'Failed': [{'Id': '0', 'Code': 'InvalidParameter', 'SenderFault': True}]}
+
+    with pytest.raises(PublishError):
+        utils.aws_send_batch([{'content': 'a'}], 'topic')
+    client.publish_batch.assert_called_once()
+
+
+@patch('watchbot_progress.utils.boto3_session')
+@patch('watchbot_progress.utils.aws_send_batch')
+def test_sns_worker_valid(aws_send_batch, session):
     """ Should work as expected
     """
 
-    aws_send_message.side_effect = [True, True]
+    aws_send_batch.return_value = True
 
-    messages = [
-        {'content': 'this is a message'},
-        {'content': 'this is another message'}]
+    messages = [{'content': 'message {}'.format(i)} for i in range(25)]
 
     topic = "arn:aws:sns:my-region:00000000000:a-stack-0000XXXXXXX"
 
     assert utils.sns_worker(messages, topic)
-    assert aws_send_message.call_count == 2
+    assert aws_send_batch.call_count == 3
+    assert [len(c[0][0]) for c in aws_send_batch.call_args_list] == [10, 10, 5]
+
+
+@patch('watchbot_progress.utils.boto3_session')
+@patch('watchbot_progress.utils.aws_send_batch')
+def test_sns_worker_large_messages(aws_send_batch, session):
+    """ Should keep each request under the PublishBatch size limit
+    """
+
+    aws_send_batch.return_value = True
+
+    # ~100KB each, so only two fit in a request
+    messages = [{'content': 'x' * 100000, 'partid': i} for i in range(5)]
+
+    assert utils.sns_worker(messages, 'topic', 'map')
+    assert [len(c[0][0]) for c in aws_send_batch.call_args_list] == [2, 2, 1]
+
+
+def test_sns_batches():
+    """ Should split by count and by size
+    """
+    assert [len(b) for b in utils.sns_batches([{}] * 25)] == [10, 10, 5]
+    assert list(utils.sns_batches([])) == []
+
+    big = {'content': 'x' * (utils.SNS_BATCH_BYTES - 23)}  # 8 bytes short of the limit
+    small = {'a': 1}  # 8 bytes encoded
+    assert list(utils.sns_batches([big, small])) == [[big, small]]
+    assert list(utils.sns_batches([big, small], subject='map')) == [[big], [small]]
+    assert list(utils.sns_batches([big, big])) == [[big], [big]]
 
 
-@patch('watchbot_progress.utils.aws_send_message')
-def test_sns_worker_valid_subject(aws_send_message):
+@patch('watchbot_progress.utils.boto3_session')
+@patch('watchbot_progress.utils.aws_send_batch')
+def test_sns_worker_valid_subject(aws_send_batch, session):
     """ Should work as expected
     """
 
-    aws_send_message.side_effect = [True, True]
+    aws_send_batch.return_value = True
 
     messages = [
         {'content': 'this is a message'},
@@ -90,4 +225,69 @@ def test_sns_worker_valid_subject(aws_send_message):
     topic = "arn:aws:sns:my-region:00000000000:a-stack-0000XXXXXXX"
 
     assert utils.sns_worker(messages, topic, subject)
-    assert aws_send_message.call_count == 2
+    aws_send_batch.assert_called_once()
+    assert aws_send_batch.call_args[1].get('subject') == 'map'
+
+
+@patch('watchbot_progress.utils.time.time')
+def test_failed_job_cache(now):
+    """ Should ask the backend at most once per ttl
+    """
+    progress = Mock()
+    progress.is_failed.return_value = False
+    cache = utils.FailedJobCache(ttl=10)
+
+    now.return_value = 100
+    assert cache.is_failed(progress, 'a') is False
+    now.return_value = 109
+    assert cache.is_failed(progress, 'a') is False
+    assert progress.is_failed.call_count == 1
+
+    now.return_value = 111
+    progress.is_failed.return_value = True
+    assert cache.is_failed(progress, 'a') is True
+    assert progress.is_failed.call_count == 2
+
+    cache.mark_failed('b')
+    assert cache.is_failed(progress, 'b') is True
+    assert progress.is_failed.call_count == 2
+
+
+@patch('watchbot_progress.utils.time.time')
+def test_failed_job_cache_prune(now):
+    """ Should drop expired jobs once full
+    """
+    progress = Mock()
+    progress.is_failed.return_value = False
+    cache = utils.FailedJobCache(ttl=10, max_size=2)
+
+    now.return_value = 100
+    cache.is_failed(progress, 'a')
+    now.return_value = 105
+    cache.is_failed(progress, 'b')
+    now.return_value = 112
+    cache.is_failed(progress, 'c')
+    assert sorted(cache._jobs) == ['b', 'c']
+
+
+def test_progress_window():
+    """ Should measure rate and ETA across the window
+    """
+    window = utils.ProgressWindow(100, size=3)
+    assert window.add(100, now=0) is True
+    assert window.rate() == 0.0
+    assert window.eta() is None
+
+    assert window.add(90, now=10) is True
+    assert window.rate() == 1.0
+    assert window.eta() == 90.0
+
+    assert window.add(90, now=20) is False
+    assert window.stalled_for(now=25) == 15
+    assert window.add(80, now=30) is True
+    # the first sample has left the window
+    assert window.rate() == 0.5
+    assert window.eta() == 160.0
+
+    window.add(0, now=40)
+    assert window.eta() == 0.0
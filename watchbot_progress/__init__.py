@@ -1,3 +1,3 @@
-from watchbot_progress.main import create_job, Part, JobFailed
+from watchbot_progress.main import create_job, run_job, Part, Parts, JobFailed
 
-__all__ = ['create_job', 'Part', 'JobFailed']
+__all__ = ['create_job', 'run_job', 'Part', 'Parts', 'JobFailed']
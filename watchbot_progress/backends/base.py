@@ -3,6 +3,9 @@ from __future__ import division
 import abc
 import logging
 
+from watchbot_progress.errors import JobDoesNotExist
+from watchbot_progress.metrics import instrumented
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
@@ -29,10 +32,41 @@ class WatchbotProgressBase(ABC):
         dict, similar to JS watchbot-progress.status object
         """
 
+    @instrumented('remaining')
+    def remaining(self, jobid):
+        """Number of parts left in the job
+
+        Backends should override this with a read of only the remaining count.
+        """
+        return self.status(jobid)['remaining']
+
+    @instrumented('status_many', jobid=False)
+    def status_many(self, jobids):
+        """Get the status of many jobs
+
+        Backends should override this to read all statuses in a few round trips.
+
+        Returns
+        -------
+        list of status dicts, in the order of jobids.
+            Jobs which do not exist are skipped.
+        """
+        statuses = []
+        for jobid in jobids:
+            try:
+                statuses.append(self.status(jobid))
+            except JobDoesNotExist:
+                continue
+        return statuses
+
     @abc.abstractmethod
-    def set_total(self, jobid, parts):
+    def set_total(self, jobid, parts, callback=None):
         """ set total number of parts for the job
         Based on watchbot-progress.setTotal
+
+        parts is a count, or a sized collection of parts (see utils.part_count).
+        Backends which write the pending parts in chunks call
+        callback(done, total) after each one.
         """
 
     @abc.abstractmethod
@@ -41,6 +75,14 @@ class WatchbotProgressBase(ABC):
         Based on watchbot-progress.failJob
         """
 
+    @instrumented('is_failed')
+    def is_failed(self, jobid):
+        """Has the job been marked as failed?
+
+        Backends should override this with a read of only the failure flag.
+        """
+        return bool(self.status(jobid).get('failed'))
+
     @abc.abstractmethod
     def complete_part(self, jobid, partid):
         """Mark part as complete
@@ -51,6 +93,82 @@ class WatchbotProgressBase(ABC):
             Is the overall job completed yet?
         """
 
+    @instrumented('complete_parts')
+    def complete_parts(self, jobid, partids):
+        """Mark several parts as complete
+
+        Backends should override this to complete all parts in one write.
+
+        Returns
+        -------
+        dict
+            remaining: number of parts left in the job
+            complete: is the overall job completed yet?
+        """
+        all_done = False
+        for partid in partids:
+            all_done = self.complete_part(jobid, partid)
+        remaining = 0 if all_done else self.status(jobid).get('remaining')
+        return {'remaining': remaining, 'complete': all_done}
+
+    @instrumented('claim_reduce')
+    def claim_reduce(self, jobid):
+        """Claim the right to send the reduce message for a job
+
+        Backends should override this with an atomic operation
+        so that exactly one caller claims each job.
+
+        Returns
+        -------
+        dict or None
+            The job metadata if this caller claimed the reduce,
+            None if it had already been claimed
+        """
+        metadata = self.status(jobid).get('metadata', {})
+        if metadata.get('reduce_message_sent', False):
+            return None
+        self.set_metadata(jobid, {'reduce_message_sent': True})
+        return metadata
+
+    @instrumented('release_reduce')
+    def release_reduce(self, jobid):
+        """Give up a reduce claim, e.g. when the reduce message could not be sent
+        """
+        self.set_metadata(jobid, {'reduce_message_sent': False})
+
+    @instrumented('complete_part_and_claim_reduce')
+    def complete_part_and_claim_reduce(self, jobid, partid):
+        """Mark part as complete and, if the job is done, claim the reduce
+
+        Returns
+        -------
+        tuple (boolean, dict or None)
+            Is the overall job completed yet? And the job metadata
+            if this caller claimed the reduce, otherwise None
+        """
+        all_done = self.complete_part(jobid, partid)
+        if not all_done:
+            return False, None
+        return True, self.claim_reduce(jobid)
+
+    @instrumented('complete_parts_and_claim_reduce')
+    def complete_parts_and_claim_reduce(self, jobid, partids):
+        """Mark several parts as complete and, if the job is done, claim the reduce
+
+        Backends which delete finished jobs must override this
+        to claim the reduce before the job is deleted.
+
+        Returns
+        -------
+        tuple (boolean, dict or None)
+            Is the overall job completed yet? And the job metadata
+            if this caller claimed the reduce, otherwise None
+        """
+        res = self.complete_parts(jobid, partids)
+        if not res['complete']:
+            return False, None
+        return True, self.claim_reduce(jobid)
+
     @abc.abstractmethod
     def set_metadata(self, jobid, metadata):
         """Associate arbitrary metadata with a particular map-reduce job
@@ -62,9 +180,106 @@ class WatchbotProgressBase(ABC):
         """
 
     @abc.abstractmethod
-    def list_jobs(self, status=True):
+    def list_jobs(self, status=True, active_only=False, jobids=None):
         """Lists of all jobs in the database
 
         If status is True, the returned items will be the full status dictionary of each job
         If status is False, the items will be job ids only
+        If active_only is True, only jobs with remaining parts are listed
+        If jobids are given, only those jobs are listed, see _list_given_jobs
         """
+
+    def _list_given_jobs(self, jobids, status=True, active_only=False):
+        """List the given jobs which exist, with a single status_many call"""
+        for data in self.status_many(jobids):
+            if active_only and not data['remaining'] > 0:
+                continue
+            yield data if status else data['jobid']
+
+
+class LocalProgressMixin(object):
+    """Part completion shared by the single-host backends, memory, sqlite and shared
+
+    Backends implement _complete, which removes parts and claims the reduce
+    in one atomic step, under a lock or in a transaction, and have a
+    delete_when_done attribute. A finished job is only deleted once the
+    reduce has been claimed.
+    """
+
+    def _complete(self, jobid, partids, claim):
+        """Remove pending parts and, if claim and none remain, claim the reduce
+
+        Returns
+        -------
+        tuple (integer, dict or None)
+            The number of remaining parts, and the job metadata
+            if the reduce was claimed
+        """
+        raise NotImplementedError
+
+    def _done(self, jobid, remaining):
+        if remaining == 0 and self.delete_when_done:
+            self.delete(jobid)
+
+    @instrumented('complete_part')
+    def complete_part(self, jobid, partid):
+        """Mark part as complete
+
+        Returns
+        -------
+        boolean
+            Is the overall job completed yet?
+        """
+        remaining, _ = self._complete(jobid, [partid], claim=False)
+        self._done(jobid, remaining)
+        return remaining == 0
+
+    @instrumented('complete_parts')
+    def complete_parts(self, jobid, partids):
+        """Mark several parts as complete, atomically
+
+        Returns
+        -------
+        dict
+            remaining: number of parts left in the job
+            complete: is the overall job completed yet?
+        """
+        remaining, _ = self._complete(jobid, partids, claim=False)
+        self._done(jobid, remaining)
+        return {'remaining': remaining, 'complete': remaining == 0}
+
+    @instrumented('complete_part_and_claim_reduce')
+    def complete_part_and_claim_reduce(self, jobid, partid):
+        """Mark part as complete and, if the job is done, claim the reduce
+
+        Both happen atomically.
+
+        Returns
+        -------
+        tuple (boolean, dict or None)
+            Is the overall job completed yet? And the job metadata
+            if this caller claimed the reduce, otherwise None
+        """
+        return self._complete_and_claim(jobid, [partid])
+
+    @instrumented('complete_parts_and_claim_reduce')
+    def complete_parts_and_claim_reduce(self, jobid, partids):
+        """Mark several parts as complete and, if the job is done, claim the reduce
+
+        Both happen atomically.
+
+        Returns
+        -------
+        tuple (boolean, dict or None)
+            Is the overall job completed yet? And the job metadata
+            if this caller claimed the reduce, otherwise None
+        """
+        return self._complete_and_claim(jobid, partids)
+
+    def _complete_and_claim(self, jobid, partids):
+        """Remove parts and claim the reduce, before any delete"""
+        remaining, metadata = self._complete(jobid, partids, claim=True)
+        if remaining:
+            return False, None
+        self._done(jobid, remaining)
+        return True, metadata
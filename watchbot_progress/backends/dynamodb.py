@@ -1,16 +1,45 @@
 from __future__ import division
 
+from concurrent import futures
 import logging
+import math
 import os
+import time
 
 import boto3
+from botocore.exceptions import ClientError
 
+from watchbot_progress import metrics
 from watchbot_progress.backends.base import WatchbotProgressBase
 from watchbot_progress.errors import JobDoesNotExist
+from watchbot_progress.metrics import instrumented
+from watchbot_progress.utils import chunker, part_count
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Everything status needs, leaving the (potentially huge) parts set on the server
+STATUS_ATTRIBUTES = ('total', 'remaining', 'shards', 'error', 'metadata', 'reduceSent')
+
+# Sparse global secondary index of the jobs with remaining parts,
+# keyed on an attribute which is removed when the last part is completed
+ACTIVE_INDEX = 'active-jobs'
+ACTIVE_ATTRIBUTE = 'active'
+
+# Parts removed per update, keeping the condition expression well under 4KB
+MAX_PARTS_PER_UPDATE = 50
+
+# Parts added to the parts set per update by set_total
+SET_TOTAL_CHUNK = 10000
+
+
+def _projection(*attributes):
+    """ProjectionExpression keyword arguments for the given attribute names"""
+    names = ['#a{}'.format(i) for i in range(len(attributes))]
+    return dict(
+        ProjectionExpression=', '.join(names),
+        ExpressionAttributeNames=dict(zip(names, attributes)))
+
 
 class DynamoProgress(WatchbotProgressBase):
     """Sets up objects for reduce mode job tracking with SNS and DynamoDB
@@ -20,7 +49,23 @@ class DynamoProgress(WatchbotProgressBase):
     https://github.com/mapbox/watchbot-progress
     """
 
-    def __init__(self, table_arn=None, topic_arn=None):
+    def __init__(self, table_arn=None, topic_arn=None, shards=None, active_index=ACTIVE_INDEX):
+        """DynamoDB-backed progress object
+
+        Parameters
+        ----------
+        table_arn
+        topic_arn
+        shards: optional integer, spread the pending parts of each job
+            across this many items. Required for jobs whose parts do not fit
+            in a single 400KB item, and spreads completion writes across
+            partition keys. Completions are routed by the shard count of
+            the job itself, but a client without shards cannot complete
+            the parts of a sharded job.
+        active_index: optional string, name of the sparse global secondary
+            index on the active attribute (see scripts/create.py), which
+            list_jobs(active_only=True) queries. None to scan the table instead.
+        """
         # SNS Topic
         self.topic = topic_arn if topic_arn else os.environ['WorkTopic']
 
@@ -30,7 +75,36 @@ class DynamoProgress(WatchbotProgressBase):
             self.table = self.table_arn.split(':table/')[-1]  # just name
         self.dynamodb = boto3.resource('dynamodb')
         self.db = self.dynamodb.Table(self.table)
+        self.shards = shards
+        self.active_index = active_index
+        self._has_active_index = None
+
+    def _shard_key(self, jobid, shard):
+        return '{}#shard-{}'.format(jobid, shard)
+
+    def _shard_keys(self, jobid, shards):
+        return [{'id': self._shard_key(jobid, shard)} for shard in range(shards)]
+
+    def _batch_get(self, keys, **kwargs):
+        """Strongly consistent BatchGetItem over any number of keys
 
+        Requests up to 100 keys at a time and retries unprocessed keys.
+        """
+        items = []
+        for i in range(0, len(keys), 100):
+            request = {self.table: dict(Keys=keys[i:i + 100], ConsistentRead=True, **kwargs)}
+            attempt = 0
+            while request:
+                metrics.round_trip()
+                res = self.dynamodb.batch_get_item(RequestItems=request)
+                items.extend(res['Responses'].get(self.table, []))
+                request = res.get('UnprocessedKeys')
+                if request:
+                    time.sleep(min(0.05 * 2 ** attempt, 1))
+                    attempt += 1
+        return items
+
+    @instrumented('status')
     def status(self, jobid, part=None):
         """get status from dynamodb
 
@@ -43,14 +117,95 @@ class DynamoProgress(WatchbotProgressBase):
         -------
         dict, similar to JS watchbot-progress.status object
         """
-        res = self.db.get_item(Key={'id': jobid}, ConsistentRead=True)
+        metrics.round_trip()
+        res = self.db.get_item(
+            Key={'id': jobid}, ConsistentRead=True, **_projection(*STATUS_ATTRIBUTES))
         item = res['Item']
-        remaining = len(item['parts']) if 'parts' in item else 0
-        percent = (item['total'] - remaining) / item['total']
+
+        if part is not None:
+            # js implementation
+            # if (part) response.partComplete =
+            # item.parts ? item.parts.values.indexOf(part) === -1 : true;
+            raise NotImplementedError()  # todo
+
+        return self._item_status(jobid, item, self._remaining(jobid, item))
+
+    @instrumented('remaining')
+    def remaining(self, jobid):
+        """Number of parts left in the job
+
+        An eventually consistent read of only the remaining count.
+        """
+        metrics.round_trip()
+        res = self.db.get_item(Key={'id': jobid}, **_projection('remaining', 'shards'))
+        if 'Item' not in res:
+            raise JobDoesNotExist('jobid {} does not exist'.format(jobid))
+        return self._remaining(jobid, res['Item'])
+
+    @instrumented('status_many', jobid=False)
+    def status_many(self, jobids):
+        """Status of many jobs, read with BatchGetItem
+
+        One request per 100 jobs, plus one per 100 shards of sharded jobs.
+
+        Returns
+        -------
+        list of status dicts, in the order of jobids.
+            Jobs which do not exist are skipped.
+        """
+        jobids = list(jobids)
+        unique = sorted(set(jobids))
+        items = dict((item['id'], item) for item in self._batch_get(
+            [{'id': jobid} for jobid in unique], **_projection('id', *STATUS_ATTRIBUTES)))
+
+        shard_keys = [key for item in items.values() if 'shards' in item
+                      for key in self._shard_keys(item['id'], int(item['shards']))]
+        shard_remaining = {}
+        if shard_keys:
+            projection = _projection('id', 'shardOf', 'remaining')
+            for shard in self._batch_get(shard_keys, **projection):
+                jobid = shard['shardOf']
+                shard_remaining[jobid] = shard_remaining.get(jobid, 0) + int(shard['remaining'])
+
+        statuses = []
+        for jobid in jobids:
+            item = items.get(jobid)
+            if item is None:
+                continue
+            if 'shards' in item:
+                remaining = shard_remaining.get(jobid, 0)
+            else:
+                remaining = self._remaining(jobid, item)
+            statuses.append(self._item_status(jobid, item, remaining))
+        return statuses
+
+    def _remaining(self, jobid, item):
+        """Remaining parts of a job, given its status attributes"""
+        if 'shards' in item:
+            shards = self._batch_get(
+                self._shard_keys(jobid, int(item['shards'])), **_projection('remaining'))
+            remaining = sum(int(shard['remaining']) for shard in shards)
+        elif 'remaining' in item:
+            remaining = int(item['remaining'])
+        else:
+            # jobs created before the remaining count was maintained
+            metrics.round_trip()
+            res = self.db.get_item(
+                Key={'id': jobid}, ConsistentRead=True, **_projection('parts'))
+            parts = res['Item'].get('parts')
+            remaining = len(parts) if parts else 0
+        return remaining
+
+    def _item_status(self, jobid, item, remaining):
+        """Status dict from a job's status attributes and remaining part count"""
+        total = int(item['total'])
+        percent = (total - remaining) / total
 
         data = {
             'jobid': jobid,
-            'progress': percent}
+            'progress': percent,
+            'total': total,
+            'remaining': remaining}
 
         if 'error' in item:
             # failure must have a 'failed' key
@@ -60,42 +215,122 @@ class DynamoProgress(WatchbotProgressBase):
         if 'reduceSent' in item:
             data['reduceSent'] = item['reduceSent']
 
-        if part is not None:
-            # js implementation
-            # if (part) response.partComplete =
-            # item.parts ? item.parts.values.indexOf(part) === -1 : true;
-            raise NotImplementedError()  # todo
-
         return data
 
-    def set_total(self, jobid, parts):
+    @instrumented('set_total')
+    def set_total(self, jobid, parts, callback=None):
         """ set total number of parts for the job
 
         Based on watchbot-progress.setTotal
+
+        parts is a count or a sized collection of parts. The parts set is
+        written SET_TOTAL_CHUNK partids per request, calling
+        callback(done, total) after each one.
+        """
+        total = part_count(parts)
+        if self.shards:
+            return self._set_total_sharded(jobid, total, callback)
+
+        stop = min(SET_TOTAL_CHUNK, total)
+        names = {
+            '#p': 'parts',
+            '#t': 'total',
+            '#r': 'remaining',
+            '#a': ACTIVE_ATTRIBUTE}
+        values = {':t': total, ':a': 1}
+        if stop:
+            values[':p'] = set(range(stop))
+            expression = 'set #p = :p, #t = :t, #r = :t, #a = :a'
+        else:
+            # DynamoDB sets cannot be empty
+            expression = 'set #t = :t, #r = :t, #a = :a remove #p'
+        metrics.round_trip()
+        res = self.db.update_item(
+            Key={'id': jobid},
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            UpdateExpression=expression)
+        if stop and callback is not None:
+            callback(stop, total)
+
+        for start in range(stop, total, SET_TOTAL_CHUNK):
+            stop = min(start + SET_TOTAL_CHUNK, total)
+            metrics.round_trip()
+            self.db.update_item(
+                Key={'id': jobid},
+                ExpressionAttributeNames={'#p': 'parts'},
+                ExpressionAttributeValues={':p': set(range(start, stop))},
+                UpdateExpression='add #p :p')
+            if callback is not None:
+                callback(stop, total)
+        return res
+
+    def _set_total_sharded(self, jobid, total, callback=None):
+        """Write one item per shard, then the job header item
+
+        Part ``n`` lives on shard ``n % shards``. Shards left empty by a small
+        job are counted as done up front.
         """
-        total = len(parts)
+        empty = 0
+        done = 0
+        # BatchWriteItem writes up to 25 items per request
+        metrics.round_trip(count=int(math.ceil(self.shards / 25)))
+        with self.db.batch_writer() as batch:
+            for shard in range(self.shards):
+                partids = set(range(shard, total, self.shards))
+                item = {
+                    'id': self._shard_key(jobid, shard),
+                    'shardOf': jobid,
+                    'remaining': len(partids)}
+                if partids:
+                    item['parts'] = partids
+                else:
+                    empty += 1
+                batch.put_item(Item=item)
+                done += len(partids)
+                if partids and callback is not None:
+                    callback(done, total)
+
+        metrics.round_trip()
         return self.db.update_item(
             Key={'id': jobid},
             ExpressionAttributeNames={
-                '#p': 'parts',
-                '#t': 'total'},
+                '#t': 'total',
+                '#s': 'shards',
+                '#d': 'shardsDone',
+                '#a': ACTIVE_ATTRIBUTE},
             ExpressionAttributeValues={
-                ':p': set(range(total)),
-                ':t': total},
-            UpdateExpression='set #p = :p, #t = :t')
+                ':t': total,
+                ':s': self.shards,
+                ':d': empty,
+                ':a': 1},
+            UpdateExpression='set #t = :t, #s = :s, #d = :d, #a = :a')
 
+    @instrumented('fail_job')
     def fail_job(self, jobid, reason):
         """fail the job, notify dynamodb
 
         Based on watchbot-progress.failJob
         """
         logger.error('[fail_job] {} failed because {}.'.format(jobid, reason))
+        metrics.round_trip()
         self.db.update_item(
             Key={'id': jobid},
             ExpressionAttributeNames={'#e': 'error'},
             ExpressionAttributeValues={':e': reason},
             UpdateExpression='set #e = :e')
 
+    @instrumented('is_failed')
+    def is_failed(self, jobid):
+        """Has the job been marked as failed?
+
+        An eventually consistent read of only the error attribute.
+        """
+        metrics.round_trip()
+        res = self.db.get_item(Key={'id': jobid}, **_projection('error'))
+        return 'error' in res.get('Item', {})
+
+    @instrumented('complete_part')
     def complete_part(self, jobid, partid):
         """Mark part as complete
 
@@ -104,12 +339,196 @@ class DynamoProgress(WatchbotProgressBase):
         boolean
             Is the overall job completed yet?
         """
+        if self.shards:
+            return self._complete_part_sharded(jobid, partid, self.shards)
+        return self._complete_part_unsharded(jobid, partid)
+
+    def _complete_part_unsharded(self, jobid, partid):
+        """Remove the part from the job item, counting down its remaining parts
+        """
+        finished = self._remove_part({'id': jobid}, partid)
+        if finished is not None:
+            if finished:
+                self._deactivate(jobid)
+            return finished
+
+        # part was already complete, or the job has no remaining count
+        metrics.round_trip()
+        res = self.db.get_item(
+            Key={'id': jobid}, ConsistentRead=True, **_projection('remaining', 'shards'))
+        item = res.get('Item', {})
+        self._check_unsharded(jobid, item)
+        if 'remaining' in item:
+            return item['remaining'] <= 0
+        return self._complete_part_legacy(jobid, partid)
+
+    def _check_unsharded(self, jobid, item):
+        """Raise if the job header of a client without shards is sharded"""
+        if 'shards' in item:
+            raise ValueError(
+                'Job {} is sharded, use DynamoProgress(shards={})'.format(
+                    jobid, int(item['shards'])))
+
+    def _remove_part(self, key, partid):
+        """Remove a pending part from an item and count down its remaining parts
+
+        Returns
+        -------
+        boolean or None
+            Did this call finish the item? None if the part was not pending
+        """
+        return self._remove_parts(key, [partid])
+
+    def _remove_parts(self, key, partids):
+        """Remove pending parts from an item and count down its remaining parts
+
+        The update modifies the parts set, so any updated values returned
+        would include the whole set. Nothing is returned; instead the update
+        is conditional on parts remaining afterwards and, failing that, on
+        none remaining, which only succeeds for the caller finishing the item.
+        Both conditions require every part to still be pending, so repeated
+        completions are not counted. If some were not, the parts are removed
+        one at a time.
+
+        Returns
+        -------
+        boolean or None
+            Did this call finish the item? None if none of the parts were pending
+        """
+        ids = dict((':id{}'.format(i), partid) for i, partid in enumerate(partids))
+        values = dict(ids)
+        values.update({':p': set(partids), ':n': -len(partids), ':c': len(partids)})
+        pending = ' and '.join('contains(#p, {})'.format(name) for name in sorted(ids))
+        for finished, count in ((False, '#r > :c'), (True, '#r = :c')):
+            try:
+                metrics.round_trip()
+                self.db.update_item(
+                    Key=key,
+                    ExpressionAttributeNames={'#p': 'parts', '#r': 'remaining'},
+                    ExpressionAttributeValues=values,
+                    ConditionExpression='{} and {}'.format(pending, count),
+                    UpdateExpression='delete #p :p add #r :n',
+                    ReturnValues='NONE')
+                return finished
+            except ClientError as err:
+                if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        if len(partids) == 1:
+            return None
+        results = [self._remove_parts(key, [partid]) for partid in partids]
+        results = [r for r in results if r is not None]
+        return any(results) if results else None
+
+    @instrumented('complete_parts')
+    def complete_parts(self, jobid, partids):
+        """Mark several parts as complete
+
+        Parts are removed with one update per item (per shard if sharded)
+        for up to 50 parts at a time.
+
+        Returns
+        -------
+        dict
+            remaining: number of parts left in the job
+            complete: is the overall job completed yet?
+        """
+        partids = sorted(set(partids))
+        if self.shards:
+            return self._complete_parts_sharded(jobid, partids)
+        return self._complete_parts_unsharded(jobid, partids)
+
+    def _complete_parts_unsharded(self, jobid, partids):
+        """Remove parts from the job item, counting down its remaining parts
+        """
+        results = [self._remove_parts({'id': jobid}, chunk)
+                   for chunk in chunker(partids, MAX_PARTS_PER_UPDATE)]
+        if any(results):
+            self._deactivate(jobid)
+            remaining = 0
+        else:
+            # parts remain, were already complete, or the job has no remaining count
+            metrics.round_trip()
+            res = self.db.get_item(
+                Key={'id': jobid}, ConsistentRead=True, **_projection('remaining', 'shards'))
+            item = res.get('Item', {})
+            self._check_unsharded(jobid, item)
+            if 'remaining' not in item:
+                return super(DynamoProgress, self).complete_parts(jobid, partids)
+            remaining = int(item['remaining'])
+        return {'remaining': remaining, 'complete': remaining <= 0}
+
+    def _complete_parts_sharded(self, jobid, partids):
+        """Remove parts from their shards, counting finished shards on the job header
+
+        Parts are routed by the shard count of the job header, which a
+        client with another shards setting does not share.
+        """
+        metrics.round_trip()
+        res = self.db.get_item(Key={'id': jobid}, ConsistentRead=True, **_projection('shards'))
+        item = res.get('Item', {})
+        if 'shards' not in item:
+            return self._complete_parts_unsharded(jobid, partids)
+        shards = int(item['shards'])
+
+        by_shard = {}
+        for partid in partids:
+            by_shard.setdefault(partid % shards, []).append(partid)
+
+        finished = 0
+        for shard, shard_partids in sorted(by_shard.items()):
+            key = {'id': self._shard_key(jobid, shard)}
+            results = [self._remove_parts(key, chunk)
+                       for chunk in chunker(shard_partids, MAX_PARTS_PER_UPDATE)]
+            # only the caller whose decrement emptied the shard finishes it
+            if any(results):
+                finished += 1
+
+        if finished:
+            self._finish_shards(jobid, finished)
+
+        items = self._batch_get(self._shard_keys(jobid, shards), **_projection('remaining'))
+        remaining = sum(int(shard['remaining']) for shard in items)
+        return {'remaining': remaining, 'complete': remaining == 0}
+
+    def _finish_shards(self, jobid, count):
+        """Count shards emptied by this caller as done on the job header
+
+        Returns
+        -------
+        boolean
+            Are all of the job's shards done?
+        """
+        metrics.round_trip()
         res = self.db.update_item(
             Key={'id': jobid},
-            ExpressionAttributeNames={'#p': 'parts'},
-            ExpressionAttributeValues={':p': set([partid])},
-            UpdateExpression='delete #p :p',
+            ExpressionAttributeNames={'#d': 'shardsDone'},
+            ExpressionAttributeValues={':n': count},
+            UpdateExpression='add #d :n',
             ReturnValues='ALL_NEW')
+        header = res['Attributes']
+        if header['shardsDone'] >= header['shards']:
+            self._deactivate(jobid)
+            return True
+        return False
+
+    def _complete_part_legacy(self, jobid, partid):
+        """Mark part as complete on a job created without a remaining count
+
+        A sharded job's header has no parts, so it would look complete.
+        """
+        try:
+            metrics.round_trip()
+            res = self.db.update_item(
+                Key={'id': jobid},
+                ExpressionAttributeNames={'#p': 'parts', '#s': 'shards'},
+                ExpressionAttributeValues={':p': set([partid])},
+                ConditionExpression='attribute_not_exists(#s)',
+                UpdateExpression='delete #p :p',
+                ReturnValues='ALL_NEW')
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            raise ValueError('Job {} is sharded, use DynamoProgress(shards=N)'.format(jobid))
 
         record = res['Attributes']
         if 'parts' in record and len(record['parts']) > 0:
@@ -118,9 +537,99 @@ class DynamoProgress(WatchbotProgressBase):
             complete = True
         return complete
 
+    def _complete_part_sharded(self, jobid, partid, shards):
+        """Remove the part from its shard, counting down the shard's remaining parts
+
+        Each shard reaches zero exactly once and the worker that gets it there
+        counts it as done on the job header. The part is first looked for on
+        its shard of ``shards``. A part is only removed from the shard holding
+        it, so if it was not found there and the job header has another shard
+        count, or none, the part is routed by the job's own.
+        """
+        finished = self._remove_part(
+            {'id': self._shard_key(jobid, partid % shards)}, partid)
+        if finished is None:
+            # part was already complete, or the job is not sharded this way
+            metrics.round_trip()
+            res = self.db.get_item(
+                Key={'id': jobid}, ConsistentRead=True, **_projection('shards', 'shardsDone'))
+            item = res.get('Item', {})
+            if 'shards' not in item:
+                return self._complete_part_unsharded(jobid, partid)
+            if int(item['shards']) != shards:
+                return self._complete_part_sharded(jobid, partid, int(item['shards']))
+            return item['shardsDone'] >= item['shards']
+
+        if not finished:
+            return False
+        return self._finish_shards(jobid, 1)
+
+    def _deactivate(self, jobid):
+        """Drop a job with no remaining parts from the active jobs index"""
+        metrics.round_trip()
+        self.db.update_item(
+            Key={'id': jobid},
+            ExpressionAttributeNames={'#a': ACTIVE_ATTRIBUTE},
+            UpdateExpression='remove #a')
+
+    def rebuild_active_index(self, segments=1):
+        """Mark the active jobs found by scanning the whole table
+
+        For jobs created before the active attribute was maintained.
+        """
+        for data in self._list_jobs_scan(True, segments, active_only=True):
+            self.db.update_item(
+                Key={'id': data['jobid']},
+                ExpressionAttributeNames={'#a': ACTIVE_ATTRIBUTE},
+                ExpressionAttributeValues={':a': 1},
+                UpdateExpression='set #a = :a')
+
+    @instrumented('claim_reduce')
+    def claim_reduce(self, jobid):
+        """Claim the right to send the reduce message for a job
+
+        A conditional write on reduceSent, so exactly one caller succeeds.
+        The metadata is set to itself so that it comes back with UPDATED_NEW.
+
+        Returns
+        -------
+        dict or None
+            The job metadata if this caller claimed the reduce,
+            None if it had already been claimed
+        """
+        try:
+            metrics.round_trip()
+            res = self.db.update_item(
+                Key={'id': jobid},
+                ExpressionAttributeNames={
+                    '#s': 'reduceSent',
+                    '#t': 'total',
+                    '#m': 'metadata'},
+                ExpressionAttributeValues={':s': True, ':m': {}},
+                ConditionExpression='attribute_exists(#t) and attribute_not_exists(#s)',
+                UpdateExpression='set #s = :s, #m = if_not_exists(#m, :m)',
+                ReturnValues='UPDATED_NEW')
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return None
+        return res['Attributes'].get('metadata', {})
+
+    @instrumented('release_reduce')
+    def release_reduce(self, jobid):
+        """Give up a reduce claim, e.g. when the reduce message could not be sent
+        """
+        metrics.round_trip()
+        self.db.update_item(
+            Key={'id': jobid},
+            ExpressionAttributeNames={'#s': 'reduceSent'},
+            UpdateExpression='remove #s')
+
+    @instrumented('set_metadata')
     def set_metadata(self, jobid, metadata):
         """Associate arbitrary metadata with a particular map-reduce job
         """
+        metrics.round_trip()
         self.db.update_item(
             Key={'id': jobid},
             ExpressionAttributeNames={'#m': 'metadata'},
@@ -132,24 +641,161 @@ class DynamoProgress(WatchbotProgressBase):
         """
         raise NotImplementedError("delete not implemented for dynamodb yet")
 
+    @instrumented('list_pending_parts')
     def list_pending_parts(self, jobid):
         """Pending (incomplete) part numbers for a given jobid
         """
+        metrics.round_trip()
         res = self.db.get_item(Key={'id': jobid}, ConsistentRead=True)
         if 'Error' in res or 'Item' not in res:
             raise JobDoesNotExist('jobid {} does not exist')
-        pending = res['Item'].get('parts', [])
+        item = res['Item']
+        if 'shards' in item:
+            shards = self._batch_get(
+                self._shard_keys(jobid, int(item['shards'])), **_projection('parts'))
+            pending = [p for shard in shards for p in shard.get('parts', [])]
+            return sorted(int(p) for p in pending)
+        pending = item.get('parts', [])
         return [int(p) for p in pending]
 
-    def list_jobs(self, status=True):
+    def _scan_kwargs(self, segment, segments, attributes):
+        """Scan parameters for job items of one segment of the table"""
+        kwargs = _projection(*attributes)
+        kwargs['ExpressionAttributeNames']['#shard'] = 'shardOf'
+        kwargs['FilterExpression'] = 'attribute_not_exists(#shard)'
+        if segments > 1:
+            kwargs.update(Segment=segment, TotalSegments=segments)
+        return kwargs
+
+    def _scan_page(self, kwargs):
+        """Scan one page of the table"""
+        metrics.round_trip()
+        return self.db.scan(ConsistentRead=True, **kwargs)
+
+    def _scan_segment(self, segment, segments, attributes):
+        """Scan every page of one segment of the table for job items"""
+        kwargs = self._scan_kwargs(segment, segments, attributes)
+        while True:
+            res = self._scan_page(kwargs)
+            for item in res['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in res:
+                break
+            kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+    def _scan_segments(self, segments, attributes):
+        """Scan every page of parallel segments of the table for job items
+
+        Each segment has one page request in flight. Items are yielded a page
+        at a time, as pages arrive, and a segment's next page is requested
+        before its items are yielded, so at most two pages per segment are
+        held in memory.
+        """
+        with futures.ThreadPoolExecutor(max_workers=segments) as executor:
+            pending = {}
+            for segment in range(segments):
+                kwargs = self._scan_kwargs(segment, segments, attributes)
+                pending[executor.submit(self._scan_page, kwargs)] = kwargs
+            while pending:
+                done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    kwargs = pending.pop(future)
+                    res = future.result()
+                    if 'LastEvaluatedKey' in res:
+                        kwargs = dict(kwargs, ExclusiveStartKey=res['LastEvaluatedKey'])
+                        pending[executor.submit(self._scan_page, kwargs)] = kwargs
+                    for item in res['Items']:
+                        yield item
+
+    def _use_active_index(self):
+        """Does the table have the active jobs index? Checked once"""
+        if not self.active_index:
+            return False
+        if self._has_active_index is None:
+            try:
+                indexes = self.db.global_secondary_indexes or []
+            except ClientError as err:
+                logger.warning('could not describe table {}: {}'.format(self.table, err))
+                indexes = []
+            self._has_active_index = any(
+                index['IndexName'] == self.active_index for index in indexes)
+            if not self._has_active_index:
+                logger.warning('table {} has no {} index, scanning for active jobs'.format(
+                    self.table, self.active_index))
+        return self._has_active_index
+
+    def _query_active(self):
+        """Yields pages of jobids from the active jobs index"""
+        kwargs = dict(
+            IndexName=self.active_index,
+            ExpressionAttributeNames={'#a': ACTIVE_ATTRIBUTE},
+            ExpressionAttributeValues={':a': 1},
+            KeyConditionExpression='#a = :a')
+        while True:
+            metrics.round_trip()
+            res = self.db.query(**kwargs)
+            yield [item['id'] for item in res['Items']]
+            if 'LastEvaluatedKey' not in res:
+                break
+            kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+    def _list_active_jobs(self, status):
+        """Jobs with remaining parts, read from the active jobs index
+
+        The index is eventually consistent, so the statuses of each page of
+        jobs are read with status_many and jobs completed since are skipped.
+        """
+        for jobids in self._query_active():
+            if not status:
+                for jobid in jobids:
+                    yield jobid
+                continue
+
+            for data in self.status_many(jobids):
+                if data['remaining'] > 0:
+                    yield data
+
+    def _status_from_item(self, item):
+        """Status of a job from its scanned or batch read status attributes"""
+        if 'shards' in item or 'remaining' not in item:
+            return self.status(item['id'])
+        return self._item_status(item['id'], item, int(item['remaining']))
+
+    def _list_jobs_scan(self, status, segments, active_only):
+        """Jobs found by scanning the whole table"""
+        read_status = status or active_only
+        attributes = ('id',) + STATUS_ATTRIBUTES if read_status else ('id',)
+        if segments > 1:
+            items = self._scan_segments(segments, attributes)
+        else:
+            items = self._scan_segment(0, 1, attributes)
+
+        for item in items:
+            if not read_status:
+                yield item['id']
+                continue
+            data = self._status_from_item(item)
+            if active_only and not data['remaining'] > 0:
+                continue
+            yield data if status else data['jobid']
+
+    def list_jobs(self, status=True, active_only=False, jobids=None, segments=1):
         """Lists of all jobs in the database
 
         If status is True, the returned items will be the full status dictionary of each job
         If status is False, the items will be job ids only
+        If active_only is True, only jobs with remaining parts are listed
+        If jobids are given, only those jobs are listed, read with status_many
+
+        Active jobs are read from the active jobs index, if there is one.
+        Otherwise the scan follows every page and, with segments > 1, runs
+        that many parallel scan segments. Only the status attributes are
+        read, never the parts sets, and statuses are built from the scanned
+        items. Sharded jobs and jobs without a remaining count need a
+        follow-up read.
         """
-        scan = self.db.scan(ConsistentRead=True)
-        for s in scan['Items']:
-            if status:
-                yield self.status(s['id'])
-            else:
-                yield s['id']
+        if jobids is not None:
+            return self._list_given_jobs(jobids, status, active_only)
+        if active_only and self._use_active_index():
+            return self._list_active_jobs(status)
+        return self._list_jobs_scan(status, segments, active_only)
@@ -0,0 +1,180 @@
+from __future__ import division
+
+import logging
+import threading
+
+from watchbot_progress.backends.base import WatchbotProgressBase
+from watchbot_progress.metrics import instrumented
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class _PendingPart(object):
+    """A complete_part call waiting for its batch to be written"""
+
+    __slots__ = ('jobid', 'partid', 'claim', 'done', 'complete', 'metadata', 'error')
+
+    def __init__(self, jobid, partid, claim=False):
+        self.jobid = jobid
+        self.partid = partid
+        self.claim = claim
+        self.done = threading.Event()
+        self.complete = None
+        self.metadata = None
+        self.error = None
+
+
+class GroupCommitProgress(WatchbotProgressBase):
+    """Coalesces complete_part calls from many threads into batched writes
+
+    Wraps any other progress object. Each complete_part call is queued and
+    written with complete_parts, together with the calls made by other
+    threads, once max_batch calls are queued or the oldest has waited
+    max_delay seconds. The caller blocks until its own part has been written.
+    There is no background thread; whichever caller fills the batch, or
+    times out first, writes it.
+    """
+
+    def __init__(self, progress, max_batch=100, max_delay=0.005):
+        """Group commit progress object
+
+        Parameters
+        ----------
+        progress: WatchbotProgressBase, the backend to write to
+        max_batch: integer, most parts written at once
+        max_delay: float, seconds a part waits for others to join its batch
+        """
+        self.progress = progress
+        self.topic = progress.topic
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._queue = []
+
+    def _take(self):
+        """Take the queued parts, must be called with the lock held"""
+        batch, self._queue = self._queue, []
+        return batch
+
+    def _write(self, batch):
+        """Complete a batch of parts, one call per job
+
+        If any of a job's parts want the reduce, the batch is written with
+        complete_parts_and_claim_reduce so that the reduce is claimed before
+        a finished job can be deleted, and the first of them gets the claim.
+        Only that caller sees a finished job as complete, as if its part
+        had been the last one written.
+        """
+        jobs = {}
+        for pending in batch:
+            jobs.setdefault(pending.jobid, []).append(pending)
+
+        for jobid, pendings in jobs.items():
+            partids = [p.partid for p in pendings]
+            claimers = [p for p in pendings if p.claim]
+            finisher = claimers[0] if claimers else pendings[0]
+            try:
+                if claimers:
+                    complete, finisher.metadata = \
+                        self.progress.complete_parts_and_claim_reduce(jobid, partids)
+                else:
+                    complete = self.progress.complete_parts(jobid, partids)['complete']
+            except Exception as err:
+                for pending in pendings:
+                    pending.error = err
+            else:
+                for pending in pendings:
+                    pending.complete = complete and pending is finisher
+            finally:
+                for pending in pendings:
+                    pending.done.set()
+
+    @instrumented('complete_part')
+    def complete_part(self, jobid, partid):
+        """Mark part as complete, batched with other threads' parts
+
+        Returns
+        -------
+        boolean
+            Is the overall job completed yet?
+        """
+        return self._complete(_PendingPart(jobid, partid)).complete
+
+    @instrumented('complete_part_and_claim_reduce')
+    def complete_part_and_claim_reduce(self, jobid, partid):
+        """Mark part as complete, batched with other threads' parts,
+        and if the batch finishes the job, claim the reduce
+
+        Returns
+        -------
+        tuple (boolean, dict or None)
+            Is the overall job completed yet? And the job metadata
+            if this caller claimed the reduce, otherwise None
+        """
+        pending = self._complete(_PendingPart(jobid, partid, claim=True))
+        return pending.complete, pending.metadata
+
+    def _complete(self, pending):
+        """Queue a part and wait until its batch has been written"""
+        with self._lock:
+            self._queue.append(pending)
+            batch = self._take() if len(self._queue) >= self.max_batch else None
+
+        if batch:
+            self._write(batch)
+        elif not pending.done.wait(self.max_delay):
+            with self._lock:
+                batch = self._take()
+            if batch:
+                self._write(batch)
+            # our part may be in a batch being written by another thread
+            pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending
+
+    def complete_parts(self, jobid, partids):
+        """Mark several parts as complete, already a single write
+        """
+        return self.progress.complete_parts(jobid, partids)
+
+    def complete_parts_and_claim_reduce(self, jobid, partids):
+        return self.progress.complete_parts_and_claim_reduce(jobid, partids)
+
+    def status(self, jobid, part=None):
+        return self.progress.status(jobid, part=part)
+
+    def remaining(self, jobid):
+        return self.progress.remaining(jobid)
+
+    def status_many(self, jobids):
+        return self.progress.status_many(jobids)
+
+    def set_total(self, jobid, parts, callback=None):
+        return self.progress.set_total(jobid, parts, callback=callback)
+
+    def fail_job(self, jobid, reason):
+        return self.progress.fail_job(jobid, reason)
+
+    def is_failed(self, jobid):
+        return self.progress.is_failed(jobid)
+
+    def set_metadata(self, jobid, metadata):
+        return self.progress.set_metadata(jobid, metadata)
+
+    def claim_reduce(self, jobid):
+        return self.progress.claim_reduce(jobid)
+
+    def release_reduce(self, jobid):
+        return self.progress.release_reduce(jobid)
+
+    def delete(self, jobid):
+        return self.progress.delete(jobid)
+
+    def list_pending_parts(self, jobid):
+        return self.progress.list_pending_parts(jobid)
+
+    def list_jobs(self, status=True, active_only=False, jobids=None):
+        return self.progress.list_jobs(status=status, active_only=active_only, jobids=jobids)
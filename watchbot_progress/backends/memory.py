@@ -0,0 +1,254 @@
+from __future__ import division
+
+import itertools
+import logging
+import os
+import threading
+
+from watchbot_progress.backends.base import LocalProgressMixin, WatchbotProgressBase
+from watchbot_progress.errors import JobDoesNotExist
+from watchbot_progress.metrics import instrumented
+from watchbot_progress.utils import bitmap_members, part_count, pending_bitmap
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class _Job(object):
+    """A job's state, guarded by its own lock
+
+    Pending parts are a bitmap, one bit per part, most significant bit first.
+    """
+
+    __slots__ = ('lock', 'created', 'total', 'remaining', 'pending',
+                 'metadata', 'failed', 'error', 'reduce_sent')
+
+    def __init__(self, total, created):
+        self.lock = threading.Lock()
+        self.created = created
+        self.total = total
+        self.remaining = total
+        self.pending = bytearray(pending_bitmap(total))
+        self.metadata = {}
+        self.failed = False
+        self.error = None
+        self.reduce_sent = False
+
+    def is_pending(self, partid):
+        partid = int(partid)
+        if not 0 <= partid < self.total:
+            return False
+        return bool(self.pending[partid >> 3] & (0x80 >> (partid & 7)))
+
+    def remove(self, partids):
+        """Clear pending parts, must be called with the lock held"""
+        for partid in partids:
+            partid = int(partid)
+            if self.is_pending(partid):
+                self.pending[partid >> 3] &= ~(0x80 >> (partid & 7)) & 0xff
+                self.remaining -= 1
+        return self.remaining
+
+
+class MemoryProgress(LocalProgressMixin, WatchbotProgressBase):
+    """Tracks reduce mode jobs in the memory of a single process
+
+    For single host runs and tests. Every job has its own lock, so
+    threads working on different jobs do not contend.
+    """
+
+    def __init__(self, topic_arn=None, delete_when_done=False):
+        """In-memory progress object
+
+        Parameters
+        ----------
+        topic_arn: optional, defaults to the WorkTopic environment variable.
+            Not needed if reduce messages are handled by Part's on_reduce.
+        delete_when_done: boolean, delete jobs once all parts are complete
+        """
+        self.topic = topic_arn if topic_arn else os.environ.get('WorkTopic')
+        self.delete_when_done = delete_when_done
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._created = itertools.count()
+
+    def _job(self, jobid):
+        try:
+            return self._jobs[jobid]
+        except KeyError:
+            raise JobDoesNotExist('jobid {} does not exist'.format(jobid))
+
+    def _status(self, jobid, job):
+        with job.lock:
+            data = dict(
+                metadata=job.metadata.copy(),
+                jobid=jobid,
+                progress=(job.total - job.remaining) / job.total if job.total else 1.0,
+                total=job.total,
+                remaining=job.remaining,
+                failed=job.failed)
+            if job.error is not None:
+                data['error'] = job.error
+        return data
+
+    @instrumented('status')
+    def status(self, jobid, part=None):
+        """Get status
+
+        Parameters
+        ----------
+        jobid: string
+        part: optional int
+            return status of the given partid
+
+        Returns
+        -------
+        dict, similar to JS watchbot-progress.status object
+        """
+        job = self._job(jobid)
+        if part is not None:
+            with job.lock:
+                return {
+                    'part': part,
+                    'complete': not job.is_pending(part)}
+        return self._status(jobid, job)
+
+    @instrumented('remaining')
+    def remaining(self, jobid):
+        """Number of parts left in the job
+        """
+        return self._job(jobid).remaining
+
+    @instrumented('status_many', jobid=False)
+    def status_many(self, jobids):
+        """Status of many jobs
+
+        Returns
+        -------
+        list of status dicts, in the order of jobids.
+            Jobs which do not exist are skipped.
+        """
+        statuses = []
+        for jobid in jobids:
+            job = self._jobs.get(jobid)
+            if job is not None:
+                statuses.append(self._status(jobid, job))
+        return statuses
+
+    @instrumented('set_total')
+    def set_total(self, jobid, parts, callback=None):
+        """Set up parts for the job, replacing any job with the same jobid
+
+        parts is a count or a sized collection of parts
+        """
+        job = _Job(part_count(parts), next(self._created))
+        with self._lock:
+            self._jobs[jobid] = job
+        if callback is not None:
+            callback(job.total, job.total)
+
+    @instrumented('fail_job')
+    def fail_job(self, jobid, reason):
+        """Mark the job as failed
+        """
+        logger.error('[fail_job] {} failed because {}.'.format(jobid, reason))
+        job = self._job(jobid)
+        with job.lock:
+            job.failed = True
+            job.error = reason
+
+    @instrumented('is_failed')
+    def is_failed(self, jobid):
+        """Has the job been marked as failed?
+        """
+        job = self._jobs.get(jobid)
+        return job is not None and job.failed
+
+    @instrumented('delete')
+    def delete(self, jobid):
+        """Delete the reduce job
+
+        Returns
+        -------
+        boolean
+            Did the job exist?
+        """
+        with self._lock:
+            return self._jobs.pop(jobid, None) is not None
+
+    def _claim(self, job):
+        """Claim the reduce, must be called with the job's lock held"""
+        if job.reduce_sent:
+            return None
+        job.reduce_sent = True
+        return job.metadata.copy()
+
+    def _complete(self, jobid, partids, claim):
+        """Remove parts and claim the reduce under the job's lock"""
+        job = self._job(jobid)
+        with job.lock:
+            remaining = job.remove(partids)
+            metadata = self._claim(job) if claim and remaining == 0 else None
+        return remaining, metadata
+
+    @instrumented('claim_reduce')
+    def claim_reduce(self, jobid):
+        """Claim the right to send the reduce message for a job
+
+        Returns
+        -------
+        dict or None
+            The job metadata if this caller claimed the reduce,
+            None if it had already been claimed or the job does not exist
+        """
+        job = self._jobs.get(jobid)
+        if job is None:
+            return None
+        with job.lock:
+            return self._claim(job)
+
+    @instrumented('release_reduce')
+    def release_reduce(self, jobid):
+        """Give up a reduce claim, e.g. when the reduce message could not be sent
+        """
+        job = self._jobs.get(jobid)
+        if job is not None:
+            with job.lock:
+                job.reduce_sent = False
+
+    @instrumented('set_metadata')
+    def set_metadata(self, jobid, metadata):
+        """Associate arbitrary metadata with a particular map-reduce job
+        """
+        job = self._job(jobid)
+        with job.lock:
+            job.metadata.update(metadata)
+
+    @instrumented('list_pending_parts')
+    def list_pending_parts(self, jobid):
+        """Pending (incomplete) part numbers for a given jobid
+        """
+        job = self._job(jobid)
+        with job.lock:
+            pending = bytes(job.pending)
+        return list(bitmap_members(pending))
+
+    def list_jobs(self, status=True, active_only=False, jobids=None):
+        """Yields all jobs, oldest first
+
+        If status is True, the yielded items will be the full status dictionary of each job
+        If status is False, the items will be job ids only
+        If active_only is True, only jobs with remaining parts are yielded
+        If jobids are given, only those jobs are yielded
+        """
+        if jobids is not None:
+            for data in self._list_given_jobs(jobids, status, active_only):
+                yield data
+            return
+
+        with self._lock:
+            jobs = sorted(self._jobs.items(), key=lambda item: item[1].created)
+        for jobid, job in jobs:
+            if active_only and not job.remaining:
+                continue
+            yield self._status(jobid, job) if status else jobid
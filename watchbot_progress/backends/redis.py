@@ -1,25 +1,168 @@
 from __future__ import division
 from __future__ import absolute_import
 
+from concurrent import futures
 import logging
 import os
+import threading
+import time
 
 import redis
 
+from watchbot_progress import metrics
 from watchbot_progress.backends.base import WatchbotProgressBase
 from watchbot_progress.errors import JobDoesNotExist
+from watchbot_progress.metrics import instrumented
+from watchbot_progress.utils import bitmap_members, part_count, pending_bitmap
 
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Job registry, a sorted set of jobids scored by creation time
+# and a set of the jobids which still have pending parts
+JOBS_KEY = 'watchbot-progress-jobs'
+ACTIVE_KEY = 'watchbot-progress-active'
+
+# set_total writes the pending parts of large jobs in chunks, one request
+# each, so that no single command blocks the server: SET_TOTAL_CHUNK partids
+# per SADD, or BITMAP_CHUNK bytes per SET/SETRANGE of a bitmap
+SET_TOTAL_CHUNK = 10000
+BITMAP_CHUNK = 1 << 20
+
+# Connection options of StrictRedisCluster which a single node's
+# StrictRedis does not accept, see RedisProgress._primaries
+CLUSTER_ONLY_KWARGS = (
+    'startup_nodes', 'max_connections_per_node', 'init_slot_cache', 'readonly_mode',
+    'reinitialize_steps', 'skip_full_coverage_check', 'nodemanager_follow_cluster',
+    'connection_class', 'connection_pool')
+
+# Metadata hash fields which are not part of the user's job metadata
+INTERNAL_FIELDS = ('total', 'failed', 'error', 'reduce_message_sent')
+
+# Remove a part, count the remaining parts and, if there are none left,
+# claim the reduce for the caller. Returns {remaining, claimed, metadata}.
+# A bitmap's bit is only cleared within the bitmap, as SETBIT would create
+# a deleted job's key or grow it, and its remaining counter is decremented
+# only when the bit was still set.
+# KEYS: parts, metadata, remaining counter, active jobs (optional)
+# ARGV: partid, bitmap ('1' or '0'), jobid (with active jobs)
+COMPLETE_AND_CLAIM = """
+local remaining
+if ARGV[2] == '1' then
+    local partid = tonumber(ARGV[1])
+    if redis.call('EXISTS', KEYS[1]) == 1
+            and partid < redis.call('STRLEN', KEYS[1]) * 8
+            and redis.call('SETBIT', KEYS[1], partid, 0) == 1 then
+        remaining = redis.call('DECR', KEYS[3])
+    else
+        remaining = tonumber(redis.call('GET', KEYS[3]) or '0')
+    end
+else
+    redis.call('SREM', KEYS[1], ARGV[1])
+    remaining = redis.call('SCARD', KEYS[1])
+end
+if remaining == 0 and KEYS[4] then
+    redis.call('SREM', KEYS[4], ARGV[3])
+end
+if remaining > 0 or redis.call('HEXISTS', KEYS[2], 'total') == 0 then
+    return {remaining, 0}
+end
+if redis.call('HSETNX', KEYS[2], 'reduce_message_sent', 'True') == 0 then
+    return {remaining, 0}
+end
+return {remaining, 1, redis.call('HGETALL', KEYS[2])}
+"""
+
+# Clear the bits of several pending parts and decrement the remaining
+# counter by the number which were still set, as COMPLETE_AND_CLAIM does for
+# a single part. Returns the number of remaining parts.
+# KEYS: parts, remaining counter
+# ARGV: partids
+CLEAR_BITS = """
+local size = redis.call('STRLEN', KEYS[1]) * 8
+local cleared = 0
+for _, partid in ipairs(ARGV) do
+    partid = tonumber(partid)
+    if partid >= 0 and partid < size
+            and redis.call('SETBIT', KEYS[1], partid, 0) == 1 then
+        cleared = cleared + 1
+    end
+end
+if cleared > 0 then
+    return redis.call('DECRBY', KEYS[2], cleared)
+end
+return tonumber(redis.call('GET', KEYS[2]) or '0')
+"""
+
+
+class _ForkSafeConnectionPool(redis.ConnectionPool):
+    """A ConnectionPool which a forked child can keep using
+
+    redis-py 2.10 disconnects the parent's connections in the child, which
+    shuts down the sockets the parent is still using. This pool only forgets
+    them, and the child opens its own. The sockets are detached from the
+    connections first, as a connection disconnects when it is collected.
+    """
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            with self._check_lock:
+                if self.pid == os.getpid():
+                    return
+                for connection in self._available_connections:
+                    connection._sock = None
+                for connection in self._in_use_connections:
+                    connection._sock = None
+                self.reset()
+
+
+# Process-wide connection pools, by URL and options
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connection_pool(url, **kwargs):
+    """The process-wide connection pool for a redis URL
+
+    Parameters
+    ----------
+    url: string, e.g. redis://:password@localhost:6379/0, rediss:// for TLS
+        or unix:///path/to/redis.sock
+    kwargs: pool and connection options, e.g. max_connections,
+        socket_timeout, socket_connect_timeout, socket_keepalive
+
+    Returns
+    -------
+    redis.ConnectionPool, the same one for every call with the same
+        URL and options
+    """
+    key = (url, repr(sorted(kwargs.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = _ForkSafeConnectionPool.from_url(url, **kwargs)
+    return pool
+
+
+def _cluster_client(host, port, db, **kwargs):
+    """A redis-py-cluster client, an optional dependency"""
+    try:
+        from rediscluster import StrictRedisCluster
+    except ImportError:
+        raise ImportError('cluster=True needs redis-py-cluster, pip install redis-py-cluster')
+    if db:
+        raise ValueError('Redis Cluster only has db 0')
+    return StrictRedisCluster(host=host, port=port, **kwargs)
+
 
 class RedisProgress(WatchbotProgressBase):
     """Sets up objects for reduce mode job tracking with SNS and Redis
     """
 
     def __init__(self, topic_arn=None, host='localhost', port=6379, db=0,
-                 delete_when_done=False, **kwargs):
+                 delete_when_done=False, bitmap=False, scripts=True, registry=True,
+                 cluster=False, **kwargs):
         """Redis-backed progress object
 
         Parameters
@@ -28,25 +171,101 @@ class RedisProgress(WatchbotProgressBase):
         host: string, redis host
         port: integer
         db: integer, redis db number
-        kwargs: passed directly to redis.StrictRedis connection
+        delete_when_done: boolean, delete job keys once all parts are complete
+        bitmap: boolean, store pending parts as a bitmap (one bit per part)
+            rather than a set. All clients of a job must use the same encoding.
+        scripts: boolean, complete parts and claim the reduce with a single
+            Lua script. Disable for servers or proxies which do not support EVAL.
+        registry: boolean, keep a registry of all jobs and of active jobs,
+            which list_jobs reads instead of scanning the whole keyspace.
+        cluster: boolean, connect to a Redis Cluster through host and port,
+            using redis-py-cluster. A job's keys are hash tagged so they
+            share a slot. Clients of a job must all use the same setting.
+            Bitmap jobs need scripts, as cluster pipelines have no WATCH.
+        kwargs: passed directly to redis.StrictRedis connection,
+            or rediscluster.StrictRedisCluster
         """
         # SNS Topic
         self.topic = topic_arn if topic_arn else os.environ['WorkTopic']
 
+        if cluster and bitmap and not scripts:
+            raise ValueError('cluster=True with bitmap=True needs scripts=True')
+
         # Redis
-        self.redis = redis.StrictRedis(host=host, port=port, db=db, **kwargs)
+        self.cluster = cluster
+        self._kwargs = kwargs
+        if cluster:
+            self.redis = _cluster_client(host, port, db, **kwargs)
+        else:
+            self.redis = redis.StrictRedis(host=host, port=port, db=db, **kwargs)
         self.delete_when_done = delete_when_done
+        self.bitmap = bitmap
+        self.scripts = scripts
+        self.registry = registry
+        if scripts:
+            self._complete_and_claim = self.redis.register_script(COMPLETE_AND_CLAIM)
+            self._clear_pending_bits = self.redis.register_script(CLEAR_BITS)
+
+    @classmethod
+    def from_url(cls, url, topic_arn=None, delete_when_done=False, bitmap=False,
+                 scripts=True, registry=True, **kwargs):
+        """Redis-backed progress object using the process-wide pool for a URL
+
+        Progress objects created with the same URL and options share
+        connections, so creating one per job or message is cheap.
+
+        Parameters
+        ----------
+        url: string, e.g. redis://:password@localhost:6379/0, rediss:// for TLS
+            or unix:///path/to/redis.sock
+        kwargs: pool and connection options, see connection_pool.
+            The other parameters are as for RedisProgress.
+        """
+        return cls(topic_arn=topic_arn, delete_when_done=delete_when_done, bitmap=bitmap,
+                   scripts=scripts, registry=registry,
+                   connection_pool=connection_pool(url, **kwargs))
 
     def _metadata_key(self, jobid):
+        if self.cluster:
+            return '{{{}}}-metadata'.format(jobid)
         return '{}-metadata'.format(jobid)
 
     def _parts_key(self, jobid):
+        if self.cluster:
+            return '{{{}}}-parts'.format(jobid)
         return '{}-parts'.format(jobid)
 
+    def _remaining_key(self, jobid):
+        if self.cluster:
+            return '{{{}}}-remaining'.format(jobid)
+        return '{}-remaining'.format(jobid)
+
+    def _count_parts(self, pipe, jobid):
+        """Queue a count of the pending parts on a pipeline
+
+        A bitmap job keeps its count in a counter rather than
+        running BITCOUNT over the whole bitmap on every completion.
+        """
+        if self.bitmap:
+            return pipe.get(self._remaining_key(jobid))
+        return pipe.scard(self._parts_key(jobid))
+
+    def _parse_count(self, count):
+        """The result of _count_parts as an integer"""
+        return int(count or 0)
+
     def _decode_dict(self, meta):
         return {k.decode('utf-8'): v.decode('utf-8')
                 for k, v in meta.items()}
 
+    def _job_metadata(self, meta):
+        """User metadata from a raw metadata hash"""
+        meta = self._decode_dict(meta)
+        for field in INTERNAL_FIELDS:
+            meta.pop(field, None)
+        return meta
+
+    @instrumented('status')
     def status(self, jobid, part=None):
         """get status from dynamodb
 
@@ -61,16 +280,58 @@ class RedisProgress(WatchbotProgressBase):
         dict, similar to JS watchbot-progress.status object
         """
         if part is not None:
-            is_member = self.redis.sismember(self._parts_key(jobid), part)
+            if self.bitmap:
+                is_member = self.redis.getbit(self._parts_key(jobid), part)
+            else:
+                is_member = self.redis.sismember(self._parts_key(jobid), part)
+            metrics.round_trip()
             return {
                 'part': part,
                 'complete': not bool(is_member)}
 
         pipe = self.redis.pipeline()
         pipe.hgetall(self._metadata_key(jobid))
-        pipe.scard(self._parts_key(jobid))
+        self._count_parts(pipe, jobid)
         meta, remaining = pipe.execute()
+        metrics.round_trip()
 
+        return self._build_status(jobid, meta, self._parse_count(remaining))
+
+    @instrumented('remaining')
+    def remaining(self, jobid):
+        """Number of parts left in the job, a single GET or SCARD
+        """
+        remaining = self._parse_count(self._count_parts(self.redis, jobid))
+        metrics.round_trip()
+        return remaining
+
+    @instrumented('status_many', jobid=False)
+    def status_many(self, jobids):
+        """Status of many jobs, read with a single pipeline
+
+        Returns
+        -------
+        list of status dicts, in the order of jobids.
+            Jobs which do not exist are skipped.
+        """
+        jobids = list(jobids)
+        pipe = self.redis.pipeline(transaction=False)
+        for jobid in jobids:
+            pipe.hgetall(self._metadata_key(jobid))
+            self._count_parts(pipe, jobid)
+        res = pipe.execute()
+        metrics.round_trip()
+
+        statuses = []
+        for jobid, meta, remaining in zip(jobids, res[::2], res[1::2]):
+            try:
+                statuses.append(self._build_status(jobid, meta, self._parse_count(remaining)))
+            except JobDoesNotExist:
+                continue
+        return statuses
+
+    def _build_status(self, jobid, meta, remaining):
+        """Status dict from the raw metadata hash and remaining part count"""
         # Pop select keys off the metadata dict, expose at top level
         meta = self._decode_dict(meta)
         failed = meta.pop('failed', None)
@@ -94,19 +355,55 @@ class RedisProgress(WatchbotProgressBase):
 
         return data
 
-    def set_total(self, jobid, parts):
+    @instrumented('set_total')
+    def set_total(self, jobid, parts, callback=None):
         """Set up parts for the job
 
         Based on watchbot-progress.setTotal
+
+        parts is a count or a sized collection of parts. Pending parts are
+        written in chunks, calling callback(done, total) after each one,
+        and the job's total is set along with the last chunk.
         """
-        total = len(parts)
-        partids = range(total)
+        total = part_count(parts)
+        key = self._parts_key(jobid)
+        chunk = BITMAP_CHUNK * 8 if self.bitmap else SET_TOTAL_CHUNK
 
         pipe = self.redis.pipeline()
+        pipe.delete(key)
+        if self.bitmap:
+            pipe.delete(self._remaining_key(jobid))
+        for start in range(0, total, chunk):
+            stop = min(start + chunk, total)
+            if self.bitmap:
+                bitmap = pending_bitmap(stop - start)
+                if start:
+                    pipe.setrange(key, start // 8, bitmap)
+                else:
+                    pipe.set(key, bitmap)
+            else:
+                pipe.sadd(key, *range(start, stop))
+            if stop == total:
+                # the last chunk is sent with the total
+                break
+            pipe.execute()
+            metrics.round_trip()
+            if callback is not None:
+                callback(stop, total)
+            pipe = self.redis.pipeline()
+
+        if self.bitmap:
+            pipe.set(self._remaining_key(jobid), total)
         pipe.hset(self._metadata_key(jobid), 'total', total)
-        pipe.sadd(self._parts_key(jobid), *partids)
+        if self.registry:
+            pipe.zadd(JOBS_KEY, time.time(), jobid)
+            pipe.sadd(ACTIVE_KEY, jobid)
         pipe.execute()
+        metrics.round_trip()
+        if total and callback is not None:
+            callback(total, total)
 
+    @instrumented('fail_job')
     def fail_job(self, jobid, reason):
         """fail the job, notify dynamodb
 
@@ -115,7 +412,17 @@ class RedisProgress(WatchbotProgressBase):
         logger.error('[fail_job] {} failed because {}.'.format(jobid, reason))
         self.redis.hset(self._metadata_key(jobid), 'error', reason)
         self.redis.hset(self._metadata_key(jobid), 'failed', 1)
+        metrics.round_trip(count=2)
+
+    @instrumented('is_failed')
+    def is_failed(self, jobid):
+        """Has the job been marked as failed?
+        """
+        failed = self.redis.hget(self._metadata_key(jobid), 'failed')
+        metrics.round_trip()
+        return failed == b'1'
 
+    @instrumented('delete')
     def delete(self, jobid):
         """Delete the reduce job
         """
@@ -123,9 +430,45 @@ class RedisProgress(WatchbotProgressBase):
         pipe = self.redis.pipeline()
         pipe.delete(self._parts_key(jobid))
         pipe.delete(self._metadata_key(jobid))
-        parts_del, meta_del = pipe.execute()
-        return (parts_del, meta_del)
-
+        if self.bitmap:
+            pipe.delete(self._remaining_key(jobid))
+        if self.registry:
+            pipe.zrem(JOBS_KEY, jobid)
+            pipe.srem(ACTIVE_KEY, jobid)
+        res = pipe.execute()
+        metrics.round_trip()
+        return (res[0], res[1])
+
+    def _deactivate(self, jobid):
+        """Remove a job with no remaining parts from the active jobs"""
+        if self.registry:
+            self.redis.srem(ACTIVE_KEY, jobid)
+            metrics.round_trip()
+
+    def rebuild_registry(self, count=1000):
+        """Register the jobs found by scanning the whole keyspace
+
+        For jobs created without the registry, or by older clients.
+        Jobs which are already registered keep their creation time.
+        """
+        for jobids in self._scan_jobids(count):
+            pipe = self.redis.pipeline(transaction=False)
+            for jobid in jobids:
+                pipe.zscore(JOBS_KEY, jobid)
+            scores = dict(zip(jobids, pipe.execute()))
+
+            now = time.time()
+            pipe = self.redis.pipeline(transaction=False)
+            for data in self.status_many(jobids):
+                if scores[data['jobid']] is None:
+                    pipe.zadd(JOBS_KEY, now, data['jobid'])
+                if data['remaining'] > 0:
+                    pipe.sadd(ACTIVE_KEY, data['jobid'])
+                else:
+                    pipe.srem(ACTIVE_KEY, data['jobid'])
+            pipe.execute()
+
+    @instrumented('complete_part')
     def complete_part(self, jobid, partid):
         """Mark part as complete
 
@@ -134,49 +477,314 @@ class RedisProgress(WatchbotProgressBase):
         boolean
             Is the overall job completed yet?
         """
-        # Delete and count, atomically
-        pipe = self.redis.pipeline()
-        pipe.srem(self._parts_key(jobid), partid)
-        pipe.scard(self._parts_key(jobid))
-        _, remaining = pipe.execute()
+        remaining = self._remove_part(jobid, partid)
 
         if remaining == 0:
             if self.delete_when_done:
                 self.delete(jobid)
+            else:
+                self._deactivate(jobid)
             return True
         else:
             return False
 
+    @instrumented('complete_parts')
+    def complete_parts(self, jobid, partids):
+        """Mark several parts as complete, in one round trip
+
+        Returns
+        -------
+        dict
+            remaining: number of parts left in the job
+            complete: is the overall job completed yet?
+        """
+        remaining = self._remove_parts(jobid, partids)
+
+        if remaining == 0:
+            if self.delete_when_done:
+                self.delete(jobid)
+            else:
+                self._deactivate(jobid)
+        return {'remaining': remaining, 'complete': remaining == 0}
+
+    @instrumented('complete_parts_and_claim_reduce')
+    def complete_parts_and_claim_reduce(self, jobid, partids):
+        """Mark several parts as complete and, if the job is done, claim the reduce
+
+        The reduce is claimed before a finished job is deleted.
+
+        Returns
+        -------
+        tuple (boolean, dict or None)
+            Is the overall job completed yet? And the job metadata
+            if this caller claimed the reduce, otherwise None
+        """
+        remaining = self._remove_parts(jobid, partids)
+        if remaining > 0:
+            return False, None
+        self._deactivate(jobid)
+        metadata = self.claim_reduce(jobid)
+        if self.delete_when_done:
+            self.delete(jobid)
+        return True, metadata
+
+    def _remove_parts(self, jobid, partids):
+        """Delete and count several parts, atomically"""
+        if self.bitmap:
+            return self._clear_bits(jobid, partids)
+        pipe = self.redis.pipeline()
+        if partids:
+            pipe.srem(self._parts_key(jobid), *partids)
+        self._count_parts(pipe, jobid)
+        remaining = self._parse_count(pipe.execute()[-1])
+        metrics.round_trip()
+        return remaining
+
+    def _remove_part(self, jobid, partid):
+        """Delete and count, atomically"""
+        if self.bitmap:
+            return self._clear_bits(jobid, [partid])
+        pipe = self.redis.pipeline()
+        pipe.srem(self._parts_key(jobid), partid)
+        self._count_parts(pipe, jobid)
+        _, remaining = pipe.execute()
+        metrics.round_trip()
+        return remaining
+
+    def _clear_bits(self, jobid, partids):
+        """Clear the bits of pending parts and count the remaining parts
+
+        With scripts enabled this is the CLEAR_BITS script, a single round
+        trip. Otherwise the job's total is read under WATCH so that bits are
+        only cleared within the bitmap of a job which exists, and the counter
+        is decremented by the number of bits which were still set.
+        """
+        if self.scripts:
+            remaining = self._clear_pending_bits(
+                keys=[self._parts_key(jobid), self._remaining_key(jobid)],
+                args=list(partids))
+            metrics.round_trip()
+            return remaining
+
+        key = self._parts_key(jobid)
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self._metadata_key(jobid))
+                    total = int(pipe.hget(self._metadata_key(jobid), 'total') or 0)
+                    pipe.multi()
+                    for partid in partids:
+                        if 0 <= int(partid) < total:
+                            pipe.setbit(key, partid, 0)
+                    cleared = sum(pipe.execute())
+                    metrics.round_trip(count=3)
+                    break
+                except redis.WatchError:
+                    metrics.round_trip(count=3)
+                    continue
+
+        if cleared:
+            remaining = self.redis.decr(self._remaining_key(jobid), cleared)
+        else:
+            remaining = self._parse_count(self.redis.get(self._remaining_key(jobid)))
+        metrics.round_trip()
+        return remaining
+
+    @instrumented('claim_reduce')
+    def claim_reduce(self, jobid):
+        """Claim the right to send the reduce message for a job
+
+        Returns
+        -------
+        dict or None
+            The job metadata if this caller claimed the reduce,
+            None if it had already been claimed
+        """
+        pipe = self.redis.pipeline()
+        pipe.hsetnx(self._metadata_key(jobid), 'reduce_message_sent', 'True')
+        pipe.hgetall(self._metadata_key(jobid))
+        claimed, meta = pipe.execute()
+        metrics.round_trip()
+        if not claimed:
+            return None
+        if b'total' not in meta:
+            # the job has been deleted, don't leave a stray claim behind
+            self.redis.delete(self._metadata_key(jobid))
+            metrics.round_trip()
+            return None
+        return self._job_metadata(meta)
+
+    @instrumented('release_reduce')
+    def release_reduce(self, jobid):
+        """Give up a reduce claim, e.g. when the reduce message could not be sent
+        """
+        self.redis.hdel(self._metadata_key(jobid), 'reduce_message_sent')
+        metrics.round_trip()
+
+    @instrumented('complete_part_and_claim_reduce')
+    def complete_part_and_claim_reduce(self, jobid, partid):
+        """Mark part as complete and, if the job is done, claim the reduce
+
+        With scripts enabled this is a single round trip.
+
+        Returns
+        -------
+        tuple (boolean, dict or None)
+            Is the overall job completed yet? And the job metadata
+            if this caller claimed the reduce, otherwise None
+        """
+        if self.scripts:
+            keys = [self._parts_key(jobid), self._metadata_key(jobid),
+                    self._remaining_key(jobid)]
+            args = [partid, '1' if self.bitmap else '0']
+            if self.registry and not self.cluster:
+                keys.append(ACTIVE_KEY)
+                args.append(jobid)
+            res = self._complete_and_claim(keys=keys, args=args)
+            metrics.round_trip()
+            remaining, claimed = res[0], res[1]
+            if remaining == 0 and self.cluster:
+                # the registry is on another slot than the job's keys
+                self._deactivate(jobid)
+            metadata = None
+            if claimed:
+                meta = res[2]
+                metadata = self._job_metadata(dict(zip(meta[::2], meta[1::2])))
+        else:
+            remaining = self._remove_part(jobid, partid)
+            metadata = None
+            if remaining == 0:
+                self._deactivate(jobid)
+                metadata = self.claim_reduce(jobid)
+
+        if remaining > 0:
+            return False, None
+        if self.delete_when_done:
+            self.delete(jobid)
+        return True, metadata
+
+    @instrumented('set_metadata')
     def set_metadata(self, jobid, metadata):
         """Associate arbitrary metadata with a particular map-reduce job
         """
         for key, value in metadata.items():
             self.redis.hset(self._metadata_key(jobid), key, value)
+            metrics.round_trip()
 
+    @instrumented('list_pending_parts')
     def list_pending_parts(self, jobid):
         """Pending (incomplete) part numbers for a given jobid
         """
         pipe = self.redis.pipeline()
         pipe.hgetall(self._metadata_key(jobid))
-        pipe.smembers(self._parts_key(jobid))
+        if self.bitmap:
+            pipe.get(self._parts_key(jobid))
+        else:
+            pipe.smembers(self._parts_key(jobid))
         meta, parts = pipe.execute()
+        metrics.round_trip()
 
         meta = self._decode_dict(meta)
         if 'total' not in meta.keys():
             raise JobDoesNotExist('jobid {} does not exist'.format(jobid))
 
+        if self.bitmap:
+            return list(bitmap_members(parts))
         return [int(x) for x in parts]
 
-    def list_jobs(self, status=True):
+    def _scan_jobids(self, count):
+        """Yields batches of jobids found by scanning the whole keyspace
+
+        A cluster's primaries are scanned in parallel.
+        """
+        if not self.cluster:
+            return self._scan_node(self.redis, count)
+        return self._scan_primaries(count)
+
+    def _scan_node(self, client, count):
+        """Yields batches of jobids found by scanning one server"""
+        postfix = '-metadata'  # see _metadata_key method
+        cursor = 0
+        while True:
+            cursor, keys = client.scan(cursor=cursor, match='*' + postfix, count=count)
+            metrics.round_trip()
+            jobids = [key.decode('utf-8')[:-len(postfix)] for key in keys]
+            if self.cluster:
+                # strip the hash tag braces
+                jobids = [jobid[1:-1] for jobid in jobids]
+            yield jobids
+            if int(cursor) == 0:
+                break
+
+    def _primaries(self):
+        """A client for each primary node of the cluster"""
+        kwargs = dict((k, v) for k, v in self._kwargs.items() if k not in CLUSTER_ONLY_KWARGS)
+        return [redis.StrictRedis(host=node['host'], port=node['port'], **kwargs)
+                for node in self.redis.connection_pool.nodes.all_masters()]
+
+    def _scan_primaries(self, count):
+        """Yields batches of jobids from every primary, as each finishes its scan"""
+        primaries = self._primaries()
+        with futures.ThreadPoolExecutor(max_workers=len(primaries)) as executor:
+            scans = [executor.submit(lambda client: list(self._scan_node(client, count)), client)
+                     for client in primaries]
+            for scan in futures.as_completed(scans):
+                for jobids in scan.result():
+                    yield jobids
+
+    def _registry_jobids(self, count, active_only):
+        """Yields batches of jobids from the registry"""
+        if active_only:
+            cursor = 0
+            while True:
+                cursor, members = self.redis.sscan(ACTIVE_KEY, cursor=cursor, count=count)
+                yield [member.decode('utf-8') for member in members]
+                if int(cursor) == 0:
+                    break
+        else:
+            # oldest first
+            start = 0
+            while True:
+                members = self.redis.zrange(JOBS_KEY, start, start + count - 1)
+                yield [member.decode('utf-8') for member in members]
+                if len(members) < count:
+                    break
+                start += count
+
+    def list_jobs(self, status=True, active_only=False, jobids=None, count=1000):
         """Yields all jobs in the database
 
         If status is True, the yielded items will be the full status dictionary of each job
         If status is False, the items will be job ids only
+        If active_only is True, only jobs with remaining parts are yielded
+        If jobids are given, only those jobs are yielded, read with status_many
+
+        With the registry, jobs are read from the registry sets, otherwise
+        keys are scanned with SCAN COUNT ``count``. Keys are also scanned if
+        the registry does not exist yet, e.g. for jobs created before it;
+        see rebuild_registry. The statuses of each batch of jobs are read
+        with a single pipeline.
         """
-        postfix = '-metadata'  # see _metadata_key method
-        for key in self.redis.scan_iter(match='*' + postfix):
-            jobid = key.decode('utf-8').replace(postfix, '')
-            if status:
-                yield self.status(jobid)
-            else:
-                yield jobid
+        if jobids is not None:
+            for data in self._list_given_jobs(jobids, status, active_only):
+                yield data
+            return
+
+        registered = self.registry and self.redis.exists(JOBS_KEY)
+        if self.registry:
+            metrics.round_trip()
+        if registered:
+            batches = self._registry_jobids(count, active_only)
+        else:
+            batches = self._scan_jobids(count)
+
+        for batch in batches:
+            if not status and (registered or not active_only):
+                for jobid in batch:
+                    yield jobid
+                continue
+
+            for data in self.status_many(batch):
+                if active_only and not data['remaining'] > 0:
+                    continue
+                yield data if status else data['jobid']
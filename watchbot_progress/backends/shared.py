@@ -0,0 +1,441 @@
+from __future__ import division
+
+import binascii
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from watchbot_progress.backends.base import LocalProgressMixin, WatchbotProgressBase
+from watchbot_progress.errors import JobDoesNotExist
+from watchbot_progress.metrics import instrumented
+from watchbot_progress.utils import bitmap_members, part_count, pending_bitmap
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Job file header: magic, flags, total, remaining, created.
+# The pending part bitmap follows it, most significant bit first.
+MAGIC = b'WBP1'
+HEADER = struct.Struct('<4sIQQd')
+FLAGS = struct.Struct('<I')
+FLAGS_OFFSET = 4
+REMAINING = struct.Struct('<Q')
+REMAINING_OFFSET = 16
+BYTE = struct.Struct('B')
+
+FAILED = 1
+REDUCE_SENT = 2
+# Set on a job file which has been deleted or replaced by set_total
+STALE = 4
+
+JOB_SUFFIX = '.job'
+META_SUFFIX = '.json'
+
+# Bytes of pending part bitmap written at a time by set_total
+BITMAP_CHUNK = 1 << 20
+
+# Job files kept mapped by each process
+MAX_OPEN_JOBS = 256
+
+
+class _MappedJob(object):
+    """An open, memory mapped job file
+
+    The lock serializes threads using this file object, flock serializes
+    processes and other file objects of the same job.
+    """
+
+    __slots__ = ('file', 'map', 'lock')
+
+    def __init__(self, path):
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.lock.acquire()
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.lock.release()
+
+    def header(self):
+        _, flags, total, remaining, created = HEADER.unpack_from(self.map, 0)
+        return flags, total, remaining, created
+
+    def set_flags(self, flags):
+        FLAGS.pack_into(self.map, FLAGS_OFFSET, flags)
+
+    def is_pending(self, partid):
+        partid = int(partid)
+        if not 0 <= partid < self.header()[1]:
+            return False
+        byte, = BYTE.unpack_from(self.map, HEADER.size + (partid >> 3))
+        return bool(byte & (0x80 >> (partid & 7)))
+
+    def remove(self, partids):
+        """Clear pending parts, must be called with the job locked"""
+        _, total, remaining, _ = self.header()
+        for partid in partids:
+            partid = int(partid)
+            if not 0 <= partid < total:
+                continue
+            offset = HEADER.size + (partid >> 3)
+            byte, = BYTE.unpack_from(self.map, offset)
+            mask = 0x80 >> (partid & 7)
+            if byte & mask:
+                BYTE.pack_into(self.map, offset, byte & ~mask & 0xff)
+                remaining -= 1
+        REMAINING.pack_into(self.map, REMAINING_OFFSET, remaining)
+        return remaining
+
+    def pending(self):
+        total = self.header()[1]
+        return self.map[HEADER.size:HEADER.size + (total + 7) // 8]
+
+
+class SharedMemoryProgress(LocalProgressMixin, WatchbotProgressBase):
+    """Tracks reduce mode jobs in memory mapped files shared by processes
+
+    For process pools on a single host. Each job is a file holding its
+    counters and a bitmap of pending parts, mapped into every process which
+    uses it, so completing a part is a file lock and a few bytes of shared
+    memory. Metadata and failure reasons are kept in a small JSON file
+    beside it. Jobs survive crashed workers; put the directory on a tmpfs
+    such as /dev/shm to keep them in memory only.
+
+    POSIX only, as it relies on flock. Instances can be pickled to pass
+    them to worker processes.
+    """
+
+    def __init__(self, path, topic_arn=None, delete_when_done=False):
+        """Shared memory progress object
+
+        Parameters
+        ----------
+        path: string, directory of job files, created if it does not exist
+        topic_arn: optional, defaults to the WorkTopic environment variable.
+            Not needed if reduce messages are handled by Part's on_reduce.
+        delete_when_done: boolean, delete jobs once all parts are complete
+        """
+        self.path = path
+        self.topic = topic_arn if topic_arn else os.environ.get('WorkTopic')
+        self.delete_when_done = delete_when_done
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self._reset()
+
+    def __getstate__(self):
+        return dict(path=self.path, topic=self.topic, delete_when_done=self.delete_when_done)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _filename(self, jobid, suffix):
+        name = binascii.hexlify(jobid.encode('utf-8')).decode('ascii')
+        return os.path.join(self.path, name + suffix)
+
+    def _open(self, jobid):
+        if self._pid != os.getpid():
+            # a forked child must not share its parent's file locks
+            self._reset()
+        job = self._jobs.get(jobid)
+        if job is not None:
+            return job
+
+        try:
+            job = _MappedJob(self._filename(jobid, JOB_SUFFIX))
+        except (IOError, OSError) as err:
+            if err.errno == errno.ENOENT:
+                raise JobDoesNotExist('jobid {} does not exist'.format(jobid))
+            raise
+        with self._lock:
+            if len(self._jobs) >= MAX_OPEN_JOBS:
+                # unmapped once no thread is using them
+                self._jobs.clear()
+            return self._jobs.setdefault(jobid, job)
+
+    def _acquire(self, jobid):
+        """Lock the current file of a job, reopening it if it was replaced"""
+        while True:
+            job = self._open(jobid)
+            job.acquire()
+            if not job.header()[0] & STALE:
+                return job
+            job.release()
+            with self._lock:
+                if self._jobs.get(jobid) is job:
+                    del self._jobs[jobid]
+
+    @contextmanager
+    def _locked(self, jobid):
+        job = self._acquire(jobid)
+        try:
+            yield job
+        finally:
+            job.release()
+
+    def _read_meta(self, jobid):
+        with open(self._filename(jobid, META_SUFFIX)) as src:
+            return json.load(src)
+
+    def _write_meta(self, jobid, meta):
+        self._replace(self._filename(jobid, META_SUFFIX), json.dumps(meta).encode('utf-8'))
+
+    def _replace(self, filename, data):
+        """Write a file atomically"""
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as dst:
+            dst.write(data)
+        os.rename(tmp, filename)
+
+    def _status(self, jobid):
+        with self._locked(jobid) as job:
+            flags, total, remaining, _ = job.header()
+            meta = self._read_meta(jobid)
+        data = dict(
+            metadata=meta['metadata'],
+            jobid=jobid,
+            progress=(total - remaining) / total if total else 1.0,
+            total=total,
+            remaining=remaining,
+            failed=bool(flags & FAILED))
+        if meta.get('error') is not None:
+            data['error'] = meta['error']
+        return data
+
+    @instrumented('status')
+    def status(self, jobid, part=None):
+        """Get status
+
+        Parameters
+        ----------
+        jobid: string
+        part: optional int
+            return status of the given partid
+
+        Returns
+        -------
+        dict, similar to JS watchbot-progress.status object
+        """
+        if part is not None:
+            with self._locked(jobid) as job:
+                return {
+                    'part': part,
+                    'complete': not job.is_pending(part)}
+        return self._status(jobid)
+
+    @instrumented('remaining')
+    def remaining(self, jobid):
+        """Number of parts left in the job
+        """
+        with self._locked(jobid) as job:
+            return job.header()[2]
+
+    @instrumented('status_many', jobid=False)
+    def status_many(self, jobids):
+        """Status of many jobs
+
+        Returns
+        -------
+        list of status dicts, in the order of jobids.
+            Jobs which do not exist are skipped.
+        """
+        statuses = []
+        for jobid in jobids:
+            try:
+                statuses.append(self._status(jobid))
+            except JobDoesNotExist:
+                pass
+        return statuses
+
+    @instrumented('set_total')
+    def set_total(self, jobid, parts, callback=None):
+        """Set up parts for the job, replacing any job with the same jobid
+
+        parts is a count or a sized collection of parts. The bitmap is
+        written BITMAP_CHUNK bytes at a time, calling callback(done, total)
+        after each chunk.
+        """
+        total = part_count(parts)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as dst:
+            dst.write(HEADER.pack(MAGIC, 0, total, total, time.time()))
+            for start in range(0, total, BITMAP_CHUNK * 8):
+                stop = min(start + BITMAP_CHUNK * 8, total)
+                dst.write(pending_bitmap(stop - start))
+                if callback is not None:
+                    callback(stop, total)
+
+        try:
+            old = self._acquire(jobid)
+        except JobDoesNotExist:
+            old = None
+        try:
+            self._write_meta(jobid, {'metadata': {}, 'error': None})
+            os.rename(tmp, self._filename(jobid, JOB_SUFFIX))
+            if old is not None:
+                old.set_flags(old.header()[0] | STALE)
+        finally:
+            if old is not None:
+                old.release()
+
+    @instrumented('fail_job')
+    def fail_job(self, jobid, reason):
+        """Mark the job as failed
+        """
+        logger.error('[fail_job] {} failed because {}.'.format(jobid, reason))
+        with self._locked(jobid) as job:
+            meta = self._read_meta(jobid)
+            meta['error'] = str(reason)
+            self._write_meta(jobid, meta)
+            job.set_flags(job.header()[0] | FAILED)
+
+    @instrumented('is_failed')
+    def is_failed(self, jobid):
+        """Has the job been marked as failed?
+        """
+        try:
+            with self._locked(jobid) as job:
+                return bool(job.header()[0] & FAILED)
+        except JobDoesNotExist:
+            return False
+
+    @instrumented('delete')
+    def delete(self, jobid):
+        """Delete the reduce job
+
+        Returns
+        -------
+        boolean
+            Did the job exist?
+        """
+        try:
+            job = self._acquire(jobid)
+        except JobDoesNotExist:
+            return False
+        try:
+            os.unlink(self._filename(jobid, JOB_SUFFIX))
+            os.unlink(self._filename(jobid, META_SUFFIX))
+            job.set_flags(job.header()[0] | STALE)
+        finally:
+            job.release()
+        return True
+
+    def _claim(self, jobid, job):
+        """Claim the reduce, must be called with the job locked"""
+        flags = job.header()[0]
+        if flags & REDUCE_SENT:
+            return None
+        job.set_flags(flags | REDUCE_SENT)
+        return self._read_meta(jobid)['metadata']
+
+    def _complete(self, jobid, partids, claim):
+        """Remove parts and claim the reduce while holding the job's lock"""
+        with self._locked(jobid) as job:
+            remaining = job.remove(partids)
+            metadata = self._claim(jobid, job) if claim and remaining == 0 else None
+        return remaining, metadata
+
+    @instrumented('claim_reduce')
+    def claim_reduce(self, jobid):
+        """Claim the right to send the reduce message for a job
+
+        Returns
+        -------
+        dict or None
+            The job metadata if this caller claimed the reduce,
+            None if it had already been claimed or the job does not exist
+        """
+        try:
+            with self._locked(jobid) as job:
+                return self._claim(jobid, job)
+        except JobDoesNotExist:
+            return None
+
+    @instrumented('release_reduce')
+    def release_reduce(self, jobid):
+        """Give up a reduce claim, e.g. when the reduce message could not be sent
+        """
+        try:
+            with self._locked(jobid) as job:
+                job.set_flags(job.header()[0] & ~REDUCE_SENT)
+        except JobDoesNotExist:
+            pass
+
+    @instrumented('set_metadata')
+    def set_metadata(self, jobid, metadata):
+        """Associate arbitrary metadata with a particular map-reduce job
+        """
+        with self._locked(jobid):
+            meta = self._read_meta(jobid)
+            meta['metadata'].update(metadata)
+            self._write_meta(jobid, meta)
+
+    @instrumented('list_pending_parts')
+    def list_pending_parts(self, jobid):
+        """Pending (incomplete) part numbers for a given jobid
+        """
+        with self._locked(jobid) as job:
+            pending = job.pending()
+        return list(bitmap_members(pending))
+
+    def _headers(self):
+        """(created, jobid, remaining) of every job, read without locking"""
+        headers = []
+        for filename in os.listdir(self.path):
+            name, suffix = os.path.splitext(filename)
+            if suffix != JOB_SUFFIX:
+                continue
+            try:
+                with open(os.path.join(self.path, filename), 'rb') as src:
+                    _, _, _, remaining, created = HEADER.unpack(src.read(HEADER.size))
+            except (IOError, OSError) as err:
+                if err.errno == errno.ENOENT:
+                    continue
+                raise
+            jobid = binascii.unhexlify(name.encode('ascii')).decode('utf-8')
+            headers.append((created, jobid, remaining))
+        return sorted(headers)
+
+    def list_jobs(self, status=True, active_only=False, jobids=None):
+        """Yields all jobs, oldest first
+
+        If status is True, the yielded items will be the full status dictionary of each job
+        If status is False, the items will be job ids only
+        If active_only is True, only jobs with remaining parts are yielded
+        If jobids are given, only those jobs are yielded
+        """
+        if jobids is not None:
+            for data in self._list_given_jobs(jobids, status, active_only):
+                yield data
+            return
+
+        for _, jobid, remaining in self._headers():
+            if active_only and not remaining:
+                continue
+            if not status:
+                yield jobid
+                continue
+            try:
+                yield self._status(jobid)
+            except JobDoesNotExist:
+                pass
@@ -0,0 +1,336 @@
+from __future__ import division
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from watchbot_progress.backends.base import LocalProgressMixin, WatchbotProgressBase
+from watchbot_progress.errors import JobDoesNotExist
+from watchbot_progress.metrics import instrumented
+from watchbot_progress.utils import chunker, part_count
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# One row per pending part, deleted when the part is completed
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    total INTEGER NOT NULL,
+    remaining INTEGER NOT NULL,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    reduce_sent INTEGER NOT NULL DEFAULT 0,
+    metadata TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created);
+CREATE TABLE IF NOT EXISTS parts (
+    jobid TEXT NOT NULL,
+    partid INTEGER NOT NULL,
+    PRIMARY KEY (jobid, partid)
+) WITHOUT ROWID;
+"""
+
+STATUS_COLUMNS = 'id, total, remaining, failed, error, metadata'
+
+# Stay under SQLite's default limit of 999 variables per statement
+MAX_VARIABLES = 500
+
+# Pending part rows inserted per executemany call by set_total
+INSERT_BATCH_SIZE = 10000
+
+
+def _rollback(conn):
+    """Roll back the open transaction, if there still is one
+
+    Some failures, such as a full disk, roll back the transaction themselves.
+    """
+    try:
+        conn.execute('ROLLBACK')
+    except sqlite3.OperationalError:
+        pass
+
+
+class SqliteProgress(LocalProgressMixin, WatchbotProgressBase):
+    """Tracks reduce mode jobs in a SQLite database file
+
+    For jobs which run entirely on one host. The database is in WAL mode,
+    so readers do not block writers. Each thread, and each process, uses its
+    own connection, and writes are serialized by SQLite's IMMEDIATE
+    transactions. Instances can be pickled to pass them to worker processes.
+    """
+
+    def __init__(self, path, topic_arn=None, timeout=30, synchronous='NORMAL',
+                 delete_when_done=False):
+        """SQLite-backed progress object
+
+        Parameters
+        ----------
+        path: string, database file, created if it does not exist
+        topic_arn: optional, defaults to the WorkTopic environment variable.
+            Not needed if reduce messages are handled by Part's on_reduce.
+        timeout: float, seconds to wait for another connection's write lock
+        synchronous: string, SQLite synchronous pragma. NORMAL is durable
+            across process crashes, FULL across power loss as well.
+        delete_when_done: boolean, delete jobs once all parts are complete
+        """
+        self.path = path
+        self.topic = topic_arn if topic_arn else os.environ.get('WorkTopic')
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.delete_when_done = delete_when_done
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        """This thread's connection, reopened after a fork"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous={}'.format(self.synchronous))
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """A write transaction, holding the database's write lock throughout
+
+        The transaction is rolled back if the block or the COMMIT itself
+        fails, so the connection is never left inside a transaction.
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except Exception:
+            _rollback(conn)
+            raise
+
+    def _build_status(self, row):
+        jobid, total, remaining, failed, error, metadata = row
+        data = dict(
+            metadata=json.loads(metadata),
+            jobid=jobid,
+            progress=(total - remaining) / total if total else 1.0,
+            total=total,
+            remaining=remaining,
+            failed=bool(failed))
+        if error is not None:
+            data['error'] = error
+        return data
+
+    @instrumented('status')
+    def status(self, jobid, part=None):
+        """Get status
+
+        Parameters
+        ----------
+        jobid: string
+        part: optional int
+            return status of the given partid
+
+        Returns
+        -------
+        dict, similar to JS watchbot-progress.status object
+        """
+        conn = self._connection()
+        if part is not None:
+            row = conn.execute(
+                'SELECT 1 FROM parts WHERE jobid = ? AND partid = ?', (jobid, part)).fetchone()
+            return {
+                'part': part,
+                'complete': row is None}
+
+        row = conn.execute(
+            'SELECT {} FROM jobs WHERE id = ?'.format(STATUS_COLUMNS), (jobid,)).fetchone()
+        if row is None:
+            raise JobDoesNotExist('Job does not exist, run set_total first')
+        return self._build_status(row)
+
+    @instrumented('remaining')
+    def remaining(self, jobid):
+        """Number of parts left in the job
+        """
+        row = self._connection().execute(
+            'SELECT remaining FROM jobs WHERE id = ?', (jobid,)).fetchone()
+        if row is None:
+            raise JobDoesNotExist('jobid {} does not exist'.format(jobid))
+        return row[0]
+
+    @instrumented('status_many', jobid=False)
+    def status_many(self, jobids):
+        """Status of many jobs, up to 500 per query
+
+        Returns
+        -------
+        list of status dicts, in the order of jobids.
+            Jobs which do not exist are skipped.
+        """
+        jobids = list(jobids)
+        conn = self._connection()
+        statuses = {}
+        for chunk in chunker(set(jobids), MAX_VARIABLES):
+            query = 'SELECT {} FROM jobs WHERE id IN ({})'.format(
+                STATUS_COLUMNS, ', '.join('?' * len(chunk)))
+            for row in conn.execute(query, chunk):
+                statuses[row[0]] = self._build_status(row)
+        return [statuses[jobid] for jobid in jobids if jobid in statuses]
+
+    @instrumented('set_total')
+    def set_total(self, jobid, parts, callback=None):
+        """Set up parts for the job, replacing any job with the same jobid
+
+        parts is a count or a sized collection of parts. All pending part
+        rows are inserted in a single transaction, INSERT_BATCH_SIZE at a
+        time, calling callback(done, total) after each batch.
+        """
+        total = part_count(parts)
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM parts WHERE jobid = ?', (jobid,))
+            conn.execute(
+                'INSERT OR REPLACE INTO jobs (id, created, total, remaining) VALUES (?, ?, ?, ?)',
+                (jobid, time.time(), total, total))
+            for start in range(0, total, INSERT_BATCH_SIZE):
+                stop = min(start + INSERT_BATCH_SIZE, total)
+                conn.executemany(
+                    'INSERT INTO parts (jobid, partid) VALUES (?, ?)',
+                    ((jobid, partid) for partid in range(start, stop)))
+                if callback is not None:
+                    callback(stop, total)
+
+    @instrumented('fail_job')
+    def fail_job(self, jobid, reason):
+        """Mark the job as failed
+        """
+        logger.error('[fail_job] {} failed because {}.'.format(jobid, reason))
+        self._connection().execute(
+            'UPDATE jobs SET failed = 1, error = ? WHERE id = ?', (str(reason), jobid))
+
+    @instrumented('is_failed')
+    def is_failed(self, jobid):
+        """Has the job been marked as failed?
+        """
+        row = self._connection().execute(
+            'SELECT failed FROM jobs WHERE id = ?', (jobid,)).fetchone()
+        return bool(row and row[0])
+
+    @instrumented('delete')
+    def delete(self, jobid):
+        """Delete the reduce job
+
+        Returns
+        -------
+        boolean
+            Did the job exist?
+        """
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM parts WHERE jobid = ?', (jobid,))
+            return conn.execute('DELETE FROM jobs WHERE id = ?', (jobid,)).rowcount > 0
+
+    def _remove_parts(self, conn, jobid, partids):
+        """Delete pending part rows and count down, returns the remaining parts"""
+        removed = conn.executemany(
+            'DELETE FROM parts WHERE jobid = ? AND partid = ?',
+            ((jobid, int(partid)) for partid in partids)).rowcount
+        if removed > 0:
+            conn.execute(
+                'UPDATE jobs SET remaining = remaining - ? WHERE id = ?', (removed, jobid))
+        row = conn.execute('SELECT remaining FROM jobs WHERE id = ?', (jobid,)).fetchone()
+        if row is None:
+            raise JobDoesNotExist('jobid {} does not exist'.format(jobid))
+        return row[0]
+
+    def _claim(self, conn, jobid):
+        """Claim the reduce within a transaction, returns the metadata or None"""
+        claimed = conn.execute(
+            'UPDATE jobs SET reduce_sent = 1 WHERE id = ? AND reduce_sent = 0', (jobid,)).rowcount
+        if not claimed:
+            return None
+        row = conn.execute('SELECT metadata FROM jobs WHERE id = ?', (jobid,)).fetchone()
+        return json.loads(row[0])
+
+    def _complete(self, jobid, partids, claim):
+        """Remove parts and claim the reduce in one transaction"""
+        with self._transaction() as conn:
+            remaining = self._remove_parts(conn, jobid, partids)
+            metadata = self._claim(conn, jobid) if claim and remaining == 0 else None
+        return remaining, metadata
+
+    @instrumented('claim_reduce')
+    def claim_reduce(self, jobid):
+        """Claim the right to send the reduce message for a job
+
+        Returns
+        -------
+        dict or None
+            The job metadata if this caller claimed the reduce,
+            None if it had already been claimed or the job does not exist
+        """
+        with self._transaction() as conn:
+            return self._claim(conn, jobid)
+
+    @instrumented('release_reduce')
+    def release_reduce(self, jobid):
+        """Give up a reduce claim, e.g. when the reduce message could not be sent
+        """
+        self._connection().execute('UPDATE jobs SET reduce_sent = 0 WHERE id = ?', (jobid,))
+
+    @instrumented('set_metadata')
+    def set_metadata(self, jobid, metadata):
+        """Associate arbitrary metadata with a particular map-reduce job
+        """
+        with self._transaction() as conn:
+            row = conn.execute('SELECT metadata FROM jobs WHERE id = ?', (jobid,)).fetchone()
+            if row is None:
+                raise JobDoesNotExist('jobid {} does not exist'.format(jobid))
+            merged = json.loads(row[0])
+            merged.update(metadata)
+            conn.execute(
+                'UPDATE jobs SET metadata = ? WHERE id = ?', (json.dumps(merged), jobid))
+
+    @instrumented('list_pending_parts')
+    def list_pending_parts(self, jobid):
+        """Pending (incomplete) part numbers for a given jobid
+        """
+        conn = self._connection()
+        if conn.execute('SELECT 1 FROM jobs WHERE id = ?', (jobid,)).fetchone() is None:
+            raise JobDoesNotExist('jobid {} does not exist'.format(jobid))
+        return [row[0] for row in conn.execute(
+            'SELECT partid FROM parts WHERE jobid = ? ORDER BY partid', (jobid,))]
+
+    def list_jobs(self, status=True, active_only=False, jobids=None):
+        """Yields all jobs, oldest first
+
+        If status is True, the yielded items will be the full status dictionary of each job
+        If status is False, the items will be job ids only
+        If active_only is True, only jobs with remaining parts are yielded
+        If jobids are given, only those jobs are yielded
+        """
+        if jobids is not None:
+            for data in self._list_given_jobs(jobids, status, active_only):
+                yield data
+            return
+
+        query = 'SELECT {} FROM jobs{} ORDER BY created'.format(
+            STATUS_COLUMNS, ' WHERE remaining > 0' if active_only else '')
+        for row in self._connection().execute(query).fetchall():
+            yield self._build_status(row) if status else row[0]
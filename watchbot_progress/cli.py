@@ -1,36 +1,25 @@
 from __future__ import division
 
+from datetime import timedelta
 import json
+import time
+
 import click
-try:  # pragma: no cover
-    from urllib.parse import urlparse
-except ImportError:  # pragma: no cover
-    from urlparse import urlparse
 
 from watchbot_progress.backends.redis import RedisProgress
 from watchbot_progress.backends.dynamodb import DynamoProgress
+from watchbot_progress.utils import ProgressWindow
 
 
-DBHELP = 'a dynamodb table ARN or a redis URI connection string e.g. `redis://localhost:6379`'
+DBHELP = ('a dynamodb table ARN or a redis URI connection string e.g. `redis://localhost:6379`, '
+          '`rediss://:password@host:6380/0` or `unix:///path/to/redis.sock`')
 
 
 def validate_db(ctx, param, value):
     topic_arn = 'should-never-need-to-use-SNS'
 
-    if value.startswith('redis'):
-        url = urlparse(value)
-        assert url.scheme == 'redis'
-
-        db = 0
-        if url.query:
-            queries = url.query.split('&')
-            for query in queries:
-                k, v = query.split('=')
-                if k == 'db':
-                    db = int(v)
-
-        host, port = url.netloc.split(":")
-        return RedisProgress(host=host, port=port, db=db, topic_arn=topic_arn)
+    if value.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisProgress.from_url(value, topic_arn=topic_arn)
 
     elif value.startswith('arn:'):
         return DynamoProgress(table_arn=value, topic_arn=topic_arn)
@@ -46,14 +35,19 @@ def main():
 
 
 @main.command()
-@click.argument('jobid', type=str)
+@click.argument('jobids', type=str, nargs=-1, required=True)
 @click.option('--database', '-d', default='dynamodb', nargs=1, callback=validate_db, help=DBHELP)
-def info(jobid, database):
-    '''Returns the status of a specific jobid for a watchbot-progress job
-    as single JSON object
+def info(jobids, database):
+    '''Returns the status of specific jobids for a watchbot-progress job
+    as JSON objects, one per line
     '''
-    status = database.status(jobid)
-    click.echo(json.dumps(status))
+    if len(jobids) == 1:
+        statuses = [database.status(jobids[0])]
+    else:
+        # jobs which do not exist are skipped
+        statuses = database.status_many(jobids)
+    for status in statuses:
+        click.echo(json.dumps(status))
 
 
 @main.command()
@@ -62,13 +56,20 @@ def info(jobid, database):
               help="Show full status object, otherwise only jobid")
 @click.option('--hide-completed', is_flag=True,
               help="show only jobs with pending parts")
-def ls(database, status, hide_completed):
+@click.option('--rebuild-registry', is_flag=True,
+              help="register jobs created without the redis job registry first, "
+                   "found by scanning every key")
+def ls(database, status, hide_completed, rebuild_registry):
     '''Scans the database for jobs and lists them as a jobids
     '''
-    jobs = database.list_jobs(status=status)
+    if rebuild_registry:
+        if not isinstance(database, RedisProgress):
+            raise click.BadParameter('only redis databases have a job registry',
+                                     param_hint='--rebuild-registry')
+        database.rebuild_registry()
+    jobs = database.list_jobs(status=status, active_only=hide_completed)
     for job in jobs:
-        if not hide_completed or (hide_completed and job['remaining'] > 0):
-            click.echo(job)
+        click.echo(job)
 
 
 @main.command()
@@ -85,3 +86,61 @@ def pending(jobid, database, array):
     else:
         for part in parts:
             click.echo(part)
+
+
+def _describe(jobid, window, stall, now):
+    """One line summary of a job's progress"""
+    if window.remaining == 0:
+        return '{}: complete, {} parts'.format(jobid, window.total)
+
+    done = window.total - window.remaining
+    eta = window.eta()
+    line = '{}: {}/{} parts ({:.1%}), {:.2f} parts/s, ETA {}'.format(
+        jobid, done, window.total, done / window.total, window.rate(),
+        timedelta(seconds=int(eta)) if eta is not None else 'unknown')
+    stalled = window.stalled_for(now)
+    if stalled >= stall:
+        line += ', stalled for {}'.format(timedelta(seconds=int(stalled)))
+    return line
+
+
+@main.command()
+@click.argument('jobids', type=str, nargs=-1, required=True)
+@click.option('--database', '-d', default='dynamodb', nargs=1, callback=validate_db, help=DBHELP)
+@click.option('--interval', default=5.0, type=float,
+              help='Seconds between polls while jobs are progressing')
+@click.option('--max-interval', default=60.0, type=float,
+              help='Longest wait between polls, reached by backing off while jobs are not progressing')
+@click.option('--window', default=10, type=int,
+              help='Number of polls the rate and ETA are measured over')
+@click.option('--stall', default=300.0, type=float,
+              help='Seconds without progress before a job is reported as stalled')
+def watch(jobids, database, interval, max_interval, window, stall):
+    '''Polls jobs until they are complete, showing throughput and ETA
+
+    Only the count of remaining parts is read on each poll.
+    '''
+    now = time.time()
+    windows = []
+    for status in database.status_many(jobids):
+        progress = ProgressWindow(status['total'], size=window)
+        progress.add(status['remaining'], now)
+        windows.append((status['jobid'], progress))
+    if not windows:
+        raise click.ClickException('no such jobs: {}'.format(', '.join(jobids)))
+
+    delay = interval
+    while True:
+        for jobid, progress in windows:
+            click.echo(_describe(jobid, progress, stall, now))
+        if all(progress.remaining == 0 for _, progress in windows):
+            break
+
+        time.sleep(delay)
+        now = time.time()
+        progressed = False
+        for jobid, progress in windows:
+            if progress.remaining:
+                progressed |= progress.add(database.remaining(jobid), now)
+        # poll slow jobs less often
+        delay = interval if progressed else min(delay * 2, max_interval)
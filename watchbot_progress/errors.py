@@ -9,3 +9,7 @@ class JobFailed(RuntimeError):
 
 class ProgressTypeError(TypeError):
     """Progress argument is not of the correct type"""
+
+
+class PublishError(RuntimeError):
+    """SNS messages could not be published"""
@@ -2,38 +2,106 @@ from __future__ import division
 
 from concurrent import futures
 from contextlib import contextmanager
-from functools import partial
 import logging
 import math
+import multiprocessing
+import threading
 import uuid
 import warnings
 
+from watchbot_progress import metrics
 from watchbot_progress.backends.dynamodb import DynamoProgress
 from watchbot_progress.backends.base import WatchbotProgressBase
+from watchbot_progress.backends.memory import MemoryProgress
 from watchbot_progress.errors import ProgressTypeError, JobFailed
-from watchbot_progress.utils import chunker, sns_worker, aws_send_message
+from watchbot_progress.utils import (
+    chunker, sns_worker, aws_send_message, part_range, FailedJobCache, SNS_BATCH_SIZE)
 
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Most map messages handed to a publisher thread at once
+MAX_CHUNK_SIZE = 1000
+
+# Job failure checks made by Part are shared across the process
+failed_jobs = FailedJobCache(ttl=10)
+
 #
 # The main public interfaces, create_job and Part
 #
 
 
-def create_job(parts, jobid=None, workers=25, progress=None, metadata=None):
+def _annotate_parts(parts, jobid, metadata, total):
+    """Lazily add partid, jobid and metadata to each part"""
+    partid = -1
+    for partid, original_part in enumerate(parts):
+        if partid >= total:
+            raise ValueError('job {} has more than {} parts'.format(jobid, total))
+        part = original_part.copy()
+        part.update(partid=partid)
+        part.update(jobid=jobid)
+        part.update(metadata=metadata)
+        yield part
+    if partid + 1 != total:
+        raise ValueError('job {} has {} parts, expected {}'.format(jobid, partid + 1, total))
+
+
+def _start_job(parts, jobid, progress, metadata, total):
+    """Record a new job with the backend, returns the parts and their total"""
+    if total is None:
+        try:
+            total = len(parts)
+        except TypeError:
+            parts = list(parts)
+            total = len(parts)
+
+    # a range rather than the count, for backends which take len() of parts
+    progress.set_total(jobid, part_range(total))
+
+    if metadata:
+        progress.set_metadata(jobid, metadata)
+
+    return parts, total
+
+
+def _publish(messages, topic, workers, chunk_size):
+    """Send map messages from any iterable, concurrently
+
+    At most two chunks per worker are held in memory at once. The first
+    publishing error is raised as soon as it is seen.
+    """
+    slots = threading.BoundedSemaphore(workers * 2)
+    pending = []
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunker(messages, chunk_size):
+            slots.acquire()
+            future = executor.submit(sns_worker, chunk, topic, subject='map')
+            future.add_done_callback(lambda _: slots.release())
+            pending.append(future)
+            for done in [f for f in pending if f.done()]:
+                done.result()
+                pending.remove(done)
+        for future in pending:
+            future.result()
+
+
+def create_job(parts, jobid=None, workers=25, progress=None, metadata=None, total=None):
     """Create a reduce mode job
 
     Handles all the details of reduce-mode accounting (SNS, partid and jobid)
 
+    parts: iterable of dicts
+        Any iterable, including generators, is streamed to SNS without
+        holding the whole job in memory
     jobid: string
         Reduce mode job
-    partid: string
-        Part number
     progress: WatchbotProgress
         Instance of a WatchbotProgress class
         Defaults to DynamoProgress
+    total: optional int
+        Number of parts. Required to stream parts which have no len(),
+        otherwise they are read into a list first.
     """
     if progress is None:
         progress = DynamoProgress()
@@ -44,29 +112,38 @@ def create_job(parts, jobid=None, workers=25, progress=None, metadata=None):
 
     jobid = jobid if jobid else str(uuid.uuid4())
 
-    progress.set_total(jobid, parts)
+    with metrics.measure('create_job', jobid):
+        parts, total = _start_job(parts, jobid, progress, metadata, total)
 
-    if metadata:
-        progress.set_metadata(jobid, metadata)
+        # Spread small jobs across all workers, cap the chunk size for large ones
+        chunk_size = min(max(int(math.ceil(total / workers)), SNS_BATCH_SIZE), MAX_CHUNK_SIZE)
 
-    annotated_parts = []
-    for partid, original_part in enumerate(parts):
-        part = original_part.copy()
-        part.update(partid=partid)
-        part.update(jobid=jobid)
-        part.update(metadata=metadata)
-        annotated_parts.append(part)
+        # Send SNS message for each part, concurrently
+        _publish(_annotate_parts(parts, jobid, metadata, total),
+                 progress.topic, workers, chunk_size)
+
+    return jobid
 
-    # Create chunks of messages to be processed by each thread
-    chunk_size = max(math.ceil(len(annotated_parts) / workers), workers)
-    _chunks = chunker(annotated_parts, chunk_size)
 
-    # Send SNS message for each part, concurrently
-    _send_message = partial(sns_worker, topic=progress.topic, subject='map')
-    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        executor.map(_send_message, _chunks)
+def _reduce(jobid, metadata, progress, on_reduce):
+    """Send the reduce message for a job whose reduce has been claimed"""
+    if metadata is None:
+        warnings.warn('skip reduce message, already sent for job {}'.format(jobid))
+        return
 
-    return jobid
+    message = {
+        'jobid': jobid,
+        'metadata': metadata}
+    try:
+        with metrics.measure('reduce', jobid):
+            if on_reduce is None:
+                aws_send_message(message, progress.topic, subject='reduce')
+            else:
+                on_reduce(message, progress.topic, subject='reduce')
+    except Exception:
+        # let a retry of this part send the reduce message
+        progress.release_reduce(jobid)
+        raise
 
 
 @contextmanager
@@ -100,7 +177,7 @@ def Part(jobid, partid, progress=None, fail_job_on=(), on_reduce=None, **kwargs)
 
     if fail_job_on:
         # Only check for job failure if there are exception types to fail on
-        if 'failed' in progress.status(jobid):
+        if failed_jobs.is_failed(progress, jobid):
             raise JobFailed('job {} already failed'.format(jobid))
 
     try:
@@ -109,22 +186,148 @@ def Part(jobid, partid, progress=None, fail_job_on=(), on_reduce=None, **kwargs)
     except Exception as err:
         if any(isinstance(err, f) for f in fail_job_on):
             progress.fail_job(jobid, partid)
+            failed_jobs.mark_failed(jobid)
         raise
     else:
-        all_done = progress.complete_part(jobid, partid)
+        all_done, metadata = progress.complete_part_and_claim_reduce(jobid, partid)
         if all_done:
-            status = progress.status(jobid)
-            metadata = status.get('metadata', {})
-            message = {
-                'jobid': jobid,
-                'metadata': metadata}
-
-            already_sent = metadata.get('reduce_message_sent', False)
-            if already_sent:
-                warnings.warn('skip reduce message, already sent for job {}'.format(jobid))
-            else:
-                if on_reduce is None:
-                    aws_send_message(message, progress.topic, subject='reduce')
-                else:
-                    on_reduce(message, progress.topic, subject='reduce')
-                progress.set_metadata(jobid, {'reduce_message_sent': True})
+            _reduce(jobid, metadata, progress, on_reduce)
+
+
+@contextmanager
+def Parts(jobid, partids, progress=None, fail_job_on=(), on_reduce=None, **kwargs):
+    """Context manager to handle several parts of an ecs-watchbot reduce job at once.
+
+    All parts are marked complete with a single write when the context
+    block succeeds. Takes the same parameters as Part, except
+
+    partids: sequence
+        Part numbers
+    """
+    if progress is None:
+        progress = DynamoProgress()
+
+    if not isinstance(progress, WatchbotProgressBase):
+        raise ProgressTypeError(
+            'progress must be an instance of WatchbotProgressBase')
+
+    if fail_job_on:
+        # Only check for job failure if there are exception types to fail on
+        if failed_jobs.is_failed(progress, jobid):
+            raise JobFailed('job {} already failed'.format(jobid))
+
+    try:
+        # yield control to the context block which processes the messages
+        yield
+    except Exception as err:
+        if any(isinstance(err, f) for f in fail_job_on):
+            progress.fail_job(jobid, ', '.join(str(p) for p in partids))
+            failed_jobs.mark_failed(jobid)
+        raise
+    else:
+        all_done, metadata = progress.complete_parts_and_claim_reduce(jobid, partids)
+        if all_done:
+            _reduce(jobid, metadata, progress, on_reduce)
+
+
+#
+# Running jobs locally, without SNS
+#
+
+
+class _ReduceCollector(object):
+    """on_reduce hook which keeps the reduce message for the caller"""
+
+    def __init__(self):
+        self.message = None
+
+    def __call__(self, message, topic, subject=None):
+        self.message = message
+
+
+def _run_part(map_fn, message, progress, fail_job_on):
+    """Run the map function on one part, in a worker thread or process
+
+    Returns the reduce message if this part completed the job.
+    """
+    collector = _ReduceCollector()
+    with Part(progress=progress, fail_job_on=fail_job_on, on_reduce=collector, **message):
+        map_fn(message)
+    return collector.message
+
+
+def run_job(parts, map_fn, reduce_fn=None, executor=None, progress=None,
+            jobid=None, metadata=None, total=None, fail_job_on=()):
+    """Run a reduce mode job on this host
+
+    Parts are annotated and accounted for exactly as by create_job and Part,
+    but each map message is handed directly to map_fn in a pool of workers
+    instead of being published to SNS. The reduce message is passed to
+    reduce_fn in the calling process.
+
+    parts: iterable of dicts
+    map_fn: function
+        Called with each map message, the part dict with jobid, partid
+        and metadata added. Must be picklable to use a process pool.
+    reduce_fn: optional function
+        Called with the reduce message, {'jobid': ..., 'metadata': ...}
+    executor: concurrent.futures.Executor
+        Runs map_fn. Defaults to a thread pool with a worker per CPU
+    progress: WatchbotProgress
+        Instance of a WatchbotProgress class
+        Defaults to MemoryProgress. Process pools need a backend which
+        worker processes can share, such as SqliteProgress
+    jobid, metadata, total, fail_job_on:
+        As for create_job and Part
+
+    Returns
+    -------
+    The result of reduce_fn, or None
+    """
+    if progress is None:
+        progress = MemoryProgress()
+
+    if not isinstance(progress, WatchbotProgressBase):
+        raise ProgressTypeError(
+            'progress must be an instance of WatchbotProgressBase')
+
+    jobid = jobid if jobid else str(uuid.uuid4())
+
+    own_executor = executor is None
+    if own_executor:
+        executor = futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count())
+
+    try:
+        with metrics.measure('run_job', jobid):
+            parts, total = _start_job(parts, jobid, progress, metadata, total)
+
+            # At most MAX_CHUNK_SIZE map messages wait for a worker at once
+            pending = set()
+            reduce_message = None
+            for message in _annotate_parts(parts, jobid, metadata, total):
+                if len(pending) >= MAX_CHUNK_SIZE:
+                    done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    reduce_message = _collect(done) or reduce_message
+                pending.add(executor.submit(_run_part, map_fn, message, progress, fail_job_on))
+            reduce_message = _collect(pending) or reduce_message
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    if reduce_message is None or reduce_fn is None:
+        return None
+    with metrics.measure('reduce', jobid):
+        return reduce_fn(reduce_message)
+
+
+def _collect(finished):
+    """Results of map futures, raising the first error
+
+    Returns the reduce message, if one of them completed the job.
+    """
+    reduce_message = None
+    for future in finished:
+        message = future.result()
+        if message is not None:
+            reduce_message = message
+    return reduce_message
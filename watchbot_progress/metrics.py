@@ -0,0 +1,215 @@
+from __future__ import division
+
+import functools
+import logging
+import math
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Registered sinks. Instrumented operations do nothing more than check
+# this list until a sink is added.
+_sinks = []
+_local = threading.local()
+
+
+class Event(object):
+    """A single instrumented operation
+
+    op: string, operation name e.g. 'complete_part' or 'sns.publish_batch'
+    jobid: string or None
+    duration: float, seconds
+    round_trips: integer, requests made to the database or SNS
+    payload_bytes: integer, bytes of messages sent, where known
+    error: the exception raised by the operation, or None
+    """
+
+    __slots__ = ('op', 'jobid', 'duration', 'round_trips', 'payload_bytes', 'error')
+
+    def __init__(self, op, jobid=None):
+        self.op = op
+        self.jobid = jobid
+        self.duration = 0.0
+        self.round_trips = 0
+        self.payload_bytes = 0
+        self.error = None
+
+
+class Sink(object):
+    """Receives an Event for every instrumented operation
+
+    Called from whichever thread ran the operation, so implementations
+    must be thread safe.
+    """
+
+    def record(self, event):
+        raise NotImplementedError()
+
+
+def add_sink(sink):
+    """Start sending events to a sink"""
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    """Stop sending events to a sink"""
+    _sinks.remove(sink)
+
+
+def clear_sinks():
+    del _sinks[:]
+
+
+def round_trip(payload_bytes=0, count=1):
+    """Count requests made by the operation being recorded on this thread
+    """
+    if not _sinks:
+        return
+    events = getattr(_local, 'events', None)
+    if events:
+        events[-1].round_trips += count
+        events[-1].payload_bytes += payload_bytes
+
+
+def _start(op, jobid):
+    event = Event(op, jobid)
+    events = getattr(_local, 'events', None)
+    if events is None:
+        events = _local.events = []
+    events.append(event)
+    return event, time.time()
+
+
+def _finish(event, start, error=None):
+    event.duration = time.time() - start
+    event.error = error
+    events = _local.events
+    events.pop()
+    if events:
+        # requests made by nested operations count towards the outer one too
+        events[-1].round_trips += event.round_trips
+        events[-1].payload_bytes += event.payload_bytes
+    for sink in list(_sinks):
+        try:
+            sink.record(event)
+        except Exception:
+            logger.exception('metrics sink {} failed'.format(sink))
+
+
+def instrumented(op, jobid=True):
+    """Decorate a method taking a jobid as its first argument,
+    which may also be passed by keyword
+
+    With jobid=False the first argument is not recorded, e.g. for
+    methods of many jobs.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not _sinks:
+                return func(self, *args, **kwargs)
+            if jobid:
+                event, start = _start(op, args[0] if args else kwargs.get('jobid'))
+            else:
+                event, start = _start(op, None)
+            try:
+                result = func(self, *args, **kwargs)
+            except Exception as err:
+                _finish(event, start, err)
+                raise
+            _finish(event, start)
+            return result
+        return wrapper
+    return decorator
+
+
+class measure(object):
+    """Context manager recording an operation which is not a method"""
+
+    __slots__ = ('op', 'jobid', '_event', '_start')
+
+    def __init__(self, op, jobid=None):
+        self.op = op
+        self.jobid = jobid
+        self._event = None
+
+    def __enter__(self):
+        if _sinks:
+            self._event, self._start = _start(self.op, self.jobid)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._event is not None:
+            self._event.jobid = self.jobid
+            _finish(self._event, self._start, exc)
+
+
+def _percentile(ordered, p):
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[max(int(math.ceil(p / 100 * len(ordered))) - 1, 0)]
+
+
+class MemorySink(Sink):
+    """Aggregates events per operation in memory
+
+    Keeps up to max_samples durations per operation, sampled uniformly
+    once there are more, for the percentiles.
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._ops = {}
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        with self._lock:
+            stats = self._ops.get(event.op)
+            if stats is None:
+                stats = self._ops[event.op] = {
+                    'count': 0, 'errors': 0, 'round_trips': 0,
+                    'payload_bytes': 0, 'seconds': 0.0, 'samples': []}
+            stats['count'] += 1
+            stats['round_trips'] += event.round_trips
+            stats['payload_bytes'] += event.payload_bytes
+            stats['seconds'] += event.duration
+            if event.error is not None:
+                stats['errors'] += 1
+
+            samples = stats['samples']
+            if len(samples) < self.max_samples:
+                samples.append(event.duration)
+            else:
+                # reservoir sampling
+                i = random.randint(0, stats['count'] - 1)
+                if i < self.max_samples:
+                    samples[i] = event.duration
+
+    def summary(self):
+        """Totals and duration percentiles, in seconds, by operation
+
+        Returns
+        -------
+        dict of operation name to dict
+        """
+        with self._lock:
+            ops = dict((op, dict(stats, samples=sorted(stats['samples'])))
+                       for op, stats in self._ops.items())
+
+        summary = {}
+        for op, stats in ops.items():
+            samples = stats.pop('samples')
+            stats.update(
+                mean=stats['seconds'] / stats['count'],
+                p50=_percentile(samples, 50),
+                p90=_percentile(samples, 90),
+                p99=_percentile(samples, 99),
+                max=samples[-1])
+            summary[op] = stats
+        return summary
+
+    def clear(self):
+        with self._lock:
+            self._ops.clear()
@@ -1,14 +1,197 @@
+from collections import deque
+from itertools import islice
 import json
+import numbers
+import threading
+import time
 
 from boto3.session import Session as boto3_session
 
+from watchbot_progress import metrics
+from watchbot_progress.errors import PublishError
+
+# Maximum number of entries in an SNS PublishBatch request,
+# and the maximum total size of their messages in bytes
+SNS_BATCH_SIZE = 10
+SNS_BATCH_BYTES = 256 * 1024
+
+try:
+    _range = xrange  # noqa: F821, range builds a list on python 2
+except NameError:
+    _range = range
+
 
 def chunker(iterable, n):
     """
-    Chop list in smaller lists
+    Chop any iterable into lists of length n
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, n))
+
+
+def sns_batches(messages, subject=None):
+    """
+    Chop SNS messages into PublishBatch sized lists, limited by both
+    the number of entries and the total size of the encoded messages.
+    A message too large on its own is sent alone, and rejected by SNS.
+    """
+    batch, size = [], 0
+    for message in messages:
+        length = len(json.dumps(message).encode('utf-8')) + len(subject or '')
+        if batch and (len(batch) == SNS_BATCH_SIZE or size + length > SNS_BATCH_BYTES):
+            yield batch
+            batch, size = [], 0
+        batch.append(message)
+        size += length
+    if batch:
+        yield batch
+
+
+def part_count(parts):
+    """
+    Number of parts, given either as a count or a sized collection of parts
+    """
+    if isinstance(parts, numbers.Integral):
+        return int(parts)
+    return len(parts)
+
+
+def part_range(total):
+    """
+    Part numbers of a job of ``total`` parts, a lazy but sized sequence
+    which part_count, len() and iteration all accept
     """
-    for i in range(0, len(iterable), n):
-        yield iterable[i:i + n]
+    return _range(total)
+
+
+def pending_bitmap(total):
+    """
+    Bitmap with the first ``total`` bits set, one bit per pending part.
+    Bits are ordered most significant first, matching redis SETBIT offsets.
+    """
+    full, rest = divmod(total, 8)
+    bitmap = bytearray(b'\xff' * full)
+    if rest:
+        bitmap.append((0xff << (8 - rest)) & 0xff)
+    return bytes(bitmap)
+
+
+def bitmap_members(bitmap):
+    """
+    Yield the offsets of all set bits in a bitmap
+    """
+    for index, byte in enumerate(bytearray(bitmap or b'')):
+        if not byte:
+            continue
+        for position in range(8):
+            if byte & (0x80 >> position):
+                yield index * 8 + position
+
+
+class FailedJobCache(object):
+    """
+    Remembers, for ttl seconds, whether jobs have failed
+
+    Expired entries are pruned once the cache holds max_size jobs.
+    """
+
+    def __init__(self, ttl=10, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def is_failed(self, progress, jobid):
+        """
+        Has the job failed? Asks the backend at most once per ttl
+        """
+        now = time.time()
+        entry = self._jobs.get(jobid)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        failed = progress.is_failed(jobid)
+        self._set(jobid, failed, now)
+        return failed
+
+    def mark_failed(self, jobid):
+        """
+        Record a failure made by this process
+        """
+        self._set(jobid, True, time.time())
+
+    def clear(self):
+        with self._lock:
+            self._jobs.clear()
+
+    def _set(self, jobid, failed, now):
+        with self._lock:
+            if len(self._jobs) >= self.max_size:
+                self._jobs = dict(
+                    (k, v) for k, v in self._jobs.items() if v[1] > now)
+            self._jobs[jobid] = (failed, now + self.ttl)
+
+
+class ProgressWindow(object):
+    """
+    Sliding window of remaining part counts sampled from a job
+
+    The rate is measured across the oldest and newest samples in the window.
+    """
+
+    def __init__(self, total, size=10):
+        self.total = total
+        self.samples = deque(maxlen=size)
+        self.last_progress = None
+
+    def add(self, remaining, now=None):
+        """
+        Record a sample, returns whether parts were completed since the last one
+        """
+        now = time.time() if now is None else now
+        progressed = not self.samples or remaining < self.samples[-1][1]
+        if progressed:
+            self.last_progress = now
+        self.samples.append((now, remaining))
+        return progressed
+
+    @property
+    def remaining(self):
+        return self.samples[-1][1] if self.samples else self.total
+
+    def rate(self):
+        """
+        Parts completed per second across the window
+        """
+        if len(self.samples) < 2:
+            return 0.0
+        (start, start_remaining), (end, end_remaining) = self.samples[0], self.samples[-1]
+        if end <= start:
+            return 0.0
+        return max(start_remaining - end_remaining, 0) / float(end - start)
+
+    def eta(self):
+        """
+        Seconds until the job is complete at the current rate, None if unknown
+        """
+        rate = self.rate()
+        if not self.remaining:
+            return 0.0
+        if not rate:
+            return None
+        return self.remaining / rate
+
+    def stalled_for(self, now=None):
+        """
+        Seconds since parts were last completed
+        """
+        now = time.time() if now is None else now
+        if self.last_progress is None:
+            return 0.0
+        return now - self.last_progress
 
 
 def aws_send_message(message, topic, subject=None, client=None):
@@ -20,10 +203,57 @@ def aws_send_message(message, topic, subject=None, client=None):
         session = boto3_session()
         client = session.client('sns')
 
-    return client.publish(
-        Message=json.dumps(message),
-        Subject=subject,
-        TargetArn=topic)
+    body = json.dumps(message)
+    jobid = message.get('jobid') if isinstance(message, dict) else None
+    with metrics.measure('sns.publish', jobid):
+        metrics.round_trip(payload_bytes=len(body))
+        return client.publish(
+            Message=body,
+            Subject=subject,
+            TargetArn=topic)
+
+
+def aws_send_batch(messages, topic, subject=None, client=None, retries=3):
+    """
+    Sends up to 10 SNS messages, totalling up to 256KB, with a single
+    PublishBatch request. See sns_batches.
+
+    Entries which fail on the SNS side are retried, with backoff, up to
+    ``retries`` times. Raises PublishError if any message could not be sent.
+    """
+
+    if not client:
+        session = boto3_session()
+        client = session.client('sns')
+
+    entries = {}
+    for i, message in enumerate(messages):
+        entry = {'Id': str(i), 'Message': json.dumps(message)}
+        if subject:
+            entry['Subject'] = subject
+        entries[entry['Id']] = entry
+
+    jobid = messages[0].get('jobid') if messages and isinstance(messages[0], dict) else None
+    with metrics.measure('sns.publish_batch', jobid):
+        attempt = 0
+        while entries:
+            metrics.round_trip(payload_bytes=sum(len(e['Message']) for e in entries.values()))
+            res = client.publish_batch(
+                TopicArn=topic,
+                PublishBatchRequestEntries=list(entries.values()))
+            for success in res.get('Successful', []):
+                entries.pop(success['Id'], None)
+
+            # Sender faults (e.g. a message that is too large) will never succeed
+            sender_fault = any(f.get('SenderFault') for f in res.get('Failed', []))
+            if sender_fault or (entries and attempt >= retries):
+                raise PublishError('failed to publish {} of {} messages to {}: {}'.format(
+                    len(entries), len(messages), topic, res.get('Failed')))
+            if entries:
+                time.sleep(0.1 * 2 ** attempt)
+                attempt += 1
+
+    return True
 
 
 def sns_worker(messages, topic, subject=None):
@@ -34,7 +264,7 @@ def sns_worker(messages, topic, subject=None):
     session = boto3_session()
     client = session.client('sns')
 
-    for message in messages:
-        aws_send_message(message, topic, subject=subject, client=client)
+    for batch in sns_batches(messages, subject=subject):
+        aws_send_batch(batch, topic, subject=subject, client=client)
 
     return True